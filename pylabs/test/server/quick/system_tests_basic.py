@@ -18,6 +18,7 @@ limitations under the License.
 
 from .. import system_tests_common as C
 import time
+import threading
 import subprocess
 import logging
 from nose.tools import *
@@ -25,7 +26,9 @@ from nose.tools import *
 from Compat import X
 
 CONFIG = C.CONFIG
-from arakoon.ArakoonProtocol import AtLeast
+from arakoon import ArakoonProtocol
+from arakoon.ArakoonProtocol import AtLeast, NoGuarantee, CompactSequence
+from arakoon.ArakoonAsync import AsyncArakoonClient
 
 try:
     assert_in
@@ -189,6 +192,372 @@ def test_large_value ():
     except X.arakoon_client.ArakoonException as inst:
         logging.info('inst=%s', inst)
 
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_get_into ():
+    value = ''.join(chr(i % 256) for i in xrange(3 * 1024 * 1024))
+    client = C.get_client()
+    client.set('blob', value)
+    view = client.get('blob', as_memoryview = True)
+    assert_equals(view.tobytes(), value)
+    buf = bytearray(4 * 1024 * 1024)
+    assert_equals(client.getInto('blob', buf), len(value))
+    assert_equals(str(buf[:len(value)]), value)
+    assert_raises(X.arakoon_client.ArakoonBufferTooSmall,
+                  client.getInto, 'blob', bytearray(16))
+    assert_equals(client.get('blob'), value)
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_read_cache ():
+    client = C.get_client()
+    other = C.get_client()
+    client.set('key', 'value')
+    client.enableReadCache(1024 * 1024, 0.05)
+    cache = client.getReadCache()
+    client.setConsistency(AtLeast(client.get_txid().i))
+    deadline = time.time() + 10.0
+    while cache.getPosition() is None and time.time() < deadline:
+        time.sleep(0.1)
+    assert_equals(client.get('key'), 'value')
+    assert_equals(client.get('key'), 'value')
+    assert_equals(cache.hits, 1)
+    assert_false(client.exists('missing'))
+    other.set('key', 'new value')
+    other.set('missing', 'found')
+    client.setConsistency(AtLeast(other.get_txid().i))
+    assert_equals(client.get('key'), 'new value')
+    assert_true(client.exists('missing'))
+    client.disableReadCache()
+    client.dropConnections()
+    other.dropConnections()
+
+@C.with_custom_setup( C.setup_3_nodes, C.basic_teardown )
+def test_dirty_read_balancing ():
+    client = C.get_client()
+    client.set('key', 'value')
+    client.setConsistency(AtLeast(client.get_txid().i))
+    for i in xrange(100):
+        assert_equals(client.get('key'), 'value')
+    stats = client.getReadBalancer().getStatistics()
+    assert_equals(sum(s['requests'] for s in stats.values()), 100)
+    assert_true(len([s for s in stats.values() if s['requests'] > 0]) > 1)
+    slave = [n for n in C.node_names[:3] if n != client.whoMaster()][0]
+    C.stopOne(slave)
+    for i in xrange(100):
+        assert_equals(client.get('key'), 'value')
+    assert_true(client.getReadBalancer().getStatistics()[slave]['skipped'])
+    C.startOne(slave)
+    client.dropConnections()
+
+@C.with_custom_setup( C.setup_3_nodes, C.basic_teardown )
+def test_circuit_breaker ():
+    client = C.get_client()
+    client.enableCircuitBreaker(failureThreshold = 2, probeInterval = 0.5)
+    client.set('key', 'value')
+    slave = [n for n in C.node_names[:3] if n != client.whoMaster()][0]
+    C.stopOne(slave)
+    client.setDirtyReadNode(slave)
+    client.allowDirtyReads()
+    # the read is retried until the deadline, the slave is skipped after two failures
+    with client.deadline(2.0):
+        assert_raises(X.arakoon_client.ArakoonTimeout, client.get, 'key')
+    health = client.getNodeHealth()[slave]
+    assert_equals(health['state'], 'open')
+    assert_true(health['skipped'] > 0)
+    client.setDirtyReadNode(None)
+    for i in xrange(100):
+        assert_equals(client.get('key'), 'value')
+    C.startOne(slave)
+    deadline = time.time() + 30.0
+    while client.getNodeHealth()[slave]['state'] == 'open' and time.time() < deadline:
+        time.sleep(0.5)
+    client.setDirtyReadNode(slave)
+    assert_equals(client.get('key'), 'value')
+    assert_equals(client.getNodeHealth()[slave]['state'], 'closed')
+    client.disableCircuitBreaker()
+    assert_equals(client.getNodeHealth(), None)
+    client.dropConnections()
+
+@C.with_custom_setup( C.setup_3_nodes, C.basic_teardown )
+def test_hedged_reads ():
+    client = C.get_client()
+    client.set('key', 'value')
+    client.allowDirtyReads()
+    # hedge nearly every read
+    client.enableHedgedReads(1.0)
+    for i in xrange(500):
+        assert_equals(client.get('key'), 'value')
+        assert_equals(client.multiGet(['key']), ['value'])
+    stats = client.getHedgeStatistics()
+    assert_true(stats['issued'] > 0)
+    assert_true(stats['won'] <= stats['issued'])
+    client.disableHedgedReads()
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_trusted_caller ():
+    client = C.get_client()
+    assert_raises( X.arakoon_client.ArakoonInvalidArguments, client.set, 'key', 1 )
+    ArakoonProtocol.ARA_CFG_TRUSTED_CALLER = True
+    try:
+        client.set('key', 'value')
+        assert_equals(client.get(key = 'key'), 'value')
+        assert_equals(client.range(None, True, None, True, maxElements = 1), ['key'])
+    finally:
+        ArakoonProtocol.ARA_CFG_TRUSTED_CALLER = False
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_metrics ():
+    client = C.get_client()
+    metrics = client.getMetrics()
+    metrics.reset()
+    for i in xrange(100):
+        client.set('key_%d' % i, 'value')
+        client.get('key_%d' % i)
+    snapshot = metrics.snapshot(reset = True)
+    get = snapshot['latency'][ArakoonProtocol.ARA_CMD_GET]
+    assert_equals(get.count, 100)
+    assert_equals(snapshot['latency'][ArakoonProtocol.ARA_CMD_SET].count, 100)
+    assert_true(get.percentile(50) <= get.percentile(99) <= get.max)
+    assert_true(snapshot['bytesSent'] > 0 and snapshot['bytesReceived'] > 0)
+    assert_equals(metrics.snapshot()['latency'], {})
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_bulk_write ():
+    client = C.get_client()
+    seq = client.makeSequence(compact = True)
+    seq.addSets(("key_%04d" % i, "value") for i in xrange(100))
+    seq.addDelete("key_0000")
+    client.sequence(seq)
+    assert_equals(len(client.prefix("key_")), 99)
+    updates = [ ArakoonProtocol.Set("bulk_%04d" % i, "x" * 100) for i in xrange(1000) ]
+    assert_raises( X.arakoon_client.ArakoonSequenceTooLarge, client.bulkWrite, updates, maxBytes = 10000 )
+    assert_equals(client.prefix("bulk_"), [])
+    assert_true(client.bulkWrite(updates, allowSplit = True, maxBytes = 10000) > 1)
+    assert_equals(len(client.prefix("bulk_", 2000)), 1000)
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_bulk_loader ():
+    client = C.get_client()
+    progress = []
+    loader = client.bulkLoader(connections = 2)
+    stats = loader.load((("load_%05d" % i, "x" * 100) for i in xrange(20000)), progress.append, 0.0)
+    assert_equals(stats['keys'], 20000)
+    assert_equals(stats['performed'], 20000)
+    assert_true(len(progress) > 0)
+    assert_equals(len(client.prefix("load_", 30000)), 20000)
+    assert_equals(client.get("load_12345"), "x" * 100)
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_write_behind ():
+    client = C.get_client()
+    client.set("gone", "x")
+    with client.writeBehind(maxDelay = 60.0) as wb:
+        for i in xrange(1000):
+            wb.set("counter", str(i))
+        wb.delete("gone")
+        wb.delete("never")
+        assert_equals(wb.get("counter"), "999")
+        assert_false(wb.exists("gone"))
+        assert_equals(client.get("gone"), "x")
+    assert_equals(client.get("counter"), "999")
+    assert_false(client.exists("gone"))
+    assert_equals(wb.getStatistics()['flushes'], 1)
+    assert_equals(wb.getStatistics()['coalesced'], 999)
+    wb = client.writeBehind(maxDelay = 0.1)
+    wb.set("later", "y")
+    time.sleep(1.0)
+    assert_equals(client.get("later"), "y")
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_value_codec ():
+    client = C.get_client()
+    plain = C.get_client()
+    blob = "".join('{"id": %d, "name": "user_%d", "tags": ["a", "b"]}' % (i, i) for i in xrange(200))
+    plain.set("plain", blob)
+    client.setValueCodec("zlib")
+    client.set("packed", blob)
+    client.set("small", "tiny")
+    assert_true(len(plain.get("packed")) < len(blob) / 4)
+    assert_equals(plain.get("small"), "tiny")
+    assert_equals(client.get("packed"), blob)
+    assert_equals(client.get("plain"), blob)
+    assert_equals(client.multiGet(["packed", "plain", "small"]), [blob, blob, "tiny"])
+    assert_equals(dict(client.range_entries("p", True, None, True))["packed"], blob)
+    seq = client.makeSequence()
+    seq.addSet("seq", blob)
+    seq.addAssert("packed", blob)
+    client.sequence(seq)
+    assert_equals(client.get("seq"), blob)
+    assert_equals(client.testAndSet("seq", blob, blob + "!"), blob)
+    assert_equals(client.get("seq"), blob + "!")
+    compact = client.makeSequence(compact = True)
+    compact.addSets([("compact", blob), ("compact_small", "tiny")])
+    compact.addAssert("packed", blob)
+    encoded = client.getValueCodec().encodeUpdate(compact)
+    assert_true(isinstance(encoded, CompactSequence))
+    assert_equals(len(encoded), 3)
+    assert_true(encoded.size() < compact.size() / 4)
+    client.sequence(compact)
+    assert_true(len(plain.get("compact")) < len(blob) / 4)
+    assert_equals(client.multiGet(["compact", "compact_small"]), [blob, "tiny"])
+    pipeline = client.pipeline()
+    pipeline.set("pipelined", blob)
+    pipeline.get("pipelined")
+    pipeline.replace("pipelined", blob + "!")
+    pipeline.multiGet(["pipelined", "packed"])
+    assert_equals(pipeline.execute(), [None, blob, blob, [blob + "!", blob]])
+    assert_true(len(plain.get("pipelined")) < len(blob) / 4)
+    async = AsyncArakoonClient(client._config)
+    async.setValueCodec("zlib")
+    assert_equals(async.set("async", blob).result(), None)
+    assert_true(len(plain.get("async")) < len(blob) / 4)
+    assert_equals(async.get("async").result(), blob)
+    assert_equals(async.multiGet(["async", "packed", "small"]).result(), [blob, blob, "tiny"])
+    async.dropConnections()
+    client.setValueCodec(None)
+    assert_not_equals(client.get("packed"), blob)
+    client.dropConnections()
+    plain.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_large_objects ():
+    client = C.get_client()
+    blob = "".join(chr(i % 251) for i in xrange(5 * 1024 * 1024 + 17))
+    assert_equals(client.putObject("object", blob, 512 * 1024), len(blob))
+    assert_equals(len(client.prefix("@chunk/object\x00", 100)), 11)
+    assert_equals(client.getObject("object"), blob)
+    reader = client.openObject("object", 2)
+    assert_equals(reader.size, len(blob))
+    assert_equals(reader.read(1000) + "".join(reader), blob)
+    reader.close()
+    client.putObject("object", "small")
+    assert_equals(client.getObject("object"), "small")
+    assert_equals(len(client.prefix("@chunk/object\x00", 100)), 1)
+    client.set("plain", "value")
+    assert_raises(X.arakoon_client.ArakoonInvalidObject, client.getObject, "plain")
+    client.deleteObject("object")
+    assert_false(client.exists("object"))
+    assert_equals(client.prefix("@chunk/object\x00", 100), [])
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_change_feed ():
+    client = C.get_client()
+    client.set("before", "x")
+    feed = client.changeFeed(checkpointKey = "feed_position", ackBatch = 2)
+    assert_equals(list(feed.changes(block = False)), [])
+    client.set("a", "1")
+    client.delete("a")
+    seq = client.makeSequence()
+    seq.addSet("b", "2")
+    client.sequence(seq)
+    changes = list(feed.changes(block = False))
+    kinds = [ type(ch.updates[0]).__name__ for ch in changes ]
+    assert_equals(kinds, ["Set", "Delete", "Sequence"])
+    assert_equals(changes[0].updates[0].key, "a")
+    for ch in changes:
+        feed.ack(ch.i)
+    feed.close()
+    assert_equals(int(client.get("feed_position")), changes[-1].i)
+    client.set("c", "3")
+    resumed = client.changeFeed(checkpointKey = "feed_position")
+    assert_equals([ ch.updates[0].key for ch in resumed.changes(block = False) ], ["c"])
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_user_hook ():
+    client = C.get_client()
+    # the nodes of the test cluster have no hooks registered
+    stream = client.userHook("no_such_hook")
+    assert_raises( X.arakoon_client.ArakoonUserHookNotFound, stream.readResult )
+    assert_true( stream.closed )
+    stream = client.userHook("no_such_hook", NoGuarantee())
+    assert_raises( X.arakoon_client.ArakoonUserHookNotFound, stream.readResult )
+    client.set("key", "value")
+    assert_equals(client.get("key"), "value")
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_read_your_writes ():
+    client = C.get_client()
+    client.enableReadYourWrites()
+    for i in xrange(100):
+        key = "key_%03d" % i
+        client.set(key, str(i))
+        assert_equals(client.get(key), str(i))
+        assert_true(client.exists(key))
+    stats = client.getSessionStatistics()
+    assert_equals(stats['txidFetches'], 100)
+    client.delete("key_000")
+    assert_false(client.exists("key_000"))
+    client.disableReadYourWrites()
+    assert_equals(client.getSessionStatistics(), None)
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_bounded_staleness ():
+    client = C.get_client()
+    for i in xrange(100):
+        client.set("key_%03d" % i, str(i))
+    client.enableBoundedStaleness(maxEntries = 1000, probeInterval = 0.1)
+    deadline = time.time() + 10.0
+    while len(client.getStalenessStatistics()['nodes']) < len(client._config.getNodes()) and \
+          time.time() < deadline:
+        time.sleep(0.1)
+    stats = client.getStalenessStatistics()
+    assert_equals(len(stats['nodes']), len(client._config.getNodes()))
+    for progress in stats['nodes'].itervalues():
+        assert_true(0 <= progress['behind'] <= 1000)
+    for i in xrange(100):
+        assert_equals(client.get("key_%03d" % i), str(i))
+    # with both bounds, a node within either of them will do
+    client.enableBoundedStaleness(maxEntries = 0, maxSeconds = 3600.0, probeInterval = 0.1)
+    tracker = client._consistency.tracker
+    deadline = time.time() + 10.0
+    while tracker.lowerBound(0, 3600.0) is None and time.time() < deadline:
+        time.sleep(0.1)
+    both = tracker.lowerBound(0, 3600.0)
+    assert_equals(both, min(tracker.lowerBound(0, None), tracker.lowerBound(None, 3600.0)))
+    assert_true(both <= tracker.lowerBound(0, None))
+    for i in xrange(100):
+        assert_equals(client.get("key_%03d" % i), str(i))
+    client.disableBoundedStaleness()
+    assert_equals(client.getStalenessStatistics(), None)
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_deadline ():
+    client = C.get_client()
+    with client.deadline(5.0):
+        client.set("key", "value")
+        assert_equals(client.get("key"), "value")
+    with client.deadline(0.0):
+        assert_raises(X.arakoon_client.ArakoonTimeout, client.get, "key")
+    assert_raises(X.arakoon_client.ArakoonInvalidArguments, client.deadline, -1)
+    assert_equals(client.get("key"), "value")
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown )
+def test_paging_iterators ():
+    client = C.get_client()
+    keys = ["key_%04d" % i for i in xrange(250)]
+    for k in keys:
+        client.set(k, k)
+    for prefetch in (False, True):
+        kvs = list(client.iterRangeEntries(None, True, None, True, 100, prefetch))
+        assert_equals(kvs, zip(keys, keys))
+        kvs = list(client.iterRevRangeEntries("key_0200", False, None, True, 30, prefetch))
+        assert_equals([k for (k, _) in kvs], list(reversed(keys[:200])))
+        assert_equals(list(client.iterPrefix("key_01", 7, prefetch)), keys[100:200])
+        assert_equals(list(client.iterRange("key_0010", False, "key_0020", True, 3)), keys[11:21])
+    client.dropConnections()
+
 @C.with_custom_setup( C.default_setup, C.basic_teardown )
 def test_range_entries ():
     C.range_entries_scenario( 1000 )
@@ -370,6 +739,60 @@ def test_replace():
     e = client.exists("xxx")
     assert_equals(e,False)
 
+@C.with_custom_setup( C.default_setup, C.basic_teardown)
+def test_pipeline():
+    client = C.get_client()
+    p = client.pipeline()
+    for i in xrange(100):
+        p.set("key_%03d" % i, "value_%03d" % i)
+    results = p.execute()
+    assert_equals(results, [None] * 100)
+    p.get("key_007")
+    p.get("no_such_key")
+    p.delete("key_008")
+    p.exists("key_008")
+    p.range("key_000", True, "key_003", False)
+    results = p.execute()
+    assert_equals(results[0], "value_007")
+    assert_true(isinstance(results[1], X.arakoon_client.ArakoonNotFound))
+    assert_equals(results[2:], [None, False, ["key_000", "key_001", "key_002"]])
+    assert_equals(client.get("key_099"), "value_099")
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown)
+def test_async_client():
+    client = AsyncArakoonClient(C.get_client()._config)
+    futures = [client.set("key_%03d" % i, "value_%03d" % i) for i in xrange(100)]
+    for f in futures:
+        assert_equals(f.result(), None)
+    futures = [client.get("key_%03d" % i) for i in xrange(100)]
+    for (i, f) in enumerate(futures):
+        assert_equals(f.result(), "value_%03d" % i)
+    e = client.get("no_such_key").exception()
+    assert_true(isinstance(e, X.arakoon_client.ArakoonNotFound))
+    client.dropConnections()
+
+@C.with_custom_setup( C.default_setup, C.basic_teardown)
+def test_shared_client_threads():
+    client = C.get_client()
+    failures = []
+    def worker(t):
+        try:
+            for i in xrange(100):
+                key = "key_%d_%03d" % (t, i)
+                client.set(key, key)
+                assert_equals(client.get(key), key)
+        except Exception, ex:
+            failures.append(ex)
+    threads = [threading.Thread(target = worker, args = (t,)) for t in xrange(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert_equals(failures, [])
+    assert_equals(len(client.prefix("key_", -1)), 800)
+    client.dropConnections()
+
 
 @C.with_custom_setup( C.setup_3_nodes_forced_master , C.basic_teardown )
 def test_who_master_fixed () :
@@ -385,6 +808,32 @@ def test_who_master () :
     assert_true ( node in C.node_names )
     client.dropConnections()
 
+@C.with_custom_setup( C.setup_3_nodes , C.basic_teardown )
+def test_who_master_slave_down () :
+    client = C.get_client()
+    master = client.whoMaster()
+    slave = [n for n in C.node_names[:3] if n != master][0]
+    C.stopOne(slave)
+    client._forgetMaster()
+    assert_equals ( client.whoMaster(), master )
+    client.set('key', 'value')
+    C.startOne(slave)
+    client.dropConnections()
+
+@C.with_custom_setup( C.setup_2_nodes_forced_master , C.basic_teardown )
+def test_who_master_2_nodes_slave_down () :
+    client = C.get_client()
+    master = client.whoMaster()
+    assert_equals ( master, C.node_names[0] )
+    C.stopOne(C.node_names[1])
+    # no majority is left to agree, the master says so itself
+    client._forgetMaster()
+    assert_equals ( client.whoMaster(), master )
+    client.set('key', 'value')
+    assert_equals ( client.get('key'), 'value' )
+    C.startOne(C.node_names[1])
+    client.dropConnections()
+
 @C.with_custom_setup(C.setup_3_nodes, C.basic_teardown)
 def test_nop():
     client = C.get_client()
@@ -23,7 +23,9 @@ Arakoon client module
 
 import sys
 import time
+import Queue
 import random
+import select
 import threading
 
 from ArakoonProtocol import *
@@ -32,6 +34,20 @@ from ArakoonExceptions import *
 from ArakoonClientConnection import *
 from ArakoonValidators import SignatureValidator
 from ArakoonProtocol import ArakoonClientConfig
+from ArakoonPipeline import ArakoonPipeline
+from ArakoonBulkLoader import ArakoonBulkLoader
+from ArakoonWriteBehind import ArakoonWriteBehind
+from ArakoonCodec import ArakoonValueCodec, ValueCodec, getCodec, HEADER_SIZE
+import ArakoonObjects
+from ArakoonChangeFeed import ArakoonChangeFeed
+from ArakoonUserHook import ArakoonHookStream
+from ArakoonSession import FallbackConsistency, SessionConsistency
+from ArakoonStaleness import ArakoonProgressTracker, BoundedStaleness
+import ArakoonDeadline
+from ArakoonCache import ArakoonReadCache, TlogFollower, MISSING, PRESENT
+from ArakoonBalancer import ArakoonReadBalancer
+from ArakoonCircuitBreaker import ArakoonCircuitBreaker
+from ArakoonMetrics import ArakoonMetrics
 
 from functools import wraps
 
@@ -55,40 +71,121 @@ def dump(src, length=8):
 random.seed ( time.time() )
 
 
+_RETRYABLE = (ArakoonNoMaster, ArakoonNodeNotMaster, ArakoonSocketException, ArakoonNotConnected, ArakoonGoingDown)
+
 def retryDuringMasterReelection (is_read_only = False):
     def wrap(f):
         @wraps(f)
         def retrying_f (self,*args,**kwargs):
-            start = time.time()
-            tryCount = 0.0
-            backoffPeriod = 0.2
-            callSucceeded = False
-            retryPeriod = ArakoonClientConfig.getNoMasterRetryPeriod ()
-            deadline = start + retryPeriod
-            while( not callSucceeded and time.time() < deadline ):
-                try :
-                    retVal = f(self,*args,**kwargs)
-                    callSucceeded = True
-                except (ArakoonNoMaster, ArakoonNodeNotMaster, ArakoonSocketException, ArakoonNotConnected, ArakoonGoingDown) as ex:
-                    if not is_read_only and \
-                       isinstance(ex, (ArakoonSocketException, ArakoonGoingDown)):
-                        raise
-                    if len( self._config.getNodes().keys()) == 0 :
-                        raise ArakoonInvalidConfig( "Empty client configuration" )
-                    self._masterId = None
-                    self.dropConnections()
-                    sleepPeriod = backoffPeriod * tryCount
-                    if time.time() + sleepPeriod > deadline :
-                        raise
-                    tryCount += 1.0
-                    ArakoonClientLogger.logWarning( "Master not found (%s). Retrying in %0.2f sec." % (ex, sleepPeriod) )
-                    time.sleep( sleepPeriod )
-            return retVal
+            if self._callTimeout and ArakoonDeadline.current() is None:
+                with ArakoonDeadline.deadline(self._callTimeout):
+                    return retrying_f(self,*args,**kwargs)
+            # the first attempt needs no bookkeeping, calls that succeed are the common case
+            try :
+                return f(self,*args,**kwargs)
+            except _RETRYABLE:
+                return _retry(f, is_read_only, sys.exc_info(), self, args, kwargs)
+            except ArakoonInconsistentRead:
+                consistency = self._consistency
+                if not is_read_only or not isinstance(consistency, FallbackConsistency):
+                    raise
+                # the node is further behind than the consistency allows, the master isn't
+                with consistency.onMaster():
+                    return retrying_f(self,*args,**kwargs)
 
         return retrying_f
     return wrap
 
-     
+def _retry(f, is_read_only, excInfo, self, args, kwargs):
+    start = time.time()
+    tryCount = 0.0
+    backoffPeriod = 0.2
+    retryPeriod = self._config.no_master_retry_period
+    deadline = start + retryPeriod
+    callDeadline = ArakoonDeadline.current()
+    while True:
+        ex = excInfo[1]
+        if not is_read_only and \
+           isinstance(ex, (ArakoonSocketException, ArakoonGoingDown)):
+            raise excInfo[0], excInfo[1], excInfo[2]
+        if len( self._config.getNodes().keys()) == 0 :
+            raise ArakoonInvalidConfig( "Empty client configuration" )
+        # a node that can't be reached is forgotten as master by _sendMessage,
+        # broken connections are closed by the pools
+        if isinstance(ex, (ArakoonNodeNotMaster, ArakoonGoingDown)):
+            self._forgetMaster()
+        sleepPeriod = backoffPeriod * tryCount
+        if time.time() + sleepPeriod > deadline :
+            raise excInfo[0], excInfo[1], excInfo[2]
+        if callDeadline is not None and time.time() + sleepPeriod >= callDeadline.at:
+            # fail now rather than after sleeping through the rest of the budget
+            raise callDeadline.expired( ex )
+        tryCount += 1.0
+        ArakoonClientLogger.logWarning( "Master not found (%s). Retrying in %0.2f sec." % (ex, sleepPeriod) )
+        self._metrics.countRetry()
+        time.sleep( sleepPeriod )
+        if time.time() >= deadline:
+            raise excInfo[0], excInfo[1], excInfo[2]
+        try :
+            return f(self,*args,**kwargs)
+        except _RETRYABLE:
+            excInfo = sys.exc_info()
+
+
+def _prefixUpperBound(prefix):
+    # smallest key that is larger than all keys starting with prefix
+    stripped = prefix.rstrip('\xff')
+    if stripped == '':
+        return None
+    return stripped[:-1] + chr(ord(stripped[-1]) + 1)
+
+class _PagePrefetch(threading.Thread):
+    def __init__(self, fetch, first):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._fetch = fetch
+        self._first = first
+        self._page = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._page = self._fetch(self._first, False)
+        except:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._page
+
+def _iterPages(query, first, firstIncluded, last, lastIncluded, pageSize, prefetch, keyOf):
+    if pageSize <= 0:
+        raise ArakoonInvalidArguments( "iterator", [("pageSize", pageSize)] )
+    def fetch(begin, beginIncluded):
+        return query(begin, beginIncluded, last, lastIncluded, pageSize)
+    return _generatePages(fetch, first, firstIncluded, pageSize, prefetch, keyOf)
+
+def _generatePages(fetch, first, firstIncluded, pageSize, prefetch, keyOf):
+    page = fetch(first, firstIncluded)
+    while len(page) > 0:
+        lastKey = keyOf(page[-1])
+        isLastPage = len(page) < pageSize
+        pending = None
+        if prefetch and not isLastPage:
+            pending = _PagePrefetch(fetch, lastKey)
+        for item in page:
+            yield item
+        if isLastPage:
+            break
+        if pending is not None:
+            page = pending.result()
+        else:
+            page = fetch(lastKey, False)
+
+
 class ArakoonClient :
 
     def __init__ (self, config=None):
@@ -107,21 +204,34 @@ class ArakoonClient :
             config = ArakoonClientConfig()
         self._initialize( config )
         self.__lock = threading.RLock()
+        self._discoveryLock = threading.Lock()
         self._masterId = None
-        self._connections = dict()
+        self._pools = dict()
+        self._metrics = ArakoonMetrics()
         self._consistency = Consistent()
+        self._readCache = None
+        self._tlogFollower = None
+        self._valueCodec = None
         nodeList = self._config.getNodes().keys()
         if len(nodeList) == 0:
             raise ArakoonInvalidConfig("Node list empty.")
-        self._dirtyReadNode = random.choice( nodeList )
+        self._dirtyReadNode = None
+        self._balancer = ArakoonReadBalancer( nodeList )
+        self._breaker = ArakoonCircuitBreaker( self._config )
+        self._hedging = None
+        self.hedgesIssued = 0
+        self.hedgesWon = 0
 
     def allowDirtyReads(self):
         """
         Allow the client to read values from a potential slave.
 
+        Unless a node is set with L{setDirtyReadNode}, the reads are spread
+        over all nodes, see L{ArakoonReadBalancer}.
+
         Enabling this can give back outdated values!
         """
-        self._consistency = NoGuarantee()
+        self._replaceConsistency( NoGuarantee() )
 
     def disallowDirtyReads(self):
         """
@@ -129,38 +239,431 @@ class ArakoonClient :
 
         Enabling dirty reads can give back outdated values!
         """
-        self._consistency = Consistent()
+        self._replaceConsistency( Consistent() )
 
     def setConsistency(self, c):
         """
         Either Consistent or NoGuarantees or AtLeast. Allows fine grained consistency constraints on subsequent reads
         @type c: Consistency
         """
+        self._replaceConsistency( c )
+
+    def _replaceConsistency(self, c):
+        previous = self._consistency
         self._consistency = c
+        if isinstance(previous, BoundedStaleness) and previous is not c:
+            previous.tracker.stop()
+
+    def enableReadYourWrites(self):
+        """
+        Read the writes of this client back from any node.
+
+        After a write, the next read asks the master for its txid. Reads are
+        then sent to any node with AtLeast that txid, and are done on the master
+        when the node is behind. Writes by other clients are only seen once
+        they are applied on the node that is read from.
+        This replaces the consistency set before, see L{SessionConsistency}.
+        """
+        self._replaceConsistency( SessionConsistency(self.get_txid) )
+
+    def disableReadYourWrites(self):
+        """
+        Go back to consistent reads
+        """
+        if isinstance(self._consistency, SessionConsistency):
+            self._replaceConsistency( Consistent() )
+
+    def getSessionStatistics(self):
+        """
+        @rtype: dict
+        @return: the statistics of the read-your-writes session, None if there is none
+        """
+        consistency = self._consistency
+        if isinstance(consistency, SessionConsistency):
+            return consistency.getStatistics()
+        return None
+
+    def enableBoundedStaleness(self, maxEntries = None, maxSeconds = None, probeInterval = None):
+        """
+        Read from the nodes that lag at most maxEntries entries, or maxSeconds seconds, behind.
+
+        With both, a node that is within either of them can be read from.
+
+        Background threads ask every node for the i it has applied, every
+        probeInterval seconds. Reads are spread over the nodes within the bound,
+        the master included, and are done on the master while the progress of
+        the nodes is unknown or when a node fell behind since it was probed.
+        This replaces the consistency set before, see L{BoundedStaleness}.
+
+        @type maxEntries: int
+        @type maxSeconds: float
+        @param probeInterval: defaults to L{ARA_CFG_STALENESS_PROBE_INTERVAL}
+        """
+        if (maxEntries is None and maxSeconds is None) or \
+           (maxEntries is not None and maxEntries < 0) or \
+           (maxSeconds is not None and maxSeconds < 0):
+            raise ArakoonInvalidArguments( "enableBoundedStaleness",
+                                           [("maxEntries", maxEntries), ("maxSeconds", maxSeconds)] )
+        tracker = ArakoonProgressTracker(self, probeInterval, maxSeconds or 0.0)
+        self._replaceConsistency( BoundedStaleness(tracker, maxEntries, maxSeconds) )
+        tracker.start()
+
+    def disableBoundedStaleness(self):
+        """
+        Go back to consistent reads, and stop probing the nodes
+        """
+        if isinstance(self._consistency, BoundedStaleness):
+            self._replaceConsistency( Consistent() )
+
+    def getStalenessStatistics(self):
+        """
+        @rtype: dict
+        @return: the progress of the nodes as last probed, and the number of reads
+        that were done on the master, None if bounded staleness is not enabled
+        """
+        consistency = self._consistency
+        if isinstance(consistency, BoundedStaleness):
+            return consistency.getStatistics()
+        return None
+
+    def deadline(self, timeout):
+        """
+        Bound the time the calls done within a with block take, all in all.
+
+        Connecting, sending, waiting for replies, retries and the discovery of
+        the master all count. A call that runs out of time raises ArakoonTimeout,
+        rather than waiting for the timeouts of the configuration. e.g. ::
+            with client.deadline(0.25):
+                value = client.get('key')
+
+        The deadline holds for the calls the current thread does, with any
+        client. Nested blocks keep the earlier deadline. See the call_timeout
+        of L{ArakoonClientConfig} for a deadline on every call of a client.
+
+        @type timeout: float
+        @param timeout: seconds
+        """
+        if timeout is None or timeout < 0:
+            raise ArakoonInvalidArguments( "deadline", [("timeout", timeout)] )
+        return ArakoonDeadline.deadline(timeout)
 
     def _initialize(self, config ):
         self._config = config
+        # resolved once here rather than on every call, see retryDuringMasterReelection
+        self._callTimeout = config.call_timeout
+
+    def enableReadCache(self, maxBytes, pollInterval = None):
+        """
+        Cache the results of get, exists and multiGet in this client.
+
+        A background thread follows the tlog of the master and drops the
+        cached keys that get updated. The cache has processed the tlog up to
+        some entry i, and only serves reads that are satisfied by AtLeast(i):
+        reads with the L{NoGuarantee} consistency, or with L{AtLeast} consistency
+        for an entry the cache has processed. L{Consistent} reads always go to
+        the master.
+
+        @type maxBytes: int
+        @param maxBytes: Memory bound for the cached keys and values
+        @type pollInterval: float
+        @param pollInterval: Seconds between polls of the tlog
+        """
+        if maxBytes <= 0:
+            raise ArakoonInvalidArguments( "enableReadCache", [("maxBytes", maxBytes)] )
+        self.disableReadCache()
+        cache = ArakoonReadCache(maxBytes)
+        self._tlogFollower = TlogFollower(self, cache, pollInterval)
+        self._readCache = cache
+        self._tlogFollower.start()
+
+    def disableReadCache(self):
+        """
+        Stop caching reads, and drop the cache
+        """
+        follower = self._tlogFollower
+        self._readCache = None
+        self._tlogFollower = None
+        if follower is not None:
+            follower.stop()
+
+    def setValueCodec(self, codec, minSize = None):
+        """
+        Compress the values this client writes, and decompress the values it reads.
+
+        Values of at least minSize bytes that shrink are stored compressed, behind
+        a header naming the codec. Other values are stored as they are, so values
+        written without a codec still read the same. Compression applies to set,
+        confirm, testAndSet, replace, aSSert, sequence and the bulk writes, values
+        are decompressed by the get, multiGet and range_entries reads.
+
+        The expected values of testAndSet and aSSert are compressed as well, so
+        they only match values written with the same codec and level.
+
+        @type codec: L{ValueCodec} or string
+        @param codec: e.g. ZlibCodec(level = 1), or the name of a registered
+        codec: 'zlib' or 'bz2'. None to stop compressing; values are no longer
+        decompressed either.
+        @type minSize: int
+        @param minSize: defaults to L{ARA_CFG_CODEC_MIN_SIZE}
+        """
+        if codec is None:
+            self._valueCodec = None
+            return
+        if isinstance(codec, str):
+            name = codec
+            codec = getCodec(name)
+            if codec is None:
+                raise ArakoonInvalidArguments( "setValueCodec", [("codec", name)] )
+        if not isinstance(codec, ValueCodec):
+            raise ArakoonInvalidArguments( "setValueCodec", [("codec", codec)] )
+        self._valueCodec = ArakoonValueCodec(codec, minSize)
+
+    def getValueCodec(self):
+        """
+        @rtype: L{ArakoonValueCodec}
+        @return: The value codec of this client, None if values are stored as they are
+        """
+        return self._valueCodec
+
+    def getReadCache(self):
+        """
+        @rtype: L{ArakoonReadCache}
+        @return: The read cache of this client, None if it is disabled
+        """
+        return self._readCache
+
+    def _readThroughCache(self, keys, encode, decode):
+        cache = self._readCache
+        token, consistency = cache.reserve(keys, self._consistency)
+        try:
+            try:
+                result = decode( self.__send__( encode( keys, consistency ) ) )
+            except ArakoonInconsistentRead:
+                if token is None:
+                    raise
+                # the node is behind the cache: read without filling it
+                for key in keys:
+                    cache.cancel(key, token)
+                token = None
+                result = decode( self.__send__( encode( keys, self._consistency ) ) )
+        except ArakoonNotFound:
+            cache.fill(keys[0], token, MISSING)
+            raise
+        except:
+            for key in keys:
+                cache.cancel(key, token)
+            raise
+        return token, result
+
+    def _afterWrite(self, update):
+        cache = self._readCache
+        if cache is not None:
+            cache.invalidate([update])
+        self._wrote()
+
+    def _wrote(self):
+        consistency = self._consistency
+        if isinstance(consistency, SessionConsistency):
+            consistency.wrote()
 
     def __send__(self,msg):
         if self._consistency.isDirty():
-            conn = self._sendMessage(self._dirtyReadNode, msg)
+            conn = self._sendDirty(msg)
         else:
             conn = self._sendToMaster (msg)
         return conn
 
+    def _sendDirty(self, msg, consistency = None, hedged = True):
+        nodeId = self._dirtyReadNode
+        if nodeId is not None:
+            return self._sendMessage(nodeId, msg)
+        among = None
+        if consistency is None:
+            consistency = self._consistency
+        if isinstance(consistency, BoundedStaleness):
+            among = consistency.eligibleNodes()
+            if among is not None and len(among) == 0:
+                return self._sendToMaster(msg)
+        breaker = self._breaker
+        if breaker is not None:
+            among = breaker.available(among)
+        request, conn = self._sendBalanced(msg, among = among)
+        hedging = self._hedging
+        if hedged and hedging is not None and len(among or self._balancer) > 1:
+            delay = self._balancer.getLatencyPercentile( hedging[0] )
+            if delay is not None:
+                conn = self._hedge(msg, request, conn, max(delay, hedging[1]), among)
+        return conn
+
+    def _sendBalanced(self, msg, exclude = None, among = None):
+        request = self._balancer.begin(exclude = exclude, among = among)
+        try:
+            conn = self._sendMessage(request.nodeId, msg)
+        except:
+            # the node is skipped for a while, a retry goes elsewhere
+            request.finish(True)
+            raise
+        conn._onRelease = request.released
+        return request, conn
+
+    def _hedge(self, msg, request, conn, delay, among = None):
+        if conn.hasReplyData() or len( select.select([conn], [], [], delay)[0] ) > 0:
+            return conn
+        try:
+            hedgeRequest, hedge = self._sendBalanced(msg, exclude = request.nodeId, among = among)
+        except Exception, ex:
+            ArakoonClientLogger.logDebug( "Could not send hedged request (%s: '%s')" % (ex.__class__.__name__, ex) )
+            return conn
+        with self.__lock:
+            self.hedgesIssued += 1
+        try:
+            timeout = ArakoonDeadline.remaining( self._config.connection_timeout )
+        except ArakoonTimeout:
+            for c in (conn, hedge):
+                c.abandon()
+                c.release()
+            raise
+        readable = select.select( [conn, hedge], [], [], timeout )[0]
+        if len(readable) == 0:
+            # neither node answered, waiting on conn would take another timeout
+            deadline = ArakoonDeadline.current()
+            expired = deadline is not None and deadline.remaining() <= 0
+            for (c, r) in ((conn, request), (hedge, hedgeRequest)):
+                if expired:
+                    r.cancel()
+                    c.abandon()
+                else:
+                    c.close()
+                c.release()
+            if expired:
+                raise deadline.expired()
+            raise ArakoonSockNotReadable(msg = "No reply from %s nor %s" %
+                                               (request.nodeId, hedgeRequest.nodeId))
+        if hedge in readable and conn not in readable:
+            with self.__lock:
+                self.hedgesWon += 1
+            winner, loser, loserRequest = hedge, conn, request
+        else:
+            winner, loser, loserRequest = conn, hedge, hedgeRequest
+        # the loser was slow, not broken; its reply is still under way so the
+        # connection can't be reused, and its latency is unknown
+        loserRequest.cancel()
+        loser.abandon()
+        loser.release()
+        return winner
+
+    def enableHedgedReads(self, percentile = 95.0, minDelay = 0.0):
+        """
+        Send a dirty read to a second node when the first one is slow to answer.
+
+        When no reply arrived after the given percentile of the recent latencies
+        of the dirty reads, the request is sent to another node as well. The first
+        reply is taken, the connection of the other one is closed. Only applies to
+        dirty reads that are spread over the nodes, see L{allowDirtyReads}.
+        The hedges issued and won are counted in hedgesIssued and hedgesWon.
+
+        @type percentile: float
+        @param percentile: percentile of the latency after which a read is hedged, between 0 and 100
+        @type minDelay: float
+        @param minDelay: seconds to wait at least before a read is hedged
+        """
+        if not 0 < percentile <= 100:
+            raise ArakoonInvalidArguments( "enableHedgedReads", [("percentile", percentile)] )
+        if minDelay < 0:
+            raise ArakoonInvalidArguments( "enableHedgedReads", [("minDelay", minDelay)] )
+        self._hedging = (percentile, minDelay)
+
+    def disableHedgedReads(self):
+        """
+        Stop hedging dirty reads
+        """
+        self._hedging = None
+
+    def getHedgeStatistics(self):
+        """
+        @rtype: dict
+        @return: the number of hedged requests issued, and how many of them answered first
+        """
+        with self.__lock:
+            return { 'issued' : self.hedgesIssued,
+                     'won' : self.hedgesWon }
+
+    def enableCircuitBreaker(self, failureThreshold = None, probeInterval = None):
+        """
+        Skip the nodes that failed failureThreshold times in a row, until they can be reached again.
+
+        Requests to a skipped node fail with L{ArakoonNodeUnavailable} without any
+        I/O, the discovery of the master doesn't ask it and dirty reads go to the
+        other nodes. A background thread tries to reach it every probeInterval
+        seconds. This is enabled by default, see L{ArakoonCircuitBreaker}.
+
+        @type failureThreshold: int
+        @param failureThreshold: defaults to L{ARA_CFG_BREAKER_FAILURE_THRESHOLD}
+        @type probeInterval: float
+        @param probeInterval: defaults to L{ARA_CFG_BREAKER_PROBE_INTERVAL}
+        """
+        if failureThreshold is not None and failureThreshold < 1:
+            raise ArakoonInvalidArguments( "enableCircuitBreaker", [("failureThreshold", failureThreshold)] )
+        if probeInterval is not None and probeInterval <= 0:
+            raise ArakoonInvalidArguments( "enableCircuitBreaker", [("probeInterval", probeInterval)] )
+        self._replaceBreaker( ArakoonCircuitBreaker( self._config, failureThreshold, probeInterval ) )
+
+    def disableCircuitBreaker(self):
+        """
+        Send requests to every node, whether it failed before or not
+        """
+        self._replaceBreaker( None )
+
+    def _replaceBreaker(self, breaker):
+        previous = self._breaker
+        self._breaker = breaker
+        if previous is not None:
+            previous.stop()
+
+    def getNodeHealth(self):
+        """
+        @rtype: dict
+        @return: for every node the state of its circuit breaker, see
+        L{ArakoonCircuitBreaker.getStatistics}, None if it is disabled
+        """
+        breaker = self._breaker
+        if breaker is None:
+            return None
+        return breaker.getStatistics()
+
     @utils.update_argspec('self', 'node')
     def setDirtyReadNode(self, node):
         """
         Set the node that will be used for dirty read operations
 
         @type node : string
-        @param node : the node identifier
+        @param node : the node identifier, None to spread the dirty reads over all nodes again
         @rtype: void
         """
-        if node not in self._config.getNodes().keys():
+        if node is not None and node not in self._config.getNodes().keys():
             raise ArakoonUnknownNode( node )
         self._dirtyReadNode = node
 
+    def getMetrics(self):
+        """
+        Retrieve the instrumentation of this client.
+
+        It holds a latency histogram per command, the bytes sent and received, and
+        counters of retries, master discoveries and reconnects. e.g. ::
+            snapshot = client.getMetrics().snapshot()
+            print snapshot['latency'][ARA_CMD_GET].summary()
+
+        @rtype: L{ArakoonMetrics}
+        """
+        return self._metrics
+
+    def getReadBalancer(self):
+        """
+        @rtype: L{ArakoonReadBalancer}
+        @return: The balancer that spreads the dirty reads over the nodes
+        """
+        return self._balancer
+
     @utils.update_argspec('self')
     @retryDuringMasterReelection(is_read_only=True)
     def getKeyCount (self) :
@@ -178,7 +681,7 @@ class ArakoonClient :
         Retrieve the node that will be used for dirty read operations
 
         @rtype: string
-        @return : the node identifier
+        @return : the node identifier, None if the dirty reads are spread over all nodes
         """
         return self._dirtyReadNode
 
@@ -248,14 +751,24 @@ class ArakoonClient :
         @param key : key
         @return : True if there is a value for that key, False otherwise
         """
+        cache = self._readCache
+        if cache is not None and self._consistency.isDirty():
+            entry = cache.lookup(key, self._consistency, valueNeeded = False)
+            if entry is not None:
+                return entry is not MISSING
+            token, result = self._readThroughCache([key],
+                lambda keys, c: ArakoonProtocol.encodeExists(keys[0], c),
+                lambda conn: conn.decodeBoolResult())
+            cache.fill(key, token, result and PRESENT or MISSING)
+            return result
         msg = ArakoonProtocol.encodeExists(key, self._consistency)
         conn = self.__send__(msg)
         return conn.decodeBoolResult()
 
-    @utils.update_argspec('self', 'key')
+    @utils.update_argspec('self', 'key', ('as_memoryview', False))
     @retryDuringMasterReelection(is_read_only=True)
-    @SignatureValidator( 'string' )
-    def get(self, key):
+    @SignatureValidator( 'string', 'bool' )
+    def get(self, key, as_memoryview = False):
         """
         Retrieve a single value from the store.
 
@@ -263,14 +776,72 @@ class ArakoonClient :
 
         @type key: string
         @param key: The key whose value you are interested in
+        @type as_memoryview: bool
+        @param as_memoryview: Receive the value straight into a new bytearray and
+        return a memoryview on it, instead of copying it into a string
         @rtype: string
         @return: The value associated with the given key
         """
+        cache = self._readCache
+        if cache is not None and self._consistency.isDirty() and not as_memoryview:
+            entry = cache.lookup(key, self._consistency)
+            if entry is MISSING:
+                raise ArakoonNotFound(key)
+            if entry is None:
+                token, entry = self._readThroughCache([key],
+                    lambda keys, c: ArakoonProtocol.encodeGet(keys[0], c),
+                    lambda conn: conn.decodeStringResult())
+                cache.fill(key, token, entry)
+            return self._decodeValue(entry)
         msg = ArakoonProtocol.encodeGet(key, self._consistency)
         conn = self.__send__(msg)
+        codec = self._valueCodec
+        if as_memoryview:
+            result = conn.decodeStringIntoResult(None)
+            if codec is not None and codec.isEncoded( result[:HEADER_SIZE].tobytes() ):
+                result = memoryview( bytearray( codec.decode( result.tobytes() ) ) )
+            return result
         result = conn.decodeStringResult()
+        if codec is not None:
+            result = codec.decode(result)
         return result
 
+    def _decodeValue(self, value):
+        codec = self._valueCodec
+        if codec is None:
+            return value
+        return codec.decode(value)
+
+    @utils.update_argspec('self', 'key', 'buffer')
+    @retryDuringMasterReelection(is_read_only=True)
+    @SignatureValidator( 'string', 'buffer' )
+    def getInto(self, key, buffer):
+        """
+        Retrieve a single value from the store into a buffer supplied by the caller.
+
+        The value is received from the socket straight into the buffer, so large
+        values don't get copied around. If the buffer is too small,
+        ArakoonBufferTooSmall is raised; its size attribute holds the size needed.
+
+        @type key: string
+        @param key: The key whose value you are interested in
+        @type buffer: bytearray or writable memoryview
+        @param buffer: The buffer to receive the value in, starting at its first byte
+        @rtype: int
+        @return: The size of the value
+        """
+        msg = ArakoonProtocol.encodeGet(key, self._consistency)
+        conn = self.__send__(msg)
+        codec = self._valueCodec
+        if codec is None:
+            return len(conn.decodeStringIntoResult(buffer))
+        # a compressed value has to be decompressed before it goes into the buffer
+        value = codec.decode( conn.decodeStringResult() )
+        if len(value) > len(buffer):
+            raise ArakoonBufferTooSmall( len(value), len(buffer) )
+        buffer[:len(value)] = value
+        return len(value)
+
     @utils.update_argspec('self', 'keys')
     @retryDuringMasterReelection(is_read_only=True)
     def multiGet(self,keys):
@@ -281,11 +852,36 @@ class ArakoonClient :
         @rtype: string list
         @return: the values associated with the respective keys
         """
+        if self._readCache is not None and self._consistency.isDirty():
+            return self._cachedMultiGet(keys)
         msg = ArakoonProtocol.encodeMultiGet(keys, self._consistency)
         conn = self.__send__(msg)
         result = conn.decodeStringListResult()
+        if self._valueCodec is not None:
+            result = self._valueCodec.decodeList(result)
         return result
 
+    def _cachedMultiGet(self, keys):
+        cache = self._readCache
+        values = [ cache.lookup(key, self._consistency) for key in keys ]
+        missed = [ key for (key, value) in zip(keys, values) if value is None ]
+        if len(missed) > 0:
+            # multiGetOption, so the keys without a value can be cached as well
+            token, fetched = self._readThroughCache(missed,
+                ArakoonProtocol.encodeMultiGetOption,
+                lambda conn: conn.decodeStringOptionArrayResult())
+            fetched = dict( zip(missed, fetched) )
+            for key in missed:
+                value = fetched[key]
+                cache.fill(key, token, value is None and MISSING or value)
+            values = [ fetched[key] if value is None else value for (key, value) in zip(keys, values) ]
+        for (key, value) in zip(keys, values):
+            if value is None or value is MISSING:
+                raise ArakoonNotFound(key)
+        if self._valueCodec is not None:
+            values = self._valueCodec.decodeList(values)
+        return values
+
     @utils.update_argspec('self','keys')
     @retryDuringMasterReelection(is_read_only=True)
     def multiGetOption(self,keys):
@@ -301,6 +897,8 @@ class ArakoonClient :
         msg = ArakoonProtocol.encodeMultiGetOption(keys, self._consistency)
         conn = self.__send__(msg)
         result = conn.decodeStringOptionArrayResult()
+        if self._valueCodec is not None:
+            result = self._valueCodec.decodeList(result)
         return result
 
     @utils.update_argspec('self', 'key', 'value')
@@ -321,8 +919,11 @@ class ArakoonClient :
 
         @rtype: void
         """
+        if self._valueCodec is not None:
+            value = self._valueCodec.encode(value)
         conn = self._sendToMaster ( ArakoonProtocol.encodeSet( key, value ) )
         conn.decodeVoidResult()
+        self._afterWrite( Delete(key) )
 
     @retryDuringMasterReelection()
     def nop(self):
@@ -350,9 +951,12 @@ class ArakoonClient :
         otherwise, behave as set(key,value)
         @rtype: void
         """
+        if self._valueCodec is not None:
+            value = self._valueCodec.encode(value)
         msg = ArakoonProtocol.encodeConfirm(key,value)
         conn = self._sendToMaster(msg)
         conn.decodeVoidResult()
+        self._afterWrite( Delete(key) )
 
     @utils.update_argspec('self', 'key', 'vo')
     @retryDuringMasterReelection(is_read_only=True)
@@ -366,6 +970,8 @@ class ArakoonClient :
         @param vo: what the value should be (can be None)
         @rtype: void
         """
+        if self._valueCodec is not None:
+            vo = self._valueCodec.encode(vo)
         msg = ArakoonProtocol.encodeAssert(key, vo, self._consistency)
         conn = self.__send__(msg)
         result = conn.decodeVoidResult()
@@ -398,16 +1004,188 @@ class ArakoonClient :
         It's all-or-nothing: either all updates succeed, or they all fail.
         @type seq: Sequence
         """
-        encoded = ArakoonProtocol.encodeSequence(seq, sync)
+        if self._valueCodec is not None:
+            encoded = ArakoonProtocol.encodeSequence(self._valueCodec.encodeUpdate(seq), sync)
+        else:
+            encoded = ArakoonProtocol.encodeSequence(seq, sync)
         conn = self._sendToMaster(encoded)
         conn.decodeVoidResult()
+        self._afterWrite( seq )
 
-    def makeSequence(self):
+    def makeSequence(self, compact = False):
         """
         Factory method for sequences
+
+        @type compact: bool
+        @param compact: make a L{CompactSequence}, which encodes its updates as
+        they are added. Use it for sequences of many updates.
         """
+        if compact:
+            return CompactSequence()
         return Sequence()
 
+    def bulkWrite(self, updates, allowSplit = False, sync = False, maxBytes = None):
+        """
+        Perform a large batch of updates, as a single sequence or split over several.
+
+        The updates are encoded as they are taken from the iterable. If they
+        don't fit in a sequence of maxBytes, ArakoonSequenceTooLarge is raised
+        before anything is sent, unless allowSplit is set.
+
+        With allowSplit, the updates are sent in order as consecutive sequences of
+        at most maxBytes. Each of them is all-or-nothing, the batch as a whole is
+        not: when one fails, ArakoonPartialWrite is raised. Its performed attribute
+        holds the number of updates in the sequences that succeeded before.
+
+        @type updates: iterable of L{Update}
+        @param updates: e.g. L{Set} and L{Delete} objects
+        @type allowSplit: bool
+        @param allowSplit: give up the atomicity of the batch if it is too large for one sequence
+        @type sync: bool
+        @param sync: sync the filesystem on the server after every sequence
+        @type maxBytes: int
+        @param maxBytes: the size of a sequence, defaults to L{ArakoonClientConfig.getMaxSequenceSize}
+        @rtype: int
+        @return: the number of sequences sent
+        """
+        if maxBytes is None:
+            maxBytes = ArakoonClientConfig.getMaxSequenceSize()
+        seq = CompactSequence()
+        sent = 0
+        performed = 0
+        for u in updates:
+            mark = seq._mark()
+            seq.addUpdate(u)
+            if seq.size() <= maxBytes:
+                continue
+            if not allowSplit or len(seq) == 1:
+                raise ArakoonSequenceTooLarge( seq.size(), maxBytes )
+            seq._rollback(mark)
+            self._sendPart(seq, sync, performed)
+            sent += 1
+            performed += len(seq)
+            seq = CompactSequence()
+            seq.addUpdate(u)
+            if seq.size() > maxBytes:
+                raise ArakoonPartialWrite( performed, ArakoonSequenceTooLarge( seq.size(), maxBytes ) )
+        if len(seq) > 0:
+            if sent == 0:
+                self.sequence(seq, sync)
+            else:
+                self._sendPart(seq, sync, performed)
+            sent += 1
+        return sent
+
+    def _sendPart(self, seq, sync, performed):
+        try:
+            self.sequence(seq, sync)
+        except ArakoonException, ex:
+            raise ArakoonPartialWrite( performed, ex )
+
+    def pipeline(self):
+        """
+        Factory method for pipelines
+
+        A pipeline queues requests and sends them to the master in one go,
+        so a batch of N requests costs a single round trip instead of N.
+        See L{ArakoonPipeline} for details.
+
+        @rtype: L{ArakoonPipeline}
+        """
+        return ArakoonPipeline(self)
+
+    def bulkLoader(self, connections = None, depth = None, sync = False, targetLatency = None):
+        """
+        Factory method for bulk loaders
+
+        A bulk loader sets a large number of (key, value) pairs in sequences that
+        it keeps in flight on several connections to the master, adapting their
+        size to the commit latency. See L{ArakoonBulkLoader} for details.
+
+        @rtype: L{ArakoonBulkLoader}
+        """
+        return ArakoonBulkLoader(self, connections, depth, sync, targetLatency)
+
+    def writeBehind(self, maxKeys = None, maxDelay = None, sync = False):
+        """
+        Factory method for write-behind buffers
+
+        A write-behind buffer keeps the last set or delete of every key and
+        performs them as a single sequence when it is full, after maxDelay
+        seconds, or when it is flushed. See L{ArakoonWriteBehind} for details.
+
+        @rtype: L{ArakoonWriteBehind}
+        """
+        return ArakoonWriteBehind(self, maxKeys, maxDelay, sync)
+
+    def changeFeed(self, start = None, checkpointKey = None, pollInterval = None, ackBatch = None):
+        """
+        Factory method for change feeds
+
+        A change feed yields the updates committed to the cluster, as the master
+        streams them from its tlog, and resumes where it was after reconnects.
+        See L{ArakoonChangeFeed} for details.
+
+        @rtype: L{ArakoonChangeFeed}
+        """
+        return ArakoonChangeFeed(self, start, checkpointKey, pollInterval, ackBatch)
+
+    @SignatureValidator( 'string' )
+    def putObject(self, name, data, chunkSize = None):
+        """
+        Store a large object, split in chunks under a manifest.
+
+        Every chunk is set by a sequence of its own, several of them in flight
+        on different connections, so no single tlog entry holds the object.
+        The manifest is set under name when all chunks are stored: the object
+        is replaced atomically, and the chunks of the former one are removed.
+
+        @type name: string
+        @type data: string or file-like object
+        @param data: the object, or a file it is read from chunk by chunk
+        @type chunkSize: int
+        @param chunkSize: defaults to L{ARA_CFG_OBJECT_CHUNK_SIZE}
+        @rtype: int
+        @return: the size of the object
+        """
+        return ArakoonObjects.putObject(self, name, data, chunkSize)
+
+    @SignatureValidator( 'string' )
+    def openObject(self, name, threads = None):
+        """
+        Open a large object stored by L{putObject} for reading.
+
+        ArakoonInvalidObject is raised if the value of name is not a manifest.
+
+        @type name: string
+        @type threads: int
+        @param threads: chunks fetched concurrently, defaults to L{ARA_CFG_OBJECT_FETCH_THREADS}
+        @rtype: L{ArakoonObjectReader}
+        @return: a file-like reader, that fetches the chunks ahead of the reads
+        """
+        manifest = ArakoonObjects.ObjectManifest.decode( name, self.get(name) )
+        return ArakoonObjects.ArakoonObjectReader(self, manifest, threads)
+
+    @SignatureValidator( 'string' )
+    def getObject(self, name, threads = None):
+        """
+        Retrieve a large object stored by L{putObject}, see L{openObject}
+
+        @rtype: string
+        """
+        reader = self.openObject(name, threads)
+        try:
+            return reader.read()
+        finally:
+            reader.close()
+
+    @SignatureValidator( 'string' )
+    def deleteObject(self, name):
+        """
+        Remove a large object stored by L{putObject}, and its chunks
+        """
+        ArakoonObjects.deleteObject(self, name)
+
     @utils.update_argspec('self', 'key')
     @retryDuringMasterReelection()
     @SignatureValidator( 'string' )
@@ -422,6 +1200,7 @@ class ArakoonClient :
         """
         conn = self._sendToMaster ( ArakoonProtocol.encodeDelete( key ) )
         conn.decodeVoidResult()
+        self._afterWrite( Delete(key) )
 
     @utils.update_argspec('self','prefix')
     @retryDuringMasterReelection()
@@ -437,6 +1216,7 @@ class ArakoonClient :
         msg = ArakoonProtocol.encodeDeletePrefix(prefix)
         conn = self._sendToMaster(msg)
         result = conn.decodeIntResult()
+        self._afterWrite( DeletePrefix(prefix) )
         return result
 
     __setitem__= set
@@ -514,6 +1294,8 @@ class ArakoonClient :
                                                  self._consistency)
         conn = self.__send__(msg)
         result = conn.decodeStringPairListResult()
+        if self._valueCodec is not None:
+            result = self._valueCodec.decodePairs(result)
         return result
 
     @utils.update_argspec('self', 'beginKey', 'beginKeyIncluded', 'endKey',
@@ -544,6 +1326,8 @@ class ArakoonClient :
                                                         self._consistency)
         conn = self.__send__(msg)
         result = conn.decodeStringPairListResult()
+        if self._valueCodec is not None:
+            result = self._valueCodec.decodePairs(result)
         return result
 
 
@@ -569,9 +1353,80 @@ class ArakoonClient :
         conn = self.__send__(msg)
         return conn.decodeStringListResult( )
 
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int', 'bool' )
+    def iterRange(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                  pageSize = 1000, prefetch = False):
+        """
+        Iterate over the keys that lexographically fall between the beginKey and the endKey
+
+        Same as L{range}, but without a limit on the number of keys: they are fetched
+        pageSize at a time, every next page continuing right after the last key of the
+        previous one. Every page is a separate query, so the result is not a snapshot.
+
+        @type pageSize: integer
+        @param pageSize: The number of keys fetched per request
+        @type prefetch: boolean
+        @param prefetch: Fetch the next page in the background while the current one is consumed
+        @rtype: iterator of strings
+        """
+        return _iterPages(self.range, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                          pageSize, prefetch, lambda k: k)
+
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int', 'bool' )
+    def iterRangeEntries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                         pageSize = 1000, prefetch = False):
+        """
+        Iterate over the key-value pairs whose keys lexographically fall between the beginKey and the endKey
+
+        Same as L{range_entries}, but the pairs are fetched pageSize at a time.
+        See L{iterRange}.
+
+        @type pageSize: integer
+        @param pageSize: The number of key-value pairs fetched per request
+        @type prefetch: boolean
+        @param prefetch: Fetch the next page in the background while the current one is consumed
+        @rtype: iterator of (string,string)
+        """
+        return _iterPages(self.range_entries, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                          pageSize, prefetch, lambda kv: kv[0])
+
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int', 'bool' )
+    def iterRevRangeEntries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                            pageSize = 1000, prefetch = False):
+        """
+        Iterate in reverse order over the key-value pairs between the beginKey (high) and the endKey (low)
+
+        Same as L{rev_range_entries}, but the pairs are fetched pageSize at a time.
+        See L{iterRange}.
+
+        @type pageSize: integer
+        @param pageSize: The number of key-value pairs fetched per request
+        @type prefetch: boolean
+        @param prefetch: Fetch the next page in the background while the current one is consumed
+        @rtype: iterator of (string,string)
+        """
+        return _iterPages(self.rev_range_entries, beginKey, beginKeyIncluded, endKey, endKeyIncluded,
+                          pageSize, prefetch, lambda kv: kv[0])
+
+    @SignatureValidator( 'string', 'int', 'bool' )
+    def iterPrefix(self, keyPrefix, pageSize = 1000, prefetch = False):
+        """
+        Iterate over the keys that match with the provided prefix
+
+        Same as L{prefix}, but the keys are fetched pageSize at a time.
+        See L{iterRange}.
+
+        @type pageSize: integer
+        @param pageSize: The number of keys fetched per request
+        @type prefetch: boolean
+        @param prefetch: Fetch the next page in the background while the current one is consumed
+        @rtype: iterator of strings
+        """
+        return self.iterRange(keyPrefix, True, _prefixUpperBound(keyPrefix), False,
+                              pageSize, prefetch)
+
     def whoMaster(self):
-        self._determineMaster()
-        return self._masterId
+        return self._determineMaster()
 
     def expectProgressPossible(self):
         """
@@ -614,9 +1469,17 @@ class ArakoonClient :
         @rtype: string
         @return: The value that was associated with the key prior to this operation
         """
+        codec = self._valueCodec
+        if codec is not None:
+            oldValue = codec.encode(oldValue)
+            newValue = codec.encode(newValue)
         msg = ArakoonProtocol.encodeTestAndSet( key, oldValue, newValue )
         conn = self._sendToMaster( msg )
-        return conn.decodeStringOptionResult()
+        result = conn.decodeStringOptionResult()
+        self._afterWrite( Delete(key) )
+        if codec is not None:
+            result = codec.decode(result)
+        return result
 
     @utils.update_argspec('self','key','wanted')
     @retryDuringMasterReelection()
@@ -631,9 +1494,16 @@ class ArakoonClient :
         @rtype: string option
         @return: the previous binding (if any)
         """
+        codec = self._valueCodec
+        if codec is not None:
+            wanted = codec.encode(wanted)
         msg = ArakoonProtocol.encodeReplace(key,wanted)
         conn = self._sendToMaster( msg )
-        return conn.decodeStringOptionResult()
+        result = conn.decodeStringOptionResult()
+        self._afterWrite( Delete(key) )
+        if codec is not None:
+            result = codec.decode(result)
+        return result
 
     @utils.update_argspec('self', 'name', 'argument')
     @retryDuringMasterReelection()
@@ -651,7 +1521,38 @@ class ArakoonClient :
 
         msg = ArakoonProtocol.encodeUserFunction(name, argument)
         conn = self._sendToMaster(msg)
-        return conn.decodeStringOptionResult()
+        result = conn.decodeStringOptionResult()
+        self._afterWrite( UserFunction(name, argument) )
+        return result
+
+    @SignatureValidator( 'string' )
+    def userHook(self, name, consistency = None):
+        """
+        Start a user hook on a node, and return the stream to it.
+
+        User hooks are registered in the HookRegistry of the nodes. Unlike
+        user functions they don't go through consensus: a hook reads the
+        store of the node, and streams back whatever it wants over the
+        connection, so scans and aggregates can be done where the data is.
+        See L{ArakoonHookStream} for how to read what the hook sends.
+
+        @type name: string
+        @type consistency: L{Consistency}
+        @param consistency: picks the node the hook runs on, like it does for reads.
+        Defaults to the consistency of the client.
+        @rtype: L{ArakoonHookStream}
+        """
+        if consistency is None:
+            consistency = self._consistency
+        if not isinstance(consistency, Consistency):
+            raise ArakoonInvalidArguments( "userHook", [("consistency", consistency)] )
+        msg = ArakoonProtocol.encodeUserHook(name, consistency)
+        if consistency.isDirty():
+            # the reply is a stream, there is no single reply to hedge
+            conn = self._sendDirty(msg, consistency, hedged = False)
+        else:
+            conn = self._sendToMaster(msg)
+        return ArakoonHookStream(name, conn)
 
     @utils.update_argspec('self')
     @retryDuringMasterReelection(is_read_only=True)
@@ -662,67 +1563,123 @@ class ArakoonClient :
 
     def dropConnections(self):
         '''Drop all connections to the Arakoon servers'''
-        keysToRemove = self._connections.keys()
-
-        for key in keysToRemove:
-            self._connections[key].close()
-            del self._connections[ key ]
+        with self.__lock :
+            pools = self._pools.values()
+        for pool in pools:
+            pool.close()
 
     def _determineMaster(self):
-        nodeIds = []
-
-        if self._masterId is None:
-            # Prepare to ask random nodes who is master
-            nodeIds = self._config.getNodes().keys()
-            random.shuffle( nodeIds )
-
-            while self._masterId is None and len(nodeIds) > 0 :
-                node = nodeIds.pop()
-                try :
-                    self._masterId = self._getMasterIdFromNode( node )
-                    tmpMaster = self._masterId
-
-                    try :
-                        if self._masterId is not None :
-                            if self._masterId != node and not self._validateMasterId ( self._masterId ) :
-                                self._masterId = None
-                        else :
-                            ArakoonClientLogger.logWarning( "Node '%s' does not know who the master is", node )
+        masterId = self._masterId
+        if masterId is None:
+            ArakoonDeadline.acquire( self._discoveryLock )
+            try:
+                # another thread may have found the master in the meantime
+                masterId = self._masterId
+                if masterId is None:
+                    masterId = self._discoverMaster()
+                    self._masterId = masterId
+            finally:
+                self._discoveryLock.release()
 
-                    except Exception, ex :
+        if masterId is None:
+            ArakoonClientLogger.logError( "Could not determine master."  )
+            raise ArakoonNoMaster()
+        return masterId
 
-                        ArakoonClientLogger.logWarning( "Could not validate master on node '%s'", tmpMaster )
-                        ArakoonClientLogger.logDebug( "%s: %s" % (ex.__class__.__name__, ex))
-                        self._masterId = None
+    def _discoverMaster(self):
+        """
+        Ask all nodes who is master at the same time.
+
+        The first master a majority of the nodes agrees on is taken, so
+        nodes that are down or slow to answer don't hold up the discovery.
+        When a majority can no longer agree, e.g. because half of the nodes
+        are down, a node that says it is master itself is taken, as is a
+        master named by the others that confirms it is master.
+        """
+        self._metrics.countMasterDiscovery()
+        nodeIds = self._config.getNodes().keys()
+        quorum = len(nodeIds) / 2 + 1
+        answers = Queue.Queue()
+        reachable = nodeIds
+        if self._breaker is not None:
+            # doesn't take the turn of the trial of a half-open node, the probe does
+            reachable = self._breaker.available( nodeIds )
+        for nodeId in nodeIds:
+            if nodeId not in reachable:
+                # a node that is skipped counts as one that doesn't know the master
+                answers.put( (nodeId, None) )
+                continue
+            probe = threading.Thread( target = self._probeMaster, args = (nodeId, answers) )
+            probe.daemon = True
+            probe.start()
+
+        votes = dict()
+        named = []
+        validated = set()
+        for pending in xrange( len(nodeIds) - 1, -1, -1 ):
+            try:
+                (nodeId, masterId) = answers.get( True, ArakoonDeadline.remaining( None ) )
+            except Queue.Empty:
+                raise ArakoonDeadline.current().expired()
+            if masterId is not None:
+                votes[masterId] = votes.get(masterId, 0) + 1
+                if votes[masterId] >= quorum:
+                    return masterId
+                named.append( (nodeId, masterId) )
+            if max( votes.values() + [0] ) + pending < quorum:
+                while len(named) > 0:
+                    (nodeId, masterId) = named.pop(0)
+                    if masterId == nodeId:
+                        return masterId
+                    if masterId not in validated:
+                        validated.add( masterId )
+                        if self._validateMasterId( masterId ):
+                            return masterId
+        return None
 
+    def _validateMasterId(self, masterId):
+        try :
+            return self._getMasterIdFromNode( masterId ) == masterId
+        except ArakoonTimeout:
+            raise
+        except Exception, ex :
+            ArakoonClientLogger.logWarning( "Could not validate master on node '%s'", masterId )
+            ArakoonClientLogger.logDebug( "%s: %s" % (ex.__class__.__name__, ex))
+            return False
 
-                except Exception, ex :
-                    # Exceptions will occur when nodes are down, simply ignore and try the next node
-                    ArakoonClientLogger.logWarning( "Could not query node '%s' to see who is master", node )
-                    ArakoonClientLogger.logDebug( "%s: %s" % (ex.__class__.__name__, ex))
+    def _probeMaster(self, nodeId, answers):
+        masterId = None
+        try :
+            masterId = self._getMasterIdFromNode( nodeId )
+            if masterId is None :
+                ArakoonClientLogger.logWarning( "Node '%s' does not know who the master is", nodeId )
+        except Exception, ex :
+            # Exceptions will occur when nodes are down, the other nodes can still answer
+            ArakoonClientLogger.logWarning( "Could not query node '%s' to see who is master", nodeId )
+            ArakoonClientLogger.logDebug( "%s: %s" % (ex.__class__.__name__, ex))
+        answers.put( (nodeId, masterId) )
 
+    def _forgetMaster(self, nodeId = None):
+        """
+        Drop the cached master, so it is rediscovered by the next request that needs it.
 
-        if self._masterId is None:
-            ArakoonClientLogger.logError( "Could not determine master."  )
-            raise ArakoonNoMaster()
+        If nodeId is given, the cached master is only dropped if it is that node,
+        so a late failure on a former master doesn't drop a master found since.
+        """
+        with self.__lock:
+            if nodeId is None or self._masterId == nodeId:
+                self._masterId = None
 
-    def _sendToMaster(self, msg):
+    def _sendToMaster(self, msg, pipelined = False):
 
-        self._determineMaster()
+        masterId = self._determineMaster()
 
-        retVal = self._sendMessage(self._masterId, msg )
+        retVal = self._sendMessage(masterId, msg, pipelined = pipelined )
 
         if retVal is None :
             raise ArakoonNoMasterResult ()
         return retVal
 
-    def _validateMasterId(self, masterId):
-        if masterId is None:
-            return False
-
-        otherMasterId = self._getMasterIdFromNode(masterId)
-        return masterId == otherMasterId
-
     def _getMasterIdFromNode(self, nodeId):
         conn = self._sendMessage( nodeId , ArakoonProtocol.encodeWhoMaster() )
         masterId = conn.decodeStringOptionResult( )
@@ -731,7 +1688,7 @@ class ArakoonClient :
     def _sleep(self, timeout):
         time.sleep( timeout )
 
-    def _sendMessage(self, nodeId, msgBuffer, tryCount = -1):
+    def _sendMessage(self, nodeId, msgBuffer, tryCount = -1, pipelined = False):
 
         result = None
 
@@ -741,29 +1698,45 @@ class ArakoonClient :
         for i in range(tryCount) :
 
             if i > 0:
-                maxSleep = i * ArakoonClientConfig.getBackoffInterval()
-                self._sleep( random.randint(0, maxSleep) )
-
-            with self.__lock :
-
-                try :
-                    connection = self._getConnection( nodeId )
+                self._metrics.countRetry()
+                maxSleep = i * self._config.backoff_interval
+                self._sleep( ArakoonDeadline.remaining( random.uniform(0, maxSleep) ) )
+                ArakoonDeadline.check()
+
+            connection = None
+            try :
+                connection = self._getConnection( nodeId )
+                if pipelined:
+                    connection.sendPipelined( msgBuffer )
+                else:
                     connection.send( msgBuffer )
 
-                    # Message sent correctly, return client connection so result
-                    # can be read
-                    result = connection
-                    break
-
-                except Exception, ex:
-                    fmt = "Attempt %d to exchange message with node %s failed with error (%s: '%s')."
-                    ArakoonClientLogger.logWarning( fmt , i, nodeId,
-                                                    ex.__class__.__name__, ex )
-
-                    # Get rid of the connection in case of an exception
-                    self._connections[nodeId].close()
-                    del self._connections[ nodeId ]
-                    self._masterId = None
+                # Message sent correctly, return client connection so result
+                # can be read. Decoding the result hands it back to the pool.
+                result = connection
+                break
+
+            except ArakoonNodeUnavailable:
+                # no I/O was done, retrying won't change that
+                self._forgetMaster( nodeId )
+                raise
+
+            except ArakoonTimeout:
+                if connection is not None:
+                    connection.abandon()
+                    connection.release()
+                raise
+
+            except Exception, ex:
+                fmt = "Attempt %d to exchange message with node %s failed with error (%s: '%s')."
+                ArakoonClientLogger.logWarning( fmt , i, nodeId,
+                                                ex.__class__.__name__, ex )
+
+                # Get rid of the connection in case of an exception
+                if connection is not None:
+                    connection.close()
+                    connection.release()
+                self._forgetMaster( nodeId )
 
         if result is None:
             # If result is None, this means that all retries failed.
@@ -773,15 +1746,26 @@ class ArakoonClient :
         return result
 
     def _getConnection(self, nodeId):
-        connection = None
-        if self._connections.has_key( nodeId ) :
-            connection = self._connections [ nodeId ]
-
-        if connection is None:
-            nodeLocations = self._config.getNodeLocations( nodeId )
-            clusterId = self._config.getClusterId()
-            connection = ArakoonClientConnection ( nodeLocations , clusterId,
-                self._config)
-            self._connections[ nodeId ] = connection
-
-        return connection
+        breaker = self._breaker
+        if breaker is not None:
+            breaker.check( nodeId )
+        return self._getPool( nodeId ).acquire()
+
+    def _recordOutcome(self, nodeId, succeeded):
+        # the reply to a request was read, or the connection broke before
+        breaker = self._breaker
+        if breaker is None:
+            return
+        if succeeded:
+            breaker.succeeded( nodeId )
+        elif breaker.failed( nodeId ):
+            # the connections left are to a node that is down
+            self._getPool( nodeId ).close()
+
+    def _getPool(self, nodeId):
+        with self.__lock :
+            pool = self._pools.get( nodeId )
+            if pool is None:
+                pool = ArakoonConnectionPool( nodeId, self._config, self._metrics, self._recordOutcome )
+                self._pools[ nodeId ] = pool
+        return pool
@@ -0,0 +1,562 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Asynchronous Arakoon client
+
+Every request returns an L{ArakoonFuture} immediately. Requests to the same node
+share a single connection: they are written as soon as they are issued and one
+reader thread per connection decodes the replies in order, so any number of
+requests can be in flight at once. Finding the master and connecting are done
+on client threads as well, so issuing a request never waits for a node.
+"""
+
+import time
+import threading
+import collections
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+from ArakoonClientConnection import ArakoonClientConnection
+from Arakoon import ArakoonClient
+from ArakoonBalancer import ArakoonReadBalancer
+
+
+class ArakoonFuture :
+
+    def __init__ (self):
+        """
+        Result of a request issued through an L{AsyncArakoonClient}
+        """
+        self._condition = threading.Condition()
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        """
+        @rtype: bool
+        @return: True if the request completed, successfully or not
+        """
+        return self._done
+
+    def result(self, timeout = None):
+        """
+        Wait for the request to complete and return its result.
+
+        Raises the exception of a failed request.
+
+        @type timeout: float
+        @param timeout: seconds to wait, None waits forever
+        """
+        self._wait(timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout = None):
+        """
+        Wait for the request to complete and return its exception, or None if it succeeded.
+
+        @type timeout: float
+        @param timeout: seconds to wait, None waits forever
+        """
+        self._wait(timeout)
+        return self._exception
+
+    def addDoneCallback(self, fn):
+        """
+        Call fn(future) once the request completes.
+
+        If it already completed, fn is called right away.
+        Otherwise it will be called from a client thread, so it should not block.
+        """
+        with self._condition:
+            if not self._done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise ArakoonTimeout()
+
+    def _setResult(self, result):
+        self._complete(result, None)
+
+    def _setException(self, ex):
+        self._complete(None, ex)
+
+    def _complete(self, result, ex):
+        with self._condition:
+            self._result = result
+            self._exception = ex
+            self._done = True
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._condition.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception, cbEx:
+                ArakoonClientLogger.logError( "Future callback failed (%s: '%s')",
+                                              cbEx.__class__.__name__, cbEx )
+
+
+class _AsyncChannel :
+
+    def __init__ (self, nodeId, connect):
+        # connect opens the connection; the reader thread calls it, and the
+        # requests submitted in the meantime are written once it is open
+        self._nodeId = nodeId
+        self._connect = connect
+        self._connection = None
+        self._unsent = []
+        self._pending = collections.deque()
+        self._sendLock = threading.Lock()
+        self._pendingLock = threading.Condition()
+        self._broken = None
+        self._reader = threading.Thread( target = self._run,
+                                         name = "arakoon-async-%s" % nodeId )
+        self._reader.daemon = True
+        self._reader.start()
+
+    def isBroken(self):
+        return self._broken is not None
+
+    def submit(self, msg, decode, future):
+        # The send lock keeps the order of the pending queue equal to the order
+        # on the wire. It is separate from the pending lock so a blocked send
+        # never keeps the reader from taking in replies.
+        with self._sendLock:
+            with self._pendingLock:
+                if self._broken is not None:
+                    raise self._broken
+                self._pending.append( (decode, future) )
+                self._pendingLock.notify()
+            if self._connection is None:
+                self._unsent.append(msg)
+            else:
+                self._send(msg)
+
+    def _send(self, msg):
+        # called with the send lock held
+        try:
+            self._connection.send(msg)
+        except ArakoonException, ex:
+            self._break(ex)
+        if self._broken is not None:
+            # don't leave a connection behind that send might have reopened
+            self._connection.close()
+
+    def close(self):
+        self._break( ArakoonSockRecvClosed() )
+
+    def _break(self, ex):
+        with self._pendingLock:
+            if self._broken is not None:
+                return
+            self._broken = ex
+            failed = list(self._pending)
+            self._pending.clear()
+            self._pendingLock.notify()
+        if self._connection is not None:
+            self._connection.close()
+        for (_, future) in failed:
+            future._setException(ex)
+
+    def _run(self):
+        try:
+            connection = self._connect()
+        except Exception, ex:
+            self._break(ex)
+            return
+        with self._sendLock:
+            self._connection = connection
+            if self._broken is not None:
+                # closed while connecting
+                connection.close()
+                return
+            unsent = self._unsent
+            self._unsent = []
+            if len(unsent) > 0:
+                self._send( ''.join(unsent) )
+        self._readReplies()
+
+    def _readReplies(self):
+        while True:
+            with self._pendingLock:
+                while len(self._pending) == 0 and self._broken is None:
+                    self._pendingLock.wait()
+                if self._broken is not None:
+                    return
+                decode, future = self._pending[0]
+            try:
+                result = decode(self._connection)
+            except ArakoonSocketException, ex:
+                self._break(ex)
+                return
+            except ArakoonException, ex:
+                self._popHead()
+                future._setException(ex)
+            except Exception, ex:
+                self._break(ex)
+                return
+            else:
+                self._popHead()
+                future._setResult(result)
+
+    def _popHead(self):
+        with self._pendingLock:
+            if len(self._pending) > 0:
+                self._pending.popleft()
+
+
+class AsyncArakoonClient :
+
+    def __init__ (self, config = None):
+        """
+        Constructor of an asynchronous Arakoon client object.
+
+        All request methods return an L{ArakoonFuture}. e.g. ::
+            client = AsyncArakoonClient(cfg)
+            futures = [client.set('key_%d' % i, 'value') for i in xrange(1000)]
+            for f in futures:
+                f.result()
+
+        Master discovery is done the way L{ArakoonClient} does it, by a single
+        thread for all the requests that wait for it. Failed requests are
+        retried with the semantics of retryDuringMasterReelection.
+        TLS connections are not supported.
+
+        @type config: L{ArakoonClientConfig}
+        @param config: The L{ArakoonClientConfig} object to be used by the client.
+        """
+        if config is None:
+            config = ArakoonClientConfig()
+        if config.tls:
+            raise ArakoonNotSupportedException("The asynchronous client does not support TLS")
+        self._config = config
+        # only used to find out who the master is
+        self._masterClient = ArakoonClient(config)
+        self._masterLock = threading.Lock()
+        self._lock = threading.Lock()
+        self._channels = dict()
+        # the attempts that wait for the master to be found, and the thread that finds it
+        self._awaitingMaster = []
+        self._discoverer = None
+        self._consistency = Consistent()
+        self._dirtyReadNode = None
+        self._valueCodec = None
+        self._balancer = ArakoonReadBalancer( self._config.getNodes().keys() )
+
+    def allowDirtyReads(self):
+        """
+        Allow the client to read values from a potential slave.
+
+        Enabling this can give back outdated values!
+        """
+        self._consistency = NoGuarantee()
+
+    def disallowDirtyReads(self):
+        """
+        Disallow the client to read values from a potential slave.
+        """
+        self._consistency = Consistent()
+
+    def setConsistency(self, c):
+        """
+        Either Consistent or NoGuarantees or AtLeast. Allows fine grained consistency constraints on subsequent reads
+        @type c: Consistency
+        """
+        self._consistency = c
+
+    def setDirtyReadNode(self, node):
+        """
+        Set the node that will be used for dirty read operations
+
+        @type node : string
+        @param node : the node identifier, None to spread the dirty reads over all nodes again
+        """
+        if node is not None and node not in self._config.getNodes().keys():
+            raise ArakoonUnknownNode( node )
+        self._dirtyReadNode = node
+
+    def setValueCodec(self, codec, minSize = None):
+        """
+        Compress the values this client writes, see L{ArakoonClient.setValueCodec}
+        """
+        self._masterClient.setValueCodec(codec, minSize)
+        self._valueCodec = self._masterClient.getValueCodec()
+
+    def getValueCodec(self):
+        """
+        @rtype: L{ArakoonValueCodec}
+        @return: The value codec of this client, None if values are stored as they are
+        """
+        return self._valueCodec
+
+    def whoMaster(self):
+        with self._masterLock:
+            return self._masterClient.whoMaster()
+
+    def dropConnections(self):
+        '''Drop all connections to the Arakoon servers, failing the requests in flight'''
+        with self._lock:
+            channels = self._channels.values()
+            self._channels = dict()
+        for channel in channels:
+            channel.close()
+
+    def _forgetMaster(self, nodeId = None):
+        with self._masterLock:
+            self._masterClient._forgetMaster(nodeId)
+
+    def _dropChannel(self, nodeId, channel):
+        # a channel opened since by another request is left alone
+        with self._lock:
+            if self._channels.get(nodeId) is channel:
+                del self._channels[nodeId]
+        channel.close()
+
+    def _getChannel(self, nodeId):
+        # never blocks: a new channel connects on its own thread
+        with self._lock:
+            channel = self._channels.get(nodeId)
+            if channel is None or channel.isBroken():
+                channel = _AsyncChannel( nodeId, lambda: self._connect(nodeId) )
+                self._channels[nodeId] = channel
+            return channel
+
+    def _connect(self, nodeId):
+        nodeLocations = self._config.getNodeLocations( nodeId )
+        clusterId = self._config.getClusterId()
+        connection = ArakoonClientConnection( nodeLocations, clusterId, self._config )
+        if not connection._connected:
+            raise ArakoonNotConnected( nodeLocations )
+        return connection
+
+    def _submit(self, msg, decode, isReadOnly = False, allowDirty = False, undo = None):
+        # undo: takes the value codec off the result
+        if undo is not None:
+            read = decode
+            decode = lambda conn: undo( read(conn) )
+        future = ArakoonFuture()
+        deadline = time.time() + self._config.no_master_retry_period
+        dirty = allowDirty and self._consistency.isDirty()
+        self._attempt(msg, decode, isReadOnly, dirty, future, deadline, 0.0)
+        return future
+
+    def _attempt(self, msg, decode, isReadOnly, dirty, future, deadline, tryCount):
+        args = (msg, decode, isReadOnly, dirty, future, deadline, tryCount)
+        if dirty:
+            request = self._balancer.begin( self._dirtyReadNode )
+            self._send(request.nodeId, request, None, *args)
+            return
+        masterId = self._masterClient._masterId
+        if masterId is not None:
+            self._send(masterId, None, None, *args)
+            return
+        with self._lock:
+            self._awaitingMaster.append(args)
+            if self._discoverer is not None:
+                return
+            self._discoverer = threading.Thread( target = self._discover, name = "arakoon-async-master" )
+            self._discoverer.daemon = True
+            self._discoverer.start()
+
+    def _discover(self):
+        masterId = None
+        failure = None
+        try:
+            masterId = self.whoMaster()
+        except ArakoonException, ex:
+            failure = ex
+        with self._lock:
+            waiting = self._awaitingMaster
+            self._awaitingMaster = []
+            self._discoverer = None
+        for args in waiting:
+            self._send(masterId, None, failure, *args)
+
+    def _send(self, nodeId, request, failure, msg, decode, isReadOnly, dirty, future, deadline, tryCount):
+        attempt = ArakoonFuture()
+        channel = None
+        if failure is not None:
+            attempt._setException(failure)
+        else:
+            try:
+                channel = self._getChannel(nodeId)
+                channel.submit(msg, decode, attempt)
+            except ArakoonException, ex:
+                attempt._setException(ex)
+
+        def onDone(a):
+            ex = a._exception
+            if request is not None:
+                request.finish( isinstance(ex, (ArakoonSocketException, ArakoonNotConnected)) )
+            if ex is None:
+                future._setResult(a._result)
+                return
+            retryable = (ArakoonNoMaster, ArakoonNodeNotMaster, ArakoonSocketException,
+                         ArakoonNotConnected, ArakoonGoingDown)
+            if not isinstance(ex, retryable) or \
+               (not isReadOnly and isinstance(ex, (ArakoonSocketException, ArakoonGoingDown))):
+                future._setException(ex)
+                return
+            if not dirty:
+                self._forgetMaster(nodeId)
+            if channel is not None and not isinstance(ex, ArakoonNodeNotMaster):
+                self._dropChannel(nodeId, channel)
+            sleepPeriod = 0.2 * tryCount
+            if time.time() + sleepPeriod > deadline:
+                future._setException(ex)
+                return
+            ArakoonClientLogger.logWarning( "Master not found (%s). Retrying in %0.2f sec." % (ex, sleepPeriod) )
+            # retry from a timer thread: never block the reader that completed the attempt
+            timer = threading.Timer( sleepPeriod, self._attempt,
+                                     (msg, decode, isReadOnly, dirty, future, deadline, tryCount + 1.0) )
+            timer.daemon = True
+            timer.start()
+
+        attempt.addDoneCallback(onDone)
+
+    def hello(self, clientId, clusterId = 'arakoon'):
+        msg = ArakoonProtocol.encodePing(clientId, clusterId)
+        return self._submit(msg, ArakoonProtocol.decodeStringResult, isReadOnly = True)
+
+    def getKeyCount(self):
+        msg = ArakoonProtocol.encodeGetKeyCount()
+        return self._submit(msg, ArakoonProtocol.decodeInt64Result, isReadOnly = True)
+
+    def exists(self, key):
+        msg = ArakoonProtocol.encodeExists(key, self._consistency)
+        return self._submit(msg, ArakoonProtocol.decodeBoolResult, isReadOnly = True, allowDirty = True)
+
+    def get(self, key):
+        msg = ArakoonProtocol.encodeGet(key, self._consistency)
+        codec = self._valueCodec
+        return self._submit(msg, ArakoonProtocol.decodeStringResult, isReadOnly = True, allowDirty = True,
+                            undo = codec and codec.decode)
+
+    def multiGet(self, keys):
+        msg = ArakoonProtocol.encodeMultiGet(keys, self._consistency)
+        codec = self._valueCodec
+        return self._submit(msg, ArakoonProtocol.decodeStringListResult, isReadOnly = True, allowDirty = True,
+                            undo = codec and codec.decodeList)
+
+    def multiGetOption(self, keys):
+        msg = ArakoonProtocol.encodeMultiGetOption(keys, self._consistency)
+        codec = self._valueCodec
+        return self._submit(msg, ArakoonProtocol.decodeStringOptionArrayResult, isReadOnly = True, allowDirty = True,
+                            undo = codec and codec.decodeList)
+
+    def aSSert(self, key, vo):
+        codec = self._valueCodec
+        if codec is not None:
+            vo = codec.encode(vo)
+        msg = ArakoonProtocol.encodeAssert(key, vo, self._consistency)
+        return self._submit(msg, ArakoonProtocol.decodeVoidResult, isReadOnly = True, allowDirty = True)
+
+    def aSSert_exists(self, key):
+        msg = ArakoonProtocol.encodeAssertExists(key, self._consistency)
+        return self._submit(msg, ArakoonProtocol.decodeVoidResult, isReadOnly = True, allowDirty = True)
+
+    def range(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeRange(beginKey, beginKeyIncluded, endKey,
+                                          endKeyIncluded, maxElements, self._consistency)
+        return self._submit(msg, ArakoonProtocol.decodeStringListResult, isReadOnly = True, allowDirty = True)
+
+    def range_entries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeRangeEntries(beginKey, beginKeyIncluded, endKey,
+                                                 endKeyIncluded, maxElements, self._consistency)
+        codec = self._valueCodec
+        return self._submit(msg, ArakoonProtocol.decodeStringPairListResult, isReadOnly = True, allowDirty = True,
+                            undo = codec and codec.decodePairs)
+
+    def rev_range_entries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeReverseRangeEntries(beginKey, beginKeyIncluded, endKey,
+                                                        endKeyIncluded, maxElements, self._consistency)
+        codec = self._valueCodec
+        return self._submit(msg, ArakoonProtocol.decodeStringPairListResult, isReadOnly = True, allowDirty = True,
+                            undo = codec and codec.decodePairs)
+
+    def prefix(self, keyPrefix, maxElements = 1000):
+        msg = ArakoonProtocol.encodePrefixKeys(keyPrefix, maxElements, self._consistency)
+        return self._submit(msg, ArakoonProtocol.decodeStringListResult, isReadOnly = True, allowDirty = True)
+
+    def set(self, key, value):
+        codec = self._valueCodec
+        if codec is not None:
+            value = codec.encode(value)
+        return self._submit(ArakoonProtocol.encodeSet(key, value), ArakoonProtocol.decodeVoidResult)
+
+    def confirm(self, key, value):
+        codec = self._valueCodec
+        if codec is not None:
+            value = codec.encode(value)
+        return self._submit(ArakoonProtocol.encodeConfirm(key, value), ArakoonProtocol.decodeVoidResult)
+
+    def delete(self, key):
+        return self._submit(ArakoonProtocol.encodeDelete(key), ArakoonProtocol.decodeVoidResult)
+
+    def deletePrefix(self, prefix):
+        return self._submit(ArakoonProtocol.encodeDeletePrefix(prefix), ArakoonProtocol.decodeIntResult)
+
+    def sequence(self, seq, sync = False):
+        codec = self._valueCodec
+        if codec is not None:
+            seq = codec.encodeUpdate(seq)
+        return self._submit(ArakoonProtocol.encodeSequence(seq, sync), ArakoonProtocol.decodeVoidResult)
+
+    def makeSequence(self, compact = False):
+        """
+        Factory method for sequences, see L{ArakoonClient.makeSequence}
+        """
+        if compact:
+            return CompactSequence()
+        return Sequence()
+
+    def testAndSet(self, key, oldValue, newValue):
+        codec = self._valueCodec
+        if codec is not None:
+            oldValue = codec.encode(oldValue)
+            newValue = codec.encode(newValue)
+        msg = ArakoonProtocol.encodeTestAndSet(key, oldValue, newValue)
+        return self._submit(msg, ArakoonProtocol.decodeStringOptionResult, undo = codec and codec.decode)
+
+    def replace(self, key, wanted):
+        codec = self._valueCodec
+        if codec is not None:
+            wanted = codec.encode(wanted)
+        msg = ArakoonProtocol.encodeReplace(key, wanted)
+        return self._submit(msg, ArakoonProtocol.decodeStringOptionResult, undo = codec and codec.decode)
+
+    def userFunction(self, name, argument):
+        msg = ArakoonProtocol.encodeUserFunction(name, argument)
+        return self._submit(msg, ArakoonProtocol.decodeStringOptionResult)
+
+    def nop(self):
+        return self._submit(ArakoonProtocol.encodeNOP(), ArakoonProtocol.decodeVoidResult)
+
+    def get_txid(self):
+        return self._submit(ArakoonProtocol.encodeGetTxid(), ArakoonProtocol.decodeGetTxidResult)
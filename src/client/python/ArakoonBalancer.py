@@ -0,0 +1,218 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Spreads the reads that may go to any node over the nodes of the cluster
+"""
+
+import math
+import time
+import random
+import threading
+import collections
+
+# weight of a new latency sample in the moving average
+ARA_CFG_BALANCER_EWMA_WEIGHT = 0.3
+# seconds after which the latency of a node that got no requests is halved
+ARA_CFG_BALANCER_LATENCY_HALF_LIFE = 10.0
+# seconds a node that failed is left alone
+ARA_CFG_BALANCER_FAILURE_PENALTY = 5.0
+# number of recent latencies the percentiles are taken from
+ARA_CFG_BALANCER_LATENCY_WINDOW = 1000
+# no percentiles are given before this many latencies were measured
+ARA_CFG_BALANCER_MIN_SAMPLES = 20
+
+
+class _NodeLoad(object):
+
+    def __init__(self, nodeId):
+        self.nodeId = nodeId
+        self.latency = 0.0
+        self.measured = 0.0
+        self.outstanding = 0
+        self.failedAt = None
+        self.requests = 0
+        self.failures = 0
+
+    def cost(self, now):
+        # the latency decays while the node isn't used, so a node that was
+        # slow once gets tried again eventually
+        idle = now - self.measured
+        latency = self.latency * math.pow(0.5, idle / ARA_CFG_BALANCER_LATENCY_HALF_LIFE)
+        return latency * (self.outstanding + 1)
+
+
+class _BalancedRequest(object):
+
+    def __init__(self, balancer, load):
+        self._balancer = balancer
+        self._load = load
+        self.nodeId = load.nodeId
+        self._start = time.time()
+        self._finished = False
+
+    def finish(self, failed):
+        """
+        Report the outcome of the request to the balancer. Only the first call counts.
+
+        @type failed: bool
+        @param failed: whether the node could not be reached, or the connection broke
+        """
+        if not self._finished:
+            self._finished = True
+            self._balancer._finish(self._load, time.time() - self._start, failed)
+
+    def cancel(self):
+        """
+        End the request without reporting its outcome, e.g. when its reply is not waited for
+        """
+        if not self._finished:
+            self._finished = True
+            self._balancer._cancel(self._load)
+
+    def released(self, connection):
+        self.finish(not connection._connected)
+
+
+class ArakoonReadBalancer(object):
+
+    def __init__(self, nodeIds):
+        """
+        Picks the node for a read that doesn't have to go to the master.
+
+        Of two nodes picked at random, the one with the lowest cost is taken:
+        the moving average of its latency, times the number of requests it has
+        outstanding plus one. Nodes that failed less than
+        L{ARA_CFG_BALANCER_FAILURE_PENALTY} seconds ago are skipped, unless all
+        nodes did.
+
+        @type nodeIds: list of string
+        """
+        self._lock = threading.Lock()
+        self._loads = dict( (nodeId, _NodeLoad(nodeId)) for nodeId in nodeIds )
+        self._recent = collections.deque( maxlen = ARA_CFG_BALANCER_LATENCY_WINDOW )
+        self._sorted = None
+        self._unsorted = 0
+
+    def __len__(self):
+        return len(self._loads)
+
+    def choose(self, exclude = None, among = None):
+        """
+        @type exclude: string
+        @param exclude: a node not to pick, unless it is the only one
+        @type among: list of string
+        @param among: the nodes to pick from, defaults to all of them
+        @rtype: string
+        @return: the node to send the next read to
+        """
+        with self._lock:
+            return self._choose(time.time(), exclude, among).nodeId
+
+    def _choose(self, now, exclude = None, among = None):
+        limit = now - ARA_CFG_BALANCER_FAILURE_PENALTY
+        candidates = self._loads.values()
+        if among is not None:
+            candidates = [ self._loads[nodeId] for nodeId in among ]
+        loads = [ l for l in candidates if l.nodeId != exclude ]
+        if len(loads) == 0:
+            loads = candidates
+        eligible = [ l for l in loads if l.failedAt is None or l.failedAt < limit ]
+        if len(eligible) == 0:
+            return min( loads, key = lambda l: l.failedAt )
+        if len(eligible) == 1:
+            return eligible[0]
+        a, b = random.sample( eligible, 2 )
+        if b.cost(now) < a.cost(now):
+            return b
+        return a
+
+    def begin(self, nodeId = None, exclude = None, among = None):
+        """
+        Start a request on nodeId, or on the node L{choose} picks.
+
+        @rtype: object
+        @return: the request, its finish(failed) method must be called when it is done.
+        Its released(connection) method can be set as the release hook of the connection.
+        """
+        with self._lock:
+            if nodeId is None:
+                load = self._choose(time.time(), exclude, among)
+            else:
+                load = self._loads[nodeId]
+            load.outstanding += 1
+            load.requests += 1
+        return _BalancedRequest(self, load)
+
+    def _finish(self, load, elapsed, failed):
+        with self._lock:
+            load.outstanding -= 1
+            if failed:
+                load.failedAt = time.time()
+                load.failures += 1
+                return
+            load.failedAt = None
+            if load.measured == 0.0:
+                load.latency = elapsed
+            else:
+                load.latency += ARA_CFG_BALANCER_EWMA_WEIGHT * (elapsed - load.latency)
+            load.measured = time.time()
+            self._recent.append( elapsed )
+            self._unsorted += 1
+
+    def _cancel(self, load):
+        with self._lock:
+            load.outstanding -= 1
+
+    def getLatencyPercentile(self, percentile):
+        """
+        Retrieve a percentile of the latency of the last
+        L{ARA_CFG_BALANCER_LATENCY_WINDOW} requests that succeeded, on any node.
+
+        @type percentile: float
+        @param percentile: between 0 and 100
+        @rtype: float
+        @return: the latency in seconds, None if too few requests were measured
+        """
+        with self._lock:
+            n = len(self._recent)
+            if n < ARA_CFG_BALANCER_MIN_SAMPLES:
+                return None
+            # sorting the window on every request would cost more than the request
+            if self._sorted is None or self._unsorted * 10 >= n:
+                self._sorted = sorted(self._recent)
+                self._unsorted = 0
+            index = min( len(self._sorted) - 1, int(len(self._sorted) * percentile / 100.0) )
+            return self._sorted[index]
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: for every node: its average latency in seconds, the requests
+        outstanding, the requests sent, the failures and whether it is skipped
+        """
+        with self._lock:
+            limit = time.time() - ARA_CFG_BALANCER_FAILURE_PENALTY
+            result = dict()
+            for (nodeId, l) in self._loads.iteritems():
+                result[nodeId] = { 'latency' : l.latency,
+                                   'outstanding' : l.outstanding,
+                                   'requests' : l.requests,
+                                   'failures' : l.failures,
+                                   'skipped' : l.failedAt is not None and l.failedAt >= limit }
+            return result
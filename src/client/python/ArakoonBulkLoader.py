@@ -0,0 +1,255 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Loading large numbers of keys into Arakoon
+"""
+
+import time
+import select
+import collections
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+
+# connections to the master with sequences in flight; the master puts the
+# sequences that come in on different connections in the same paxos round
+ARA_CFG_BULK_CONNECTIONS = 4
+# sequences in flight per connection, the node handles them one by one
+ARA_CFG_BULK_DEPTH = 2
+# commit latency of a sequence the batch size is adapted to, in seconds
+ARA_CFG_BULK_TARGET_LATENCY = 0.2
+ARA_CFG_BULK_MIN_BATCH = 64 * 1024
+ARA_CFG_BULK_INITIAL_BATCH = 256 * 1024
+
+
+class _Batch(object):
+    __slots__ = ('index', 'keys', 'size', 'sent')
+
+    def __init__(self, index, keys, size):
+        self.index = index
+        self.keys = keys
+        self.size = size
+        self.sent = time.time()
+
+
+class ArakoonBulkLoader(object):
+
+    def __init__(self, client, connections = None, depth = None, sync = False,
+                 targetLatency = None, maxBatchBytes = None):
+        """
+        Loads (key, value) pairs at the speed of the master, not at one round trip per update.
+
+        The pairs are encoded into sequences, and several sequences are kept in
+        flight on pipelined connections to the master. The size of the sequences
+        follows the commit latency: they grow while a sequence commits faster than
+        targetLatency, and shrink when it commits slower.
+
+        The load is not atomic, every sequence is. Use L{ArakoonClient.bulkLoader}
+        to create one. e.g. ::
+            loader = client.bulkLoader()
+            loader.load( (key, value) for (key, value) in source )
+            print loader.getStatistics()['keysPerSecond']
+
+        @type client: L{ArakoonClient}
+        @param connections: defaults to L{ARA_CFG_BULK_CONNECTIONS}
+        @param depth: sequences in flight per connection, defaults to L{ARA_CFG_BULK_DEPTH}
+        @type sync: bool
+        @param sync: sync the filesystem on the server after every sequence
+        @param targetLatency: seconds, defaults to L{ARA_CFG_BULK_TARGET_LATENCY}
+        @param maxBatchBytes: the largest sequence, defaults to L{ArakoonClientConfig.getMaxSequenceSize}
+        """
+        if connections is None:
+            connections = ARA_CFG_BULK_CONNECTIONS
+        if depth is None:
+            depth = ARA_CFG_BULK_DEPTH
+        if targetLatency is None:
+            targetLatency = ARA_CFG_BULK_TARGET_LATENCY
+        if maxBatchBytes is None:
+            maxBatchBytes = ArakoonClientConfig.getMaxSequenceSize()
+        if connections < 1 or depth < 1:
+            raise ArakoonInvalidArguments( "ArakoonBulkLoader", [("connections", connections), ("depth", depth)] )
+        self._client = client
+        self._connections = connections
+        self._depth = depth
+        self._cmd = sync and ARA_CMD_SYNCED_SEQUENCE or ARA_CMD_SEQ
+        self._targetLatency = targetLatency
+        self._maxBatchBytes = maxBatchBytes
+        self._minBatchBytes = min( ARA_CFG_BULK_MIN_BATCH, maxBatchBytes )
+        self._batchBytes = min( ARA_CFG_BULK_INITIAL_BATCH, maxBatchBytes )
+        self._reset()
+
+    def _reset(self):
+        self._start = None
+        self._keys = 0
+        self._bytes = 0
+        self._sequences = 0
+        self._performed = 0
+        self._nextBatch = 0
+        self._nextUnacked = 0
+        self._acked = dict()
+        self._carry = None
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: the keys, bytes and sequences committed, the seconds the load took,
+        the resulting keys and bytes per second, the current batch size in bytes,
+        and the number of leading pairs that are known to be performed
+        """
+        elapsed = 0.0
+        if self._start is not None:
+            elapsed = time.time() - self._start
+        rate = lambda n: elapsed > 0 and n / elapsed or 0.0
+        return { 'keys' : self._keys,
+                 'bytes' : self._bytes,
+                 'sequences' : self._sequences,
+                 'elapsed' : elapsed,
+                 'keysPerSecond' : rate(self._keys),
+                 'bytesPerSecond' : rate(self._bytes),
+                 'batchBytes' : self._batchBytes,
+                 'performed' : self._performed }
+
+    def load(self, pairs, progress = None, progressInterval = 1.0):
+        """
+        Set all (key, value) pairs.
+
+        When a sequence fails, no more sequences are sent and ArakoonPartialWrite
+        is raised once the ones in flight are done. Its performed attribute holds
+        the number of leading pairs that are known to be set; the load can be
+        resumed from there.
+
+        @type pairs: iterable of pair(string, string)
+        @param progress: called with L{getStatistics} every progressInterval seconds
+        @type progressInterval: float
+        @rtype: dict
+        @return: L{getStatistics} at the end of the load
+        """
+        self._reset()
+        self._start = time.time()
+        client = self._client
+        pairs = iter(pairs)
+        codec = client._valueCodec
+        if codec is not None:
+            pairs = ( (key, codec.encode(value)) for (key, value) in pairs )
+        masterId = client._determineMaster()
+        inflight = collections.OrderedDict()
+        error = None
+        reported = self._start
+        try:
+            for i in xrange(self._connections):
+                inflight[ client._getConnection( masterId ) ] = collections.deque()
+            exhausted = False
+            while True:
+                if error is None and not exhausted:
+                    exhausted, error = self._fill(pairs, inflight)
+                busy = [ conn for (conn, batches) in inflight.iteritems() if len(batches) > 0 ]
+                if len(busy) == 0:
+                    break
+                ready = [ conn for conn in busy if conn.hasReplyData() ]
+                if len(ready) == 0:
+                    timeout = client._config.connection_timeout
+                    ready = select.select( busy, [], [], timeout )[0]
+                if len(ready) == 0:
+                    # the outcome of the sequences in flight is unknown
+                    error = error or ArakoonSockNotReadable()
+                    for conn in busy:
+                        conn.close()
+                        inflight[conn].clear()
+                for conn in ready:
+                    error = self._collect(conn, inflight[conn]) or error
+                if progress is not None and time.time() - reported >= progressInterval:
+                    reported = time.time()
+                    progress( self.getStatistics() )
+        finally:
+            for (conn, batches) in inflight.iteritems():
+                if len(batches) > 0:
+                    conn.close()
+                conn.release()
+            cache = client._readCache
+            if cache is not None:
+                cache.flush()
+            client._wrote()
+
+        if error is not None:
+            if isinstance(error, (ArakoonNodeNotMaster, ArakoonNodeNoLongerMaster, ArakoonSocketException)):
+                client._forgetMaster( masterId )
+            raise ArakoonPartialWrite( self._performed, error )
+        return self.getStatistics()
+
+    def _fill(self, pairs, inflight):
+        for (conn, batches) in inflight.iteritems():
+            while len(batches) < self._depth:
+                seq, count = self._nextSequence(pairs)
+                if count == 0:
+                    return True, None
+                if seq.size() > self._maxBatchBytes:
+                    return True, ArakoonSequenceTooLarge( seq.size(), self._maxBatchBytes )
+                batch = _Batch( self._nextBatch, count, seq.size() )
+                self._nextBatch += 1
+                try:
+                    conn.sendPipelined( seq._encode( self._cmd ) )
+                except ArakoonException, ex:
+                    return True, ex
+                batches.append( batch )
+        return False, None
+
+    def _nextSequence(self, pairs):
+        seq = CompactSequence()
+        count = 0
+        if self._carry is not None:
+            count = seq.addSets( [self._carry] )
+            self._carry = None
+        if seq.size() < self._batchBytes:
+            count += seq.addSets( pairs, self._batchBytes )
+        if seq.size() > self._maxBatchBytes and count > 1:
+            # the last pair took the sequence beyond the limit, it starts the next one
+            last = seq.updates[-1]
+            self._carry = (last.key, last.value)
+            encoded = 3 * ARA_TYPE_INT_SIZE + len(last.key) + len(last.value)
+            seq._rollback( (seq.size() - encoded, len(seq) - 1) )
+            count -= 1
+        return seq, count
+
+    def _collect(self, conn, batches):
+        batch = batches.popleft()
+        try:
+            ArakoonProtocol.decodeVoidResult( conn )
+        except ArakoonSocketException, ex:
+            batches.clear()
+            return ex
+        except ArakoonException, ex:
+            return ex
+        self._acknowledge( batch )
+        self._adapt( time.time() - batch.sent )
+        return None
+
+    def _acknowledge(self, batch):
+        self._keys += batch.keys
+        self._bytes += batch.size
+        self._sequences += 1
+        self._acked[batch.index] = batch.keys
+        while self._nextUnacked in self._acked:
+            self._performed += self._acked.pop( self._nextUnacked )
+            self._nextUnacked += 1
+
+    def _adapt(self, latency):
+        if latency > self._targetLatency:
+            self._batchBytes = max( self._minBatchBytes, int( self._batchBytes * 0.75 ) )
+        else:
+            self._batchBytes = min( self._maxBatchBytes, int( self._batchBytes * 1.25 ) )
@@ -0,0 +1,311 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Client side read cache, kept coherent by following the tlog of the master
+"""
+
+import threading
+import collections
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+
+ARA_CFG_CACHE_POLL_INTERVAL = 0.1
+
+# memory taken by a cache entry, on top of its key and value
+ENTRY_OVERHEAD = 128
+
+# cached for a key without a value
+MISSING = object()
+# cached for a key of which it is only known that it has a value
+PRESENT = object()
+
+
+def _entrySize(key, entry):
+    size = len(key) + ENTRY_OVERHEAD
+    if entry is not MISSING and entry is not PRESENT:
+        size += len(entry)
+    return size
+
+
+class ArakoonReadCache(object):
+
+    def __init__(self, maxBytes):
+        """
+        LRU cache of values, coherent up to the tlog entry it has processed.
+
+        Every update in the tlog up to and including L{getPosition} has been
+        applied to the cache, so a cached value is at least as recent as
+        AtLeast(getPosition()). Values are only cached when they were read with
+        that guarantee.
+
+        @type maxBytes: int
+        @param maxBytes: memory bound for the keys and values in the cache
+        """
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._pending = dict()
+        self._position = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def getPosition(self):
+        """
+        Retrieve the last tlog entry that was applied to the cache
+
+        @rtype: int
+        @return: the tlog index, or None if the cache does not follow the tlog (yet)
+        """
+        return self._position
+
+    def getSize(self):
+        """
+        @rtype: int
+        @return: the memory taken by the cached entries, in bytes
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key, consistency, valueNeeded = True):
+        """
+        Retrieve the cached entry for key, if it satisfies the consistency.
+
+        @type valueNeeded: bool
+        @param valueNeeded: whether L{PRESENT} counts as a miss
+        @rtype: string, L{MISSING}, L{PRESENT} or None
+        @return: the cached entry, or None on a miss
+        """
+        with self._lock:
+            entry = None
+            if self._satisfies(consistency):
+                entry = self._entries.pop(key, None)
+                if entry is not None:
+                    self._entries[key] = entry
+                if entry is PRESENT and valueNeeded:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def _satisfies(self, consistency):
+        if not consistency.isDirty() or self._position is None:
+            return False
+        if isinstance(consistency, AtLeast):
+            return consistency.i <= self._position
+        return True
+
+    def reserve(self, keys, consistency):
+        """
+        Prepare to cache what is read for keys.
+
+        @type keys: list of string
+        @rtype: pair(object, Consistency)
+        @return: the token to hand to L{fill}, and the consistency to read with.
+        The token is None if what is read can't be cached.
+        """
+        with self._lock:
+            position = self._position
+            if not consistency.isDirty() or position is None:
+                return None, consistency
+            if isinstance(consistency, AtLeast) and consistency.i > position:
+                position = consistency.i
+            token = object()
+            for key in keys:
+                self._pending[key] = token
+            return token, AtLeast(position)
+
+    def fill(self, key, token, entry):
+        """
+        Cache entry for key, unless it was invalidated since it was reserved.
+        """
+        if token is None:
+            return
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return
+            del self._pending[key]
+            old = self._entries.pop(key, None)
+            if old is not None:
+                if entry is PRESENT:
+                    entry = old
+                self._size -= _entrySize(key, old)
+            size = _entrySize(key, entry)
+            if size > self._maxBytes:
+                return
+            self._entries[key] = entry
+            self._size += size
+            while self._size > self._maxBytes:
+                k, e = self._entries.popitem(last = False)
+                self._size -= _entrySize(k, e)
+                self.evictions += 1
+
+    def cancel(self, key, token):
+        if token is None:
+            return
+        with self._lock:
+            if self._pending.get(key) is token:
+                del self._pending[key]
+
+    def _invalidate(self, key):
+        self._pending.pop(key, None)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= _entrySize(key, entry)
+
+    def _invalidatePrefix(self, prefix):
+        for key in self._pending.keys():
+            if key.startswith(prefix):
+                del self._pending[key]
+        for key in self._entries.keys():
+            if key.startswith(prefix):
+                self._invalidate(key)
+
+    def _flush(self):
+        self._pending.clear()
+        self._entries.clear()
+        self._size = 0
+
+    def _applyUpdates(self, updates):
+        for u in updates:
+            if isinstance(u, (Set, Delete, TestAndSet, Replace)):
+                self._invalidate(u.key)
+            elif isinstance(u, Sequence):
+                self._applyUpdates(u.updates)
+            elif isinstance(u, DeletePrefix):
+                self._invalidatePrefix(u.prefix)
+            elif isinstance(u, (UserFunction, NurseryUpdate)):
+                # no telling what these changed
+                self._flush()
+
+    def invalidate(self, updates):
+        """
+        Drop the keys touched by updates that were just performed by this client.
+
+        @type updates: list of L{Update}
+        """
+        with self._lock:
+            self._applyUpdates(updates)
+
+    def flush(self):
+        """
+        Drop all cached entries
+        """
+        with self._lock:
+            self._flush()
+
+    def apply(self, i, updates):
+        """
+        Apply tlog entry i to the cache
+        """
+        with self._lock:
+            self._applyUpdates(updates)
+            self._position = i
+
+    def restart(self, i):
+        """
+        Drop all cached entries and follow the tlog from entry i on.
+        """
+        with self._lock:
+            self._flush()
+            self._position = i
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        """
+        with self._lock:
+            return { 'hits' : self.hits,
+                     'misses' : self.misses,
+                     'evictions' : self.evictions,
+                     'entries' : len(self._entries),
+                     'size' : self._size,
+                     'position' : self._position }
+
+
+class TlogFollower(threading.Thread):
+
+    def __init__(self, client, cache, pollInterval = None):
+        """
+        Thread that applies the tlog of the master to a read cache.
+
+        The master streams the tlog entries that are new since the last poll
+        through LAST_ENTRIES2. When the stream has a gap, or the master can't be
+        reached, the cache is flushed.
+
+        @type client: L{ArakoonClient}
+        @type cache: L{ArakoonReadCache}
+        @param pollInterval: seconds between polls, defaults to L{ARA_CFG_CACHE_POLL_INTERVAL}
+        """
+        threading.Thread.__init__(self, name = "arakoon-tlog-follower")
+        self.daemon = True
+        self._client = client
+        self._cache = cache
+        if pollInterval is None:
+            pollInterval = ARA_CFG_CACHE_POLL_INTERVAL
+        self._pollInterval = pollInterval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.isSet():
+            try:
+                self.poll()
+            except Exception, ex:
+                ArakoonClientLogger.logWarning( "Read cache flushed, could not follow the tlog (%s: '%s')",
+                                                ex.__class__.__name__, ex )
+                self._cache.restart( None )
+            self._stopped.wait( self._pollInterval )
+
+    def poll(self):
+        cache = self._cache
+        position = cache.getPosition()
+        if position is None:
+            txid = self._client.get_txid()
+            position = -1
+            if isinstance(txid, AtLeast):
+                position = txid.i
+            cache.restart( position )
+
+        conn = self._client._sendToMaster( ArakoonProtocol.encodeLastEntries( position + 1 ) )
+        lost = False
+        try:
+            for (i, updates) in ArakoonProtocol.decodeTlogStream( conn ):
+                if i is None:
+                    cache.flush()
+                    lost = True
+                else:
+                    cache.apply( i, updates )
+                    lost = False
+        except:
+            conn.close()
+            raise
+        finally:
+            conn.release()
+        if lost:
+            # the position of the cache is unknown after the skipped entries
+            cache.restart( None )
@@ -0,0 +1,258 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Stream of the updates committed to an Arakoon cluster
+"""
+
+import threading
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+
+# seconds between polls of the tlog once the feed has caught up
+ARA_CFG_FEED_POLL_INTERVAL = 0.1
+# acknowledged entries after which the checkpoint is stored
+ARA_CFG_FEED_ACK_BATCH = 1000
+
+# errors after which the feed looks up the master again and resumes
+_RECONNECT = (ArakoonSocketException, ArakoonNotConnected, ArakoonNoMaster,
+              ArakoonNodeNotMaster, ArakoonNodeNoLongerMaster, ArakoonGoingDown)
+
+
+class Change(object):
+    __slots__ = ('i', 'updates')
+
+    def __init__(self, i, updates):
+        """
+        The updates of a tlog entry.
+
+        A change with i None stands for entries the node could not stream one
+        by one, because they are only in a tlog file or the head database. Those
+        entries are lost to the feed: a consumer that needs every change has to
+        resynchronise, e.g. with range_entries.
+
+        @type i: int
+        @type updates: list of L{Update}
+        """
+        self.i = i
+        self.updates = updates
+
+    def __repr__(self):
+        return "Change(%r, %r)" % (self.i, self.updates)
+
+
+class ArakoonChangeFeed(object):
+
+    def __init__(self, client, start = None, checkpointKey = None,
+                 pollInterval = None, ackBatch = None):
+        """
+        Iterator over the changes committed to the cluster, read from the tlog of the master.
+
+        The feed asks the master for the entries from its position on with
+        LAST_ENTRIES2, and polls again once it has caught up. When the master
+        can't be reached, or another node becomes master, it reconnects and
+        resumes after the last change it yielded. Master leases and nops are
+        left out. e.g. ::
+            feed = client.changeFeed(checkpointKey = 'indexer/position')
+            for change in feed:
+                index(change.updates)
+                feed.ack(change.i)
+
+        The consumer acknowledges the changes it has processed with L{ack}. With
+        a checkpointKey, the last acknowledged i is stored under that key every
+        ackBatch acknowledgements, on L{commit} and on L{close}; a new feed
+        with the same key starts after it. Use L{ArakoonClient.changeFeed} to
+        create one.
+
+        @type client: L{ArakoonClient}
+        @type start: int
+        @param start: the i of the first entry to read. Defaults to the entry after
+        the stored checkpoint, or else to the next entry to be committed.
+        @type checkpointKey: string
+        @param pollInterval: seconds, defaults to L{ARA_CFG_FEED_POLL_INTERVAL}
+        @param ackBatch: defaults to L{ARA_CFG_FEED_ACK_BATCH}
+        """
+        if pollInterval is None:
+            pollInterval = ARA_CFG_FEED_POLL_INTERVAL
+        if ackBatch is None:
+            ackBatch = ARA_CFG_FEED_ACK_BATCH
+        self._client = client
+        self._checkpointKey = checkpointKey
+        self._pollInterval = pollInterval
+        self._ackBatch = ackBatch
+        # the i of the next entry to read, None while it is to be looked up
+        self._next = start
+        self._acknowledged = None
+        self._committed = None
+        self._closed = threading.Event()
+        self._changes = 0
+        self._gaps = 0
+        self._reconnects = 0
+
+    def __iter__(self):
+        return self.changes()
+
+    def getPosition(self):
+        """
+        @rtype: int
+        @return: the i of the next entry the feed reads, None if it hasn't started
+        """
+        return self._next
+
+    def _resolveStart(self):
+        client = self._client
+        if self._checkpointKey is not None:
+            try:
+                acknowledged = int( client.get( self._checkpointKey ) )
+                self._acknowledged = acknowledged
+                self._committed = acknowledged
+                return acknowledged + 1
+            except ArakoonNotFound:
+                pass
+        return self._following()
+
+    def _following(self):
+        txid = self._client.get_txid()
+        if isinstance(txid, AtLeast):
+            return txid.i + 1
+        return 0
+
+    def changes(self, block = True):
+        """
+        Generator over the changes, from the position of the feed on.
+
+        @type block: bool
+        @param block: keep waiting for new changes until the feed is closed,
+        instead of stopping once it has caught up
+        @rtype: iterator of L{Change}
+        """
+        while not self._closed.isSet():
+            try:
+                if self._next is None:
+                    self._next = self._resolveStart()
+                for change in self._poll():
+                    yield change
+                if not block:
+                    return
+            except _RECONNECT, ex:
+                self._reconnects += 1
+                ArakoonClientLogger.logWarning( "Change feed reconnects at %s (%s: '%s')",
+                                                self._next, ex.__class__.__name__, ex )
+            self._closed.wait( self._pollInterval )
+
+    def _poll(self):
+        client = self._client
+        masterId = client._determineMaster()
+        try:
+            conn = client._sendMessage( masterId, ArakoonProtocol.encodeLastEntries( self._next ) )
+        except _RECONNECT:
+            client._forgetMaster( masterId )
+            raise
+        codec = client._valueCodec
+        lost = False
+        complete = False
+        try:
+            for (i, updates) in ArakoonProtocol.decodeTlogStream( conn ):
+                if i is None:
+                    self._gaps += 1
+                    lost = True
+                    yield Change( None, None )
+                    continue
+                lost = False
+                if i < self._next:
+                    continue
+                self._next = i + 1
+                updates = [ u for u in updates if not self._isInternal( u ) ]
+                if len(updates) == 0:
+                    continue
+                if codec is not None:
+                    updates = [ codec.decodeUpdate( u ) for u in updates ]
+                self._changes += 1
+                yield Change( i, updates )
+                if self._closed.isSet():
+                    break
+            else:
+                complete = True
+        except _RECONNECT:
+            client._forgetMaster( masterId )
+            raise
+        finally:
+            if not complete:
+                # the rest of the stream is not read
+                conn.abandon()
+            conn.release()
+        if lost and complete:
+            # the entries up to the end of the stream were skipped
+            self._next = self._following()
+
+    def _isInternal(self, u):
+        if isinstance(u, (MasterSet, Nop)):
+            return True
+        # the feed doesn't report the checkpoints it stores itself
+        return isinstance(u, Set) and u.key == self._checkpointKey
+
+    def ack(self, i):
+        """
+        Acknowledge that the changes up to and including i are processed.
+
+        @type i: int
+        """
+        if self._acknowledged is not None and i <= self._acknowledged:
+            return
+        self._acknowledged = i
+        if self._checkpointKey is not None and \
+           (self._committed is None or i - self._committed >= self._ackBatch):
+            self.commit()
+
+    def getAcknowledged(self):
+        """
+        @rtype: int
+        @return: the last i that was acknowledged, None if nothing was
+        """
+        return self._acknowledged
+
+    def commit(self):
+        """
+        Store the last acknowledged i under the checkpoint key now
+        """
+        acknowledged = self._acknowledged
+        if self._checkpointKey is None or acknowledged is None or acknowledged == self._committed:
+            return
+        self._client.set( self._checkpointKey, str(acknowledged) )
+        self._committed = acknowledged
+
+    def close(self):
+        """
+        Stop the iteration, and store the checkpoint
+        """
+        self._closed.set()
+        self.commit()
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: the position, the last i acknowledged and committed, and the
+        number of changes yielded, gaps met and reconnects done
+        """
+        return { 'position' : self._next,
+                 'acknowledged' : self._acknowledged,
+                 'committed' : self._committed,
+                 'changes' : self._changes,
+                 'gaps' : self._gaps,
+                 'reconnects' : self._reconnects }
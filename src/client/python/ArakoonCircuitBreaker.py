@@ -0,0 +1,243 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Keeps requests away from the nodes that can't be reached
+"""
+
+import time
+import threading
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+from ArakoonClientConnection import ArakoonClientConnection
+import ArakoonDeadline
+
+# failures in a row after which requests to a node are no longer attempted
+ARA_CFG_BREAKER_FAILURE_THRESHOLD = 3
+# seconds between two attempts to reach a node that is skipped
+ARA_CFG_BREAKER_PROBE_INTERVAL = 1.0
+# seconds an attempt to reach a node that is skipped takes at most
+ARA_CFG_BREAKER_PROBE_TIMEOUT = 2.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class _NodeHealth(object):
+
+    def __init__(self, nodeId):
+        self.nodeId = nodeId
+        self.state = CLOSED
+        self.failures = 0
+        self.openedAt = None
+        # when the request that tries a half-open node was let through
+        self.trialAt = None
+        self.trips = 0
+        self.skipped = 0
+
+
+class ArakoonCircuitBreaker(object):
+
+    def __init__(self, config, failureThreshold = None, probeInterval = None):
+        """
+        Follows which nodes can be reached, so the client stops paying a connect
+        timeout for every request to a node that is down.
+
+        A node is closed while requests to it succeed. After failureThreshold
+        failures in a row it opens: requests to it fail with
+        L{ArakoonNodeUnavailable} right away, without any I/O. A thread probes
+        the open nodes every probeInterval seconds, all at once and for at most
+        L{ARA_CFG_BREAKER_PROBE_TIMEOUT} seconds. A node that answers the probe
+        is half-open: a single request is let through to try it, the others
+        still skip it. The trial closes the node when it succeeds, and opens it
+        again when it fails.
+
+        @type config: L{ArakoonClientConfig}
+        @param failureThreshold: defaults to L{ARA_CFG_BREAKER_FAILURE_THRESHOLD}
+        @param probeInterval: defaults to L{ARA_CFG_BREAKER_PROBE_INTERVAL}
+        """
+        if failureThreshold is None:
+            failureThreshold = ARA_CFG_BREAKER_FAILURE_THRESHOLD
+        if probeInterval is None:
+            probeInterval = ARA_CFG_BREAKER_PROBE_INTERVAL
+        self._config = config
+        self._failureThreshold = failureThreshold
+        self._probeInterval = probeInterval
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._prober = None
+        self._health = dict( (nodeId, _NodeHealth(nodeId)) for nodeId in config.getNodes().keys() )
+
+    failureThreshold = property(lambda self: self._failureThreshold)
+    probeInterval = property(lambda self: self._probeInterval)
+
+    def _admits(self, health, now):
+        if health.state == CLOSED:
+            return True
+        if health.state == OPEN:
+            return False
+        # a trial that never reported back, e.g. because it was abandoned, gives up its turn
+        return health.trialAt is None or now - health.trialAt > self._config.connection_timeout
+
+    def allow(self, nodeId):
+        """
+        Take the turn of the trial request of a half-open node as well.
+
+        @type nodeId: string
+        @rtype: bool
+        @return: whether a request may be sent to the node
+        """
+        health = self._health[nodeId]
+        if health.state == CLOSED:
+            return True
+        with self._lock:
+            now = time.time()
+            if not self._admits(health, now):
+                health.skipped += 1
+                return False
+            if health.state == HALF_OPEN:
+                health.trialAt = now
+            return True
+
+    def check(self, nodeId):
+        """
+        Raise L{ArakoonNodeUnavailable} if no request may be sent to the node
+        """
+        if not self.allow(nodeId):
+            raise ArakoonNodeUnavailable( nodeId )
+
+    def available(self, among = None):
+        """
+        @type among: list of string
+        @param among: the nodes to pick from, defaults to all of them
+        @rtype: list of string
+        @return: the nodes of among that may get requests; None if among is
+        None and no node is open. When all of them are open, among is returned.
+        """
+        nodeIds = among
+        if nodeIds is None:
+            nodeIds = self._health.keys()
+        now = time.time()
+        allowed = [ nodeId for nodeId in nodeIds if self._admits(self._health[nodeId], now) ]
+        if len(allowed) == len(nodeIds) or len(allowed) == 0:
+            return among
+        return allowed
+
+    def succeeded(self, nodeId):
+        health = self._health[nodeId]
+        if health.failures == 0 and health.state == CLOSED:
+            return
+        with self._lock:
+            health.failures = 0
+            if health.state == HALF_OPEN:
+                ArakoonClientLogger.logWarning( "Node %s can be reached again", nodeId )
+                health.state = CLOSED
+                health.openedAt = None
+                health.trialAt = None
+
+    def failed(self, nodeId):
+        health = self._health[nodeId]
+        with self._lock:
+            health.failures += 1
+            if health.state == OPEN:
+                return False
+            if health.state == CLOSED and health.failures < self._failureThreshold:
+                return False
+            health.state = OPEN
+            health.openedAt = time.time()
+            health.trialAt = None
+            health.trips += 1
+            self._startProber()
+        ArakoonClientLogger.logWarning( "Node %s failed %d times in a row, it is skipped until it can be reached again" %
+                                        (nodeId, health.failures) )
+        return True
+
+    def _startProber(self):
+        # called with the lock held
+        if self._prober is None and not self._stopped.isSet():
+            self._prober = threading.Thread( target = self._probe, name = "arakoon-breaker" )
+            self._prober.daemon = True
+            self._prober.start()
+
+    def _probe(self):
+        while not self._stopped.wait( self._probeInterval ):
+            with self._lock:
+                nodeIds = [ h.nodeId for h in self._health.itervalues() if h.state == OPEN ]
+                if len(nodeIds) == 0:
+                    self._prober = None
+                    return
+            # a node that doesn't answer doesn't hold up the others
+            probes = [ threading.Thread( target = self._reach, args = (nodeId,),
+                                         name = "arakoon-breaker-%s" % nodeId )
+                       for nodeId in nodeIds ]
+            for probe in probes:
+                probe.daemon = True
+                probe.start()
+            for probe in probes:
+                probe.join()
+
+    def _reach(self, nodeId):
+        conn = None
+        try:
+            with ArakoonDeadline.deadline( ARA_CFG_BREAKER_PROBE_TIMEOUT ):
+                conn = ArakoonClientConnection( self._config.getNodeLocations( nodeId ),
+                                                self._config.getClusterId(),
+                                                self._config )
+                if not conn._connected:
+                    return
+                conn.send( ArakoonProtocol.encodeWhoMaster() )
+                conn.decodeStringOptionResult()
+        except Exception, ex:
+            ArakoonClientLogger.logDebug( "Node %s can't be reached yet (%s: '%s')" %
+                                          (nodeId, ex.__class__.__name__, ex) )
+            return
+        finally:
+            if conn is not None:
+                conn.close()
+        with self._lock:
+            health = self._health[nodeId]
+            if health.state == OPEN:
+                health.state = HALF_OPEN
+
+    def stop(self):
+        """
+        Stop probing the open nodes
+        """
+        self._stopped.set()
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: for every node: its state, the failures in a row, the times it
+        was opened, the requests that skipped it and the seconds it is open
+        """
+        now = time.time()
+        with self._lock:
+            result = dict()
+            for (nodeId, h) in self._health.iteritems():
+                openFor = None
+                if h.openedAt is not None:
+                    openFor = now - h.openedAt
+                result[nodeId] = { 'state' : h.state,
+                                   'failures' : h.failures,
+                                   'trips' : h.trips,
+                                   'skipped' : h.skipped,
+                                   'openFor' : openFor }
+            return result
@@ -17,9 +17,14 @@ limitations under the License.
 
 
 import ssl
+import time
 import socket
+import select
+import threading
 from ArakoonProtocol import *
+from ArakoonProtocol import _INT
 from ArakoonExceptions import *
+import ArakoonDeadline
 
 class ArakoonClientConnection :
 
@@ -33,14 +38,28 @@ class ArakoonClientConnection :
         self._socket = None
         self._socketInfo = None
         self._config = config
+        self._readBuffer = bytearray(ArakoonClientConfig.getReadBufferSize())
+        self._readView = memoryview(self._readBuffer)
+        self._readStart = 0
+        self._readEnd = 0
+        self._pool = None
+        self._generation = 0
+        self._onRelease = None
+        self._metrics = None
+        # a request was sent whose outcome the pool has yet to report
+        self._inFlight = False
+        self._requestCmd = None
+        self._requestStart = None
+        self._bytesSent = 0
+        self._bytesReceived = 0
         self._reconnect()
 
     def _reconnect(self):
         self.close()
+        timeout = ArakoonDeadline.remaining( self._config.connection_timeout )
         try :
             ip = self._nodeIPs[self._index]
-            sock = socket.create_connection((ip , self._nodePort),
-                                                    ArakoonClientConfig.getConnectionTimeout())
+            sock = socket.create_connection((ip , self._nodePort), timeout)
 
             if self._config.tls:
                 kwargs = {
@@ -74,20 +93,67 @@ class ArakoonClientConnection :
             self._index = (self._index + 1) % self._nIPs
 
 
+    def _reconnectForRequest(self):
+        if self._metrics is not None:
+            self._metrics.countReconnect()
+        self._reconnect()
+        if not self._connected :
+            raise ArakoonNotConnected( (self._nodeIPs, self._nodePort) )
+
+    def _startRequest(self, msg, pipelined = False):
+        if self._metrics is not None:
+            if pipelined:
+                # the replies come in one by one, there is no single latency to record
+                self._requestCmd = None
+            else:
+                self._requestCmd = _INT.unpack_from( msg )[0]
+            self._requestStart = time.time()
+            self._bytesSent += len(msg)
+
     def send(self, msg):
 
+        self._inFlight = True
         if not self._connected :
-            self._reconnect()
-            if not self._connected :
-                raise ArakoonNotConnected( (self._nodeIPs, self._nodePort) )
+            self._reconnectForRequest()
+        self._startRequest( msg )
         try:
+            self._socket.settimeout( ArakoonDeadline.remaining( self._config.connection_timeout ) )
             self._socket.sendall( msg )
+        except ArakoonTimeout:
+            raise
+        except Exception, ex:
+            self.close()
+            ArakoonClientLogger.logWarning( "Error while sending data to (%s,%s) => %s: '%s'" ,
+                self._nodeIPs[self._index], self._nodePort, ex.__class__.__name__, ex  )
+            raise ArakoonSockSendError ()
+
+    def write(self, data):
+        """
+        Send more data as part of the current request, e.g. the input of a user hook
+        """
+        if not self._connected :
+            raise ArakoonNotConnected( (self._nodeIPs, self._nodePort) )
+        if self._metrics is not None:
+            self._bytesSent += len(data)
+        try:
+            self._socket.sendall( data )
         except Exception, ex:
             self.close()
             ArakoonClientLogger.logWarning( "Error while sending data to (%s,%s) => %s: '%s'" ,
                 self._nodeIPs[self._index], self._nodePort, ex.__class__.__name__, ex  )
             raise ArakoonSockSendError ()
 
+    def abandon(self):
+        """
+        Close the connection without reading the rest of the reply to the request on it
+
+        While the connection is still up the request didn't fail, and the pool
+        doesn't report it, e.g. when the call ran out of time.
+        """
+        if self._connected:
+            self._inFlight = False
+        self.close()
+
     def close(self):
         if self._connected and self._socket is not None :
             try:
@@ -97,46 +163,401 @@ class ArakoonClientConnection :
                     self._nodeIPs[self._index], self._nodePort, ex.__class__.__name__, ex  )
             self._socketInfo = None
             self._connected = False
+        self._readStart = 0
+        self._readEnd = 0
+
+    def consume(self, n):
+        """
+        Take the next n bytes of the reply out of the read buffer, receiving more data if needed.
+
+        The bytes stay in the buffer, the caller unpacks them from self._readBuffer
+        at the returned offset.
+
+        @type n: int
+        @rtype: int
+        @return: offset of the consumed bytes in the read buffer
+        """
+        if self._readEnd - self._readStart < n:
+            self._fillReadBuffer(n)
+        offset = self._readStart
+        self._readStart = offset + n
+        return offset
+
+    def _makeRoom(self, n):
+        available = self._readEnd - self._readStart
+        capacity = len(self._readBuffer)
+        defaultSize = ArakoonClientConfig.getReadBufferSize()
+        if available == 0 and capacity > defaultSize and n <= defaultSize:
+            # don't hang on to the memory of a large reply
+            self._readBuffer = bytearray(defaultSize)
+            self._readView = memoryview(self._readBuffer)
+        elif n > capacity:
+            newBuffer = bytearray(max(n, 2 * capacity))
+            newBuffer[:available] = self._readView[self._readStart:self._readEnd]
+            self._readBuffer = newBuffer
+            self._readView = memoryview(newBuffer)
+        elif available > 0:
+            self._readView[:available] = self._readView[self._readStart:self._readEnd].tobytes()
+        self._readStart = 0
+        self._readEnd = available
+
+    def _fillReadBuffer(self, n):
+        if not self._connected :
+            raise ArakoonSockRecvClosed()
+
+        if self._readStart == self._readEnd or \
+           self._readStart + n > len(self._readBuffer):
+            self._makeRoom(n)
+
+        while self._readEnd - self._readStart < n :
+            self._waitReadable()
+            self._receiveChunk()
+
+    def _waitReadable(self):
+        if isinstance(self._socket, ssl.SSLSocket) and self._socket.pending() > 0:
+            return
+        try:
+            timeout = ArakoonDeadline.remaining( self._config.connection_timeout )
+        except ArakoonTimeout:
+            # the rest of the reply would be taken for the next one
+            self._inFlight = False
+            self._abort()
+            raise
+        readable = select.select( [self._socket], [], [], timeout )[0]
+        if len(readable) == 0 :
+            msg = str(self._socketInfo)
+            self._abort()
+            deadline = ArakoonDeadline.current()
+            if deadline is not None and deadline.remaining() <= 0:
+                # the budget of the call ran out, not the patience with the node
+                self._inFlight = False
+                raise deadline.expired()
+            raise ArakoonSockNotReadable(msg = msg)
+
+    def _receiveChunk(self):
+        if self._readEnd == len(self._readBuffer):
+            available = self._readEnd - self._readStart
+            self._makeRoom(available + ArakoonClientConfig.getReadBufferSize())
+        self._readEnd += self._receiveInto( self._readView[self._readEnd:] )
+
+    def _receiveInto(self, view):
+        try :
+            received = self._socket.recv_into( view )
+        except Exception, ex:
+            ArakoonClientLogger.logError ("Error while receiving from socket. %s: '%s'" % (ex.__class__.__name__, ex) )
+            self._connected = False
+            raise ArakoonSockRecvError()
+
+        if received == 0 :
+            self._abort()
+            raise ArakoonSockReadNoBytes ()
+        self._bytesReceived += received
+        return received
+
+    def fileno(self):
+        return self._socket.fileno()
+
+    def hasReplyData(self):
+        """
+        @rtype: bool
+        @return: whether part of the reply was received already, so reading it won't block at first
+        """
+        if self._readEnd > self._readStart:
+            return True
+        return isinstance(self._socket, ssl.SSLSocket) and self._socket.pending() > 0
+
+    def readInto(self, target):
+        """
+        Receive the next len(target) bytes of the reply straight into target.
+
+        Only the bytes that already are in the read buffer are copied, the rest
+        is received from the socket without passing through the read buffer.
+
+        @type target: memoryview
+        """
+        n = len(target)
+        done = min(n, self._readEnd - self._readStart)
+        if done > 0:
+            target[:done] = self._readView[self._readStart:self._readStart + done]
+            self._readStart += done
+        if done == n:
+            return
+        if not self._connected :
+            raise ArakoonSockRecvClosed()
+        while done < n:
+            self._waitReadable()
+            done += self._receiveInto( target[done:] )
+
+    def skip(self, n):
+        """
+        Drop the next n bytes of the reply, without holding them in memory all at once.
+
+        @type n: int
+        """
+        chunk = ArakoonClientConfig.getReadBufferSize()
+        while n > 0:
+            size = min(n, chunk)
+            self.consume( size )
+            n -= size
+
+    def sendPipelined(self, msg):
+        """
+        Send a batch of requests, buffering the replies that already come in meanwhile.
+
+        A plain sendall of a large batch can deadlock: the server stops reading
+        requests once it can no longer write replies nobody is reading.
+        """
+        self._inFlight = True
+        if not self._connected :
+            self._reconnectForRequest()
+        self._startRequest( msg, pipelined = True )
+        view = memoryview(msg)
+        sent = 0
+        try:
+            while sent < len(msg):
+                timeout = ArakoonDeadline.remaining( self._config.connection_timeout )
+                readable, writable, _ = select.select( [self._socket], [self._socket], [], timeout )
+                if len(readable) == 0 and len(writable) == 0:
+                    ArakoonDeadline.check()
+                    raise ArakoonSockSendError()
+                if len(readable) > 0:
+                    self._receiveChunk()
+                if len(writable) > 0:
+                    sent += self._socket.send( view[sent:] )
+        except ArakoonTimeout:
+            self.abandon()
+            raise
+        except ArakoonSocketException:
+            self.close()
+            raise
+        except Exception, ex:
+            self.close()
+            ArakoonClientLogger.logWarning( "Error while sending data to (%s,%s) => %s: '%s'" ,
+                self._nodeIPs[self._index], self._nodePort, ex.__class__.__name__, ex  )
+            raise ArakoonSockSendError ()
+
+    def release(self):
+        """
+        Hand the connection back to the pool it was taken from, if any
+
+        The release hook set for the request, if any, is called first.
+        """
+        onRelease = self._onRelease
+        if onRelease is not None:
+            self._onRelease = None
+            onRelease( self )
+        if self._requestStart is not None:
+            self._finishRequest()
+        if self._pool is not None:
+            self._pool.release( self )
+
+    def _finishRequest(self):
+        nodeId = None
+        if self._pool is not None:
+            nodeId = self._pool._nodeId
+        self._metrics.recordCall( self._requestCmd, nodeId, time.time() - self._requestStart,
+                                  self._bytesSent, self._bytesReceived )
+        self._requestCmd = None
+        self._requestStart = None
+        self._bytesSent = 0
+        self._bytesReceived = 0
+
+    def _decode(self, decoder, *args):
+        try:
+            return decoder( self, *args )
+        except ArakoonException:
+            raise
+        except:
+            # the rest of the reply is still waiting on the socket
+            self.close()
+            raise
+        finally:
+            self.release()
+
+    def _abort(self):
+        try:
+            self._socket.close()
+        except Exception, ex:
+            ArakoonClientLogger.logError( "Error while closing socket. %s: %s" % (ex.__class__.__name__,ex))
+        self._connected = False
+
+    def decodeStringResult(self):
+        return self._decode( ArakoonProtocol.decodeStringResult )
 
-    def decodeStringResult(self) :
-        return ArakoonProtocol.decodeStringResult ( self )
+    def decodeStringIntoResult(self, buffer):
+        return self._decode( ArakoonProtocol.decodeStringIntoResult, buffer )
 
-    def decodeBoolResult(self) :
-        return ArakoonProtocol.decodeBoolResult ( self )
+    def decodeBoolResult(self):
+        return self._decode( ArakoonProtocol.decodeBoolResult )
 
-    def decodeVoidResult(self) :
-        ArakoonProtocol.decodeVoidResult ( self )
+    def decodeVoidResult(self):
+        return self._decode( ArakoonProtocol.decodeVoidResult )
 
-    def decodeStringOptionResult (self):
-        return ArakoonProtocol.decodeStringOptionResult ( self )
+    def decodeStringOptionResult(self):
+        return self._decode( ArakoonProtocol.decodeStringOptionResult )
 
-    def decodeStringArrayResult(self) :
-        return ArakoonProtocol.decodeStringArrayResult ( self )
+    def decodeStringArrayResult(self):
+        return self._decode( ArakoonProtocol.decodeStringArrayResult )
 
     def decodeStringListResult(self):
-        return ArakoonProtocol.decodeStringListResult(self)
+        return self._decode( ArakoonProtocol.decodeStringListResult )
 
     def decodeStringOptionArrayResult(self):
-        return ArakoonProtocol.decodeStringOptionArrayResult(self)
+        return self._decode( ArakoonProtocol.decodeStringOptionArrayResult )
 
-    def decodeStringPairListResult(self) :
-        return ArakoonProtocol.decodeStringPairListResult ( self )
+    def decodeStringPairListResult(self):
+        return self._decode( ArakoonProtocol.decodeStringPairListResult )
 
     def decodeStatistics(self):
-        return ArakoonProtocol.decodeStatistics(self)
+        return self._decode( ArakoonProtocol.decodeStatistics )
 
     def decodeInt64Result(self):
-        return ArakoonProtocol.decodeInt64Result(self)
+        return self._decode( ArakoonProtocol.decodeInt64Result )
 
     def decodeIntResult(self):
-        return ArakoonProtocol.decodeIntResult(self)
+        return self._decode( ArakoonProtocol.decodeIntResult )
 
     def decodeNurseryCfgResult(self):
-        return ArakoonProtocol.decodeNurseryCfgResult(self)
+        return self._decode( ArakoonProtocol.decodeNurseryCfgResult )
 
     def decodeVersionResult(self):
-        return ArakoonProtocol.decodeVersionResult(self)
+        return self._decode( ArakoonProtocol.decodeVersionResult )
 
     def decodeGetTxidResult(self):
-        return ArakoonProtocol.decodeGetTxidResult(self)
+        return self._decode( ArakoonProtocol.decodeGetTxidResult )
+
+
+
+class ArakoonConnectionPool :
+
+    def __init__ (self, nodeId, config, metrics = None, onOutcome = None):
+        """
+        Bounded pool of connections to a single node.
+
+        A connection is taken out of the pool for a complete request/reply exchange,
+        so threads sharing a client never read each other's replies.
+        At most config.getPoolMaxSize() connections are open at any time,
+        idle connections are closed after config.getPoolMaxIdleTime() seconds
+        as long as more than config.getPoolMinSize() remain, by a timer when
+        the pool isn't used meanwhile.
 
+        @type nodeId: string
+        @type config: L{ArakoonClientConfig}
+        @type metrics: L{ArakoonMetrics}
+        @param metrics: where the requests on the connections are recorded, if anywhere
+        @type onOutcome: callable
+        @param onOutcome: called with the node and whether the connection is still
+        up when a connection a request was sent on is released, see
+        L{ArakoonClientConnection.abandon}
+        """
+        self._nodeId = nodeId
+        self._config = config
+        self._metrics = metrics
+        self._onOutcome = onOutcome
+        self._condition = threading.Condition()
+        self._idle = []
+        self._size = 0
+        self._generation = 0
+        # connections closed because they broke or were dropped, the ones
+        # opened to replace them count as reconnects
+        self._lost = 0
+        # closes the idle connections that expire while the pool isn't used
+        self._reaper = None
+
+    def acquire(self):
+        """
+        Take a connection out of the pool, opening a new one if the pool isn't full yet.
+
+        Waits for a connection to be released when the pool is full.
+
+        @rtype: L{ArakoonClientConnection}
+        """
+        deadline = time.time() + ArakoonDeadline.remaining( self._config.connection_timeout )
+        with self._condition:
+            while True:
+                self._evictIdle()
+                if len(self._idle) > 0:
+                    connection = self._idle.pop()[0]
+                    return connection
+                if self._size < self._config.getPoolMaxSize():
+                    self._size += 1
+                    generation = self._generation
+                    replacing = self._lost > 0
+                    if replacing:
+                        self._lost -= 1
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ArakoonTimeout( "No connection to %s available in the pool" % self._nodeId )
+                self._condition.wait( remaining )
+
+        try:
+            connection = ArakoonClientConnection( self._config.getNodeLocations( self._nodeId ),
+                                                  self._config.getClusterId(),
+                                                  self._config )
+        except:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+        connection._pool = self
+        connection._generation = generation
+        connection._metrics = self._metrics
+        if replacing and self._metrics is not None:
+            self._metrics.countReconnect()
+        return connection
+
+    def release(self, connection):
+        if connection._inFlight:
+            connection._inFlight = False
+            if self._onOutcome is not None:
+                self._onOutcome( self._nodeId, connection._connected )
+        with self._condition:
+            if connection._connected and connection._generation == self._generation:
+                self._idle.append( (connection, time.time()) )
+            else:
+                self._size -= 1
+                self._lost += 1
+                connection.close()
+            self._evictIdle()
+            self._scheduleEviction()
+            self._condition.notify()
+
+    def close(self):
+        """
+        Close the idle connections. Connections in use are closed when they are released.
+        """
+        with self._condition:
+            self._generation += 1
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._lost += len(idle)
+            self._condition.notify_all()
+        for (connection, _) in idle:
+            connection.close()
+
+    def _scheduleEviction(self):
+        # called with the condition held
+        if self._reaper is not None or len(self._idle) == 0 or \
+           self._size <= self._config.getPoolMinSize():
+            return
+        delay = self._idle[0][1] + self._config.getPoolMaxIdleTime() - time.time()
+        self._reaper = threading.Timer( max(0.0, delay), self._reap )
+        self._reaper.daemon = True
+        self._reaper.start()
+
+    def _reap(self):
+        with self._condition:
+            self._reaper = None
+            self._evictIdle()
+            self._scheduleEviction()
+
+    def _evictIdle(self):
+        # called with the condition held; the idle list is ordered by release time
+        minSize = self._config.getPoolMinSize()
+        limit = time.time() - self._config.getPoolMaxIdleTime()
+        while len(self._idle) > 0 and self._size > minSize and self._idle[0][1] < limit:
+            connection = self._idle.pop(0)[0]
+            self._size -= 1
+            connection.close()
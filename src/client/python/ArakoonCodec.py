@@ -0,0 +1,256 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Transparent compression of the values stored in Arakoon
+"""
+
+import bz2
+import operator
+import zlib
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+
+# values smaller than this many bytes are stored as they are
+ARA_CFG_CODEC_MIN_SIZE = 256
+
+# an encoded value starts with _MAGIC and the id of its codec
+_MAGIC = '\xac\x0d'
+HEADER_SIZE = len(_MAGIC) + 1
+# codec id of a value that is stored as it is, but starts with _MAGIC
+_RAW = 0
+
+
+class ValueCodec(object):
+    """
+    Compression algorithm for values, see L{registerCodec}
+
+    Subclasses set codecId, a number from 1 to 255 that is stored with the
+    values they compressed, and name.
+    """
+    codecId = None
+    name = None
+
+    def compress(self, data):
+        raise NotImplementedError()
+
+    def decompress(self, data):
+        raise NotImplementedError()
+
+
+class ZlibCodec(ValueCodec):
+    codecId = 1
+    name = 'zlib'
+
+    def __init__(self, level = 6):
+        self._level = level
+
+    def compress(self, data):
+        return zlib.compress( data, self._level )
+
+    def decompress(self, data):
+        return zlib.decompress( data )
+
+
+class Bz2Codec(ValueCodec):
+    codecId = 2
+    name = 'bz2'
+
+    def __init__(self, level = 9):
+        self._level = level
+
+    def compress(self, data):
+        return bz2.compress( data, self._level )
+
+    def decompress(self, data):
+        return bz2.decompress( data )
+
+
+_CODECS = dict()
+
+def registerCodec(codec):
+    """
+    Make the values compressed by codec readable.
+
+    The codecs of this module are registered already.
+
+    @type codec: L{ValueCodec}
+    """
+    if not isinstance(codec.codecId, int) or not 0 < codec.codecId < 256:
+        raise ArakoonInvalidArguments( "registerCodec", [("codecId", codec.codecId)] )
+    _CODECS[codec.codecId] = codec
+
+def getCodec(name):
+    """
+    @type name: string
+    @rtype: L{ValueCodec}
+    @return: the registered codec with this name, None if there is none
+    """
+    for codec in _CODECS.itervalues():
+        if codec.name == name:
+            return codec
+    return None
+
+registerCodec( ZlibCodec() )
+registerCodec( Bz2Codec() )
+
+
+def isEncoded(value):
+    """
+    @type value: string
+    @param value: a value, or its first L{HEADER_SIZE} bytes
+    @rtype: bool
+    @return: whether L{decodeValue} changes the value
+    """
+    return len(value) >= HEADER_SIZE and value.startswith( _MAGIC )
+
+def decodeValue(value):
+    """
+    Undo the encoding of a value, see L{ArakoonValueCodec.encode}.
+
+    Values that were not encoded are returned as they are. ArakoonCodecError
+    is raised for a value that looks encoded, but can't be decoded.
+
+    @type value: string option
+    @rtype: string option
+    """
+    if value is None or not isEncoded( value ):
+        return value
+    codecId = ord( value[len(_MAGIC)] )
+    if codecId == _RAW:
+        return value[HEADER_SIZE:]
+    codec = _CODECS.get( codecId )
+    if codec is None:
+        raise ArakoonCodecError( codecId, "the codec is not registered" )
+    try:
+        return codec.decompress( value[HEADER_SIZE:] )
+    except Exception, ex:
+        raise ArakoonCodecError( codecId, "%s: '%s'" % (ex.__class__.__name__, ex) )
+
+
+class ArakoonValueCodec(object):
+
+    def __init__(self, codec, minSize = None):
+        """
+        Encodes the values a client writes with codec, and decodes the values it reads.
+
+        A value that is at least minSize bytes, and that shrinks, is stored compressed
+        behind a header of 3 bytes that names the codec. Other values are stored as
+        they are, so values that were written without a codec read as before.
+        See L{ArakoonClient.setValueCodec}.
+
+        @type codec: L{ValueCodec}
+        @param minSize: defaults to L{ARA_CFG_CODEC_MIN_SIZE}
+        """
+        if minSize is None:
+            minSize = ARA_CFG_CODEC_MIN_SIZE
+        registerCodec( codec )
+        self._codec = codec
+        self._minSize = minSize
+        self._header = _MAGIC + chr( codec.codecId )
+
+    codec = property(operator.attrgetter('_codec'))
+    minSize = property(operator.attrgetter('_minSize'))
+
+    def encode(self, value):
+        """
+        @type value: string option
+        @rtype: string option
+        """
+        if value is None:
+            return None
+        if len(value) >= self._minSize:
+            compressed = self._codec.compress( value )
+            if len(compressed) + HEADER_SIZE < len(value):
+                return self._header + compressed
+        if value.startswith( _MAGIC ):
+            # else it would be taken for an encoded value
+            return _MAGIC + chr( _RAW ) + value
+        return value
+
+    isEncoded = staticmethod( isEncoded )
+    decode = staticmethod( decodeValue )
+
+    def decodeList(self, values):
+        return [ decodeValue(v) for v in values ]
+
+    def decodePairs(self, pairs):
+        return [ (k, decodeValue(v)) for (k, v) in pairs ]
+
+    def encodeUpdate(self, u):
+        """
+        @type u: L{Update}
+        @rtype: L{Update}
+        @return: u, or a copy of it with its values encoded
+        """
+        if isinstance(u, Set):
+            return Set( u.key, self.encode( u.value ) )
+        if isinstance(u, Assert):
+            return Assert( u.key, self.encode( u.value ) )
+        if isinstance(u, Replace):
+            return Replace( u.key, self.encode( u.wanted ) )
+        if isinstance(u, CompactSequence):
+            return self._encodeCompact( u )
+        if isinstance(u, Sequence):
+            seq = Sequence()
+            for update in u.updates:
+                seq.addUpdate( self.encodeUpdate( update ) )
+            return seq
+        return u
+
+    def _encodeCompact(self, u):
+        # the Sets stream from one encoding into the other, their values
+        # compressed on the way; only the other updates become objects
+        seq = CompactSequence()
+        entries = u._entries()
+        other = []
+        encode = self.encode
+        def sets():
+            for entry in entries:
+                if isinstance(entry, tuple):
+                    yield ( entry[0], encode( entry[1] ) )
+                else:
+                    other.append( entry )
+                    return
+        while True:
+            seq.addSets( sets() )
+            if len(other) == 0:
+                return seq
+            seq.addUpdate( self.encodeUpdate( other.pop() ) )
+
+    def decodeUpdate(self, u):
+        """
+        @type u: L{Update}
+        @rtype: L{Update}
+        @return: u, or a copy of it with its values decoded, see L{encodeUpdate}
+        """
+        if isinstance(u, Set):
+            return Set( u.key, decodeValue( u.value ) )
+        if isinstance(u, Assert):
+            return Assert( u.key, decodeValue( u.value ) )
+        if isinstance(u, Replace):
+            return Replace( u.key, decodeValue( u.wanted ) )
+        if isinstance(u, TestAndSet):
+            return TestAndSet( u.key, decodeValue( u.expected ), decodeValue( u.wanted ) )
+        if isinstance(u, Sequence):
+            seq = u.__class__()
+            for update in u.updates:
+                seq.addUpdate( self.decodeUpdate( update ) )
+            return seq
+        return u
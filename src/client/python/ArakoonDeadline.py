@@ -0,0 +1,135 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Time budgets for the calls of the current thread
+"""
+
+import time
+import threading
+import contextlib
+
+from ArakoonExceptions import *
+
+_local = threading.local()
+
+
+class Deadline(object):
+    __slots__ = ('_timeout', '_at')
+
+    def __init__(self, timeout):
+        """
+        The moment a call has to be done by, timeout seconds from now
+
+        @type timeout: float
+        """
+        self._timeout = timeout
+        self._at = time.time() + timeout
+
+    at = property(lambda self: self._at)
+    timeout = property(lambda self: self._timeout)
+
+    def remaining(self):
+        """
+        @rtype: float
+        @return: seconds left, 0 or less when the deadline passed
+        """
+        return self._at - time.time()
+
+    def expired(self, cause = None):
+        """
+        @type cause: Exception
+        @param cause: the last error the call ran into, if any
+        @rtype: L{ArakoonTimeout}
+        @return: the exception for a call that ran out of time
+        """
+        msg = "Call did not complete within its budget of %0.3f sec" % self._timeout
+        if cause is not None:
+            msg += " (last error %s: '%s')" % (cause.__class__.__name__, cause)
+        return ArakoonTimeout( msg )
+
+
+def current():
+    """
+    @rtype: L{Deadline}
+    @return: the deadline of the call the current thread is doing, None if it has none
+    """
+    return getattr( _local, 'deadline', None )
+
+@contextlib.contextmanager
+def deadline(timeout):
+    """
+    Give the calls the current thread does within the block timeout seconds, all in all.
+
+    Within an outer block, the earlier deadline of the two applies.
+
+    @type timeout: float
+    """
+    previous = current()
+    if timeout is None:
+        new = previous
+    else:
+        new = Deadline( timeout )
+        if previous is not None and previous.at <= new.at:
+            new = previous
+    _local.deadline = new
+    try:
+        yield new
+    finally:
+        _local.deadline = previous
+
+def remaining(timeout):
+    """
+    Bound a timeout by the deadline of the current thread.
+
+    ArakoonTimeout is raised when the deadline has passed.
+
+    @type timeout: float
+    @param timeout: seconds, None for no timeout
+    @rtype: float
+    @return: the seconds to wait at most
+    """
+    d = getattr( _local, 'deadline', None )
+    if d is None:
+        return timeout
+    left = d._at - time.time()
+    if left <= 0:
+        raise d.expired()
+    if timeout is None or left < timeout:
+        return left
+    return timeout
+
+def check():
+    """
+    Raise ArakoonTimeout if the deadline of the current thread has passed
+    """
+    d = getattr( _local, 'deadline', None )
+    if d is not None and d._at <= time.time():
+        raise d.expired()
+
+def acquire(lock):
+    """
+    Acquire lock, giving up with ArakoonTimeout at the deadline of the current thread
+    """
+    if current() is None:
+        lock.acquire()
+        return
+    delay = 0.001
+    while not lock.acquire( False ):
+        time.sleep( min( delay, max( 0.0, remaining( None ) ) ) )
+        delay = min( delay * 2, 0.05 )
@@ -59,6 +59,14 @@ class ArakoonNotConnected( ArakoonException ):
         self._msg = ArakoonNotConnected._msgF % ( ips, port )
         ArakoonException.__init__( self, self._msg )
 
+class ArakoonNodeUnavailable( ArakoonNotConnected ):
+    _msgF = "Node %s is skipped until it can be reached again"
+
+    def __init__ (self, nodeId):
+        self.nodeId = nodeId
+        self._msg = ArakoonNodeUnavailable._msgF % nodeId
+        ArakoonException.__init__( self, self._msg )
+
 class ArakoonNoMaster( ArakoonException ):
     _msg = "Could not determine the Arakoon master node"
 
@@ -90,9 +98,56 @@ class ArakoonInconsistentRead( ArakoonException ):
 class ArakoonUserfunctionFailure( ArakoonException ):
     _msg = "User function failed in an unexpected way"
 
+class ArakoonUserHookNotFound( ArakoonException ):
+    _msg = "No user hook is registered under that name"
+
 class ArakoonGoingDown(ArakoonException):
     _msg = "Server is going down"
 
+class ArakoonTimeout( ArakoonException ):
+    _msg = "Operation did not complete in time"
+
+class ArakoonBufferTooSmall( ArakoonException ):
+    _msgF = "Value of %d bytes does not fit in a buffer of %d bytes"
+
+    def __init__ (self, size, capacity):
+        self.size = size
+        self._msg = ArakoonBufferTooSmall._msgF % ( size, capacity )
+        ArakoonException.__init__( self, self._msg )
+
+class ArakoonSequenceTooLarge( ArakoonException ):
+    _msgF = "Sequence of %d bytes exceeds the maximum of %d bytes"
+
+    def __init__ (self, size, maxSize):
+        self.size = size
+        self._msg = ArakoonSequenceTooLarge._msgF % ( size, maxSize )
+        ArakoonException.__init__( self, self._msg )
+
+class ArakoonPartialWrite( ArakoonException ):
+    _msgF = "Only the first %d updates are known to be performed (%s: '%s')"
+
+    def __init__ (self, performed, cause):
+        self.performed = performed
+        self.cause = cause
+        self._msg = ArakoonPartialWrite._msgF % ( performed, cause.__class__.__name__, cause )
+        ArakoonException.__init__( self, self._msg )
+
+class ArakoonCodecError( ArakoonException ):
+    _msgF = "Value encoded with codec %d can not be decoded: %s"
+
+    def __init__ (self, codecId, reason):
+        self.codecId = codecId
+        self._msg = ArakoonCodecError._msgF % ( codecId, reason )
+        ArakoonException.__init__( self, self._msg )
+
+class ArakoonInvalidObject( ArakoonException ):
+    _msgF = "Large object %r can not be read: %s"
+
+    def __init__ (self, name, reason):
+        self.name = name
+        self._msg = ArakoonInvalidObject._msgF % ( name, reason )
+        ArakoonException.__init__( self, self._msg )
+
 class ArakoonSocketException ( ArakoonException ):
     pass
 
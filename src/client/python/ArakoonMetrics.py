@@ -0,0 +1,247 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Latency histograms and wire counters of an Arakoon client
+"""
+
+import math
+import time
+import threading
+
+import ArakoonProtocol
+from ArakoonProtocol import ArakoonClientLogger
+
+# seconds after which a call is logged as slow, None to log no calls
+ARA_CFG_SLOW_CALL_THRESHOLD = None
+
+# every power of two is split in this many buckets, good for about 5% precision
+_SUB_BUCKETS = 16
+
+_COMMAND_NAMES = dict( (value, name[len('ARA_CMD_'):])
+                       for (name, value) in vars(ArakoonProtocol).items()
+                       if name.startswith('ARA_CMD_') and name not in ('ARA_CMD_MAG', 'ARA_CMD_VER') )
+
+
+def commandName(cmd):
+    """
+    @type cmd: int
+    @param cmd: one of the ARA_CMD_* codes
+    @rtype: string
+    @return: the name of the command, e.g. 'GET' for ARA_CMD_GET
+    """
+    return _COMMAND_NAMES.get( cmd, hex(cmd) )
+
+
+def _bucketOf(seconds):
+    if seconds < 1e-6:
+        return 0
+    mantissa, exponent = math.frexp( seconds * 1e6 )
+    return (exponent - 1) * _SUB_BUCKETS + int( (mantissa - 0.5) * 2 * _SUB_BUCKETS )
+
+def _bucketLimit(bucket):
+    # the upper bound of the bucket, in seconds
+    exponent, sub = divmod(bucket + 1, _SUB_BUCKETS)
+    return math.ldexp( 0.5 + sub / (2.0 * _SUB_BUCKETS), exponent + 1 ) * 1e-6
+
+
+class LatencyHistogram(object):
+
+    def __init__(self):
+        """
+        Histogram of latencies in logarithmic buckets, in the style of HdrHistogram.
+
+        Every power of two of microseconds is split in the same number of
+        buckets, so the relative precision is the same for every latency.
+        """
+        self._counts = dict()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, seconds):
+        bucket = _bucketOf( seconds )
+        self._counts[bucket] = self._counts.get( bucket, 0 ) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def copy(self):
+        result = LatencyHistogram()
+        result._counts = self._counts.copy()
+        result.count = self.count
+        result.total = self.total
+        result.min = self.min
+        result.max = self.max
+        return result
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percentile):
+        """
+        @type percentile: float
+        @param percentile: between 0 and 100
+        @rtype: float
+        @return: the latency in seconds that percentile of the calls stayed under,
+        None if nothing was recorded
+        """
+        if self.count == 0:
+            return None
+        wanted = max( 1, int( math.ceil( self.count * percentile / 100.0 ) ) )
+        seen = 0
+        for bucket in sorted( self._counts.iterkeys() ):
+            seen += self._counts[bucket]
+            if seen >= wanted:
+                return min( _bucketLimit(bucket), self.max )
+        return self.max
+
+    def buckets(self):
+        """
+        @rtype: list of pair(float, int)
+        @return: the upper bound in seconds and the count of every bucket that isn't empty
+        """
+        return [ (_bucketLimit(bucket), self._counts[bucket]) for bucket in sorted( self._counts.iterkeys() ) ]
+
+    def summary(self):
+        """
+        @rtype: dict
+        @return: the count, mean, min, max and the usual percentiles, in seconds
+        """
+        return { 'count' : self.count,
+                 'mean' : self.mean(),
+                 'min' : self.min,
+                 'max' : self.max,
+                 'p50' : self.percentile(50),
+                 'p90' : self.percentile(90),
+                 'p99' : self.percentile(99),
+                 'p999' : self.percentile(99.9) }
+
+
+class ArakoonMetrics(object):
+
+    def __init__(self):
+        """
+        Instrumentation of a client: a latency histogram per command, the bytes
+        sent and received, and counters of retries, master discoveries and reconnects.
+
+        Calls that take longer than the slow call threshold are logged as a warning,
+        see L{setSlowCallThreshold}.
+        """
+        self._lock = threading.Lock()
+        self._slowCallThreshold = ARA_CFG_SLOW_CALL_THRESHOLD
+        self._reset()
+
+    def _reset(self):
+        self._latency = dict()
+        self._bytesSent = 0
+        self._bytesReceived = 0
+        self._retries = 0
+        self._masterDiscoveries = 0
+        self._reconnects = 0
+        self._slowCalls = 0
+        self._since = time.time()
+
+    def setSlowCallThreshold(self, seconds):
+        """
+        @type seconds: float
+        @param seconds: calls that take longer are logged, None to log no calls
+        """
+        self._slowCallThreshold = seconds
+
+    def getSlowCallThreshold(self):
+        return self._slowCallThreshold
+
+    def recordCall(self, cmd, nodeId, elapsed, sent, received):
+        """
+        Record a request/reply exchange with a node
+
+        @type cmd: int
+        @param cmd: the ARA_CMD_* code, None if the latency is not to be recorded
+        @type elapsed: float
+        @param elapsed: seconds from sending the request until its reply was decoded
+        @type sent: int
+        @type received: int
+        @param sent, received: bytes that went over the wire
+        """
+        slow = False
+        with self._lock:
+            self._bytesSent += sent
+            self._bytesReceived += received
+            if cmd is not None:
+                histogram = self._latency.get( cmd )
+                if histogram is None:
+                    histogram = LatencyHistogram()
+                    self._latency[cmd] = histogram
+                histogram.record( elapsed )
+                threshold = self._slowCallThreshold
+                if threshold is not None and elapsed > threshold:
+                    self._slowCalls += 1
+                    slow = True
+        if slow:
+            ArakoonClientLogger.logWarning( "%s on %s took %2.2f s", commandName(cmd), nodeId, elapsed )
+
+    def countRetry(self):
+        with self._lock:
+            self._retries += 1
+
+    def countMasterDiscovery(self):
+        with self._lock:
+            self._masterDiscoveries += 1
+
+    def countReconnect(self):
+        with self._lock:
+            self._reconnects += 1
+
+    def snapshot(self, reset = False):
+        """
+        Retrieve the metrics recorded since they were last reset
+
+        @type reset: bool
+        @param reset: start over after taking the snapshot
+        @rtype: dict
+        @return: the copied L{LatencyHistogram} of every command under 'latency',
+        keyed by ARA_CMD_* code, and the counters 'bytesSent', 'bytesReceived',
+        'retries', 'masterDiscoveries', 'reconnects' and 'slowCalls'. 'period' holds
+        the seconds the snapshot covers.
+        """
+        with self._lock:
+            result = { 'latency' : dict( (cmd, h.copy()) for (cmd, h) in self._latency.iteritems() ),
+                       'bytesSent' : self._bytesSent,
+                       'bytesReceived' : self._bytesReceived,
+                       'retries' : self._retries,
+                       'masterDiscoveries' : self._masterDiscoveries,
+                       'reconnects' : self._reconnects,
+                       'slowCalls' : self._slowCalls,
+                       'period' : time.time() - self._since }
+            if reset:
+                self._reset()
+            return result
+
+    def reset(self):
+        """
+        Drop everything recorded so far
+        """
+        with self._lock:
+            self._reset()
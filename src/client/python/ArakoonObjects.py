@@ -0,0 +1,311 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Large objects, stored as chunks under a manifest
+"""
+
+import os
+import sys
+import zlib
+import struct
+import operator
+import threading
+import collections
+
+from ArakoonProtocol import *
+from ArakoonProtocol import _packString, _packInt, _packInt64, _unpackString, _unpackInt, _unpackInt64
+from ArakoonExceptions import *
+from ArakoonBulkLoader import ArakoonBulkLoader
+
+# size of the chunks an object is split in
+ARA_CFG_OBJECT_CHUNK_SIZE = 1024 * 1024
+# chunks fetched concurrently when an object is read
+ARA_CFG_OBJECT_FETCH_THREADS = 4
+# the keys of the chunks start with this, followed by the name of the object
+ARA_CFG_OBJECT_CHUNK_PREFIX = '@chunk/'
+
+_MANIFEST_MAGIC = 'ArakoonObject/1'
+# room for the sequence header and the key, on top of the chunk
+_CHUNK_OVERHEAD = 64
+
+
+def _chunkPrefix(name, version):
+    return '%s%s\x00%s\x00' % (ARA_CFG_OBJECT_CHUNK_PREFIX, name, version)
+
+
+class ObjectManifest(object):
+
+    def __init__(self, name, version, size, chunkSize, checksums):
+        """
+        What is stored under the name of an object: where its chunks are, and their checksums
+
+        @type name: string
+        @type version: string
+        @param version: random, so the chunks of every put get keys of their own
+        @type size: int
+        @type chunkSize: int
+        @type checksums: list of int
+        @param checksums: the crc32 of every chunk
+        """
+        self._name = name
+        self._version = version
+        self._size = size
+        self._chunkSize = chunkSize
+        self._checksums = checksums
+
+    name = property(operator.attrgetter('_name'))
+    version = property(operator.attrgetter('_version'))
+    size = property(operator.attrgetter('_size'))
+    chunkSize = property(operator.attrgetter('_chunkSize'))
+
+    def __len__(self):
+        return len(self._checksums)
+
+    def chunkPrefix(self):
+        return _chunkPrefix( self._name, self._version )
+
+    def chunkKey(self, index):
+        return '%s%08d' % (self.chunkPrefix(), index)
+
+    def checkChunk(self, index, chunk):
+        if zlib.crc32( chunk ) & 0xffffffff != self._checksums[index]:
+            raise ArakoonInvalidObject( self._name, "chunk %d is corrupt" % index )
+
+    def encode(self):
+        r = [ _packString( _MANIFEST_MAGIC ),
+              _packString( self._version ),
+              _packInt64( self._size ),
+              _packInt( self._chunkSize ),
+              _packInt( len(self._checksums) ) ]
+        r.extend( _packInt(c) for c in self._checksums )
+        return ''.join(r)
+
+    @staticmethod
+    def decode(name, value):
+        """
+        @rtype: L{ObjectManifest}
+        @return: the manifest, ArakoonInvalidObject is raised if value is not one
+        """
+        if value is None:
+            raise ArakoonInvalidObject( name, "it has no manifest" )
+        try:
+            magic, offset = _unpackString( value, 0 )
+            if magic != _MANIFEST_MAGIC:
+                raise ArakoonInvalidObject( name, "it has no manifest" )
+            version, offset = _unpackString( value, offset )
+            size, offset = _unpackInt64( value, offset )
+            chunkSize, offset = _unpackInt( value, offset )
+            count, offset = _unpackInt( value, offset )
+            checksums = []
+            for i in xrange(count):
+                checksum, offset = _unpackInt( value, offset )
+                checksums.append( checksum )
+        except struct.error:
+            raise ArakoonInvalidObject( name, "it has no manifest" )
+        return ObjectManifest( name, version, size, chunkSize, checksums )
+
+
+def _split(data, chunkSize):
+    if isinstance(data, str):
+        for offset in xrange(0, len(data), chunkSize):
+            yield data[offset:offset + chunkSize]
+        return
+    while True:
+        chunk = data.read( chunkSize )
+        if not chunk:
+            return
+        yield chunk
+
+def putObject(client, name, data, chunkSize = None):
+    """
+    See L{ArakoonClient.putObject}
+    """
+    if chunkSize is None:
+        chunkSize = ARA_CFG_OBJECT_CHUNK_SIZE
+    if chunkSize <= 0 or not (isinstance(data, str) or hasattr(data, 'read')):
+        raise ArakoonInvalidArguments( "putObject", [("data", type(data)), ("chunkSize", chunkSize)] )
+    version = os.urandom(8).encode('hex')
+    prefix = _chunkPrefix( name, version )
+    checksums = []
+    sizes = []
+    def chunks():
+        for chunk in _split( data, chunkSize ):
+            checksums.append( zlib.crc32( chunk ) & 0xffffffff )
+            sizes.append( len(chunk) )
+            yield ( '%s%08d' % (prefix, len(sizes) - 1), chunk )
+
+    # a sequence per chunk, several of them in flight on different connections
+    loader = ArakoonBulkLoader( client, maxBatchBytes = chunkSize + len(prefix) + _CHUNK_OVERHEAD )
+    try:
+        loader.load( chunks() )
+    except:
+        excInfo = sys.exc_info()
+        try:
+            client.deletePrefix( prefix )
+        except ArakoonException, ex:
+            ArakoonClientLogger.logWarning( "Could not remove the chunks of %r (%s: '%s')",
+                                            name, ex.__class__.__name__, ex )
+        raise excInfo[0], excInfo[1], excInfo[2]
+
+    manifest = ObjectManifest( name, version, sum(sizes), chunkSize, checksums )
+    # the object is replaced atomically, the chunks of the former one are orphans after
+    old = client.replace( name, manifest.encode() )
+    _dropChunks( client, name, old )
+    return manifest.size
+
+def _dropChunks(client, name, value):
+    if value is None:
+        return
+    try:
+        prefix = ObjectManifest.decode( name, value ).chunkPrefix()
+    except ArakoonInvalidObject:
+        return
+    try:
+        client.deletePrefix( prefix )
+    except ArakoonException, ex:
+        ArakoonClientLogger.logWarning( "Could not remove the chunks of the former %r (%s: '%s')",
+                                        name, ex.__class__.__name__, ex )
+
+def deleteObject(client, name):
+    """
+    See L{ArakoonClient.deleteObject}
+    """
+    while True:
+        value = client.get( name )
+        ObjectManifest.decode( name, value )
+        # only remove the manifest that was read, it may be replaced meanwhile
+        if client.testAndSet( name, value, None ) == value:
+            break
+    _dropChunks( client, name, value )
+
+
+class _ChunkFetch(threading.Thread):
+    def __init__(self, client, manifest, index):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._client = client
+        self._manifest = manifest
+        self._index = index
+        self._chunk = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._chunk = self._client.get( self._manifest.chunkKey( self._index ) )
+        except:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        self.join()
+        if self._exc_info is not None:
+            if isinstance(self._exc_info[1], ArakoonNotFound):
+                raise ArakoonInvalidObject( self._manifest.name,
+                    "chunk %d is missing, the object was replaced or deleted meanwhile" % self._index )
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        self._manifest.checkChunk( self._index, self._chunk )
+        return self._chunk
+
+
+class ArakoonObjectReader(object):
+
+    def __init__(self, client, manifest, threads = None):
+        """
+        File-like reader of a large object.
+
+        The next chunks are fetched ahead, each on a connection of its own.
+        Use L{ArakoonClient.openObject} to create one.
+
+        @type client: L{ArakoonClient}
+        @type manifest: L{ObjectManifest}
+        @param threads: chunks fetched ahead, defaults to L{ARA_CFG_OBJECT_FETCH_THREADS}
+        """
+        if threads is None:
+            threads = ARA_CFG_OBJECT_FETCH_THREADS
+        self._client = client
+        self._manifest = manifest
+        self._window = max( 1, threads )
+        self._fetches = collections.deque()
+        self._next = 0
+        self._chunk = ''
+        self._offset = 0
+        self._position = 0
+        self.closed = False
+
+    size = property(lambda self: self._manifest.size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def __iter__(self):
+        while True:
+            data = self.read( self._manifest.chunkSize )
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.closed = True
+        self._fetches.clear()
+        self._chunk = ''
+        self._offset = 0
+
+    def tell(self):
+        return self._position
+
+    def _nextChunk(self):
+        if self.closed:
+            raise ValueError( "I/O operation on closed object reader" )
+        while len(self._fetches) < self._window and self._next < len(self._manifest):
+            self._fetches.append( _ChunkFetch( self._client, self._manifest, self._next ) )
+            self._next += 1
+        if len(self._fetches) == 0:
+            return None
+        return self._fetches.popleft().result()
+
+    def read(self, n = -1):
+        """
+        @type n: int
+        @param n: the number of bytes to read, all that are left if negative
+        @rtype: string
+        @return: at most n bytes, an empty string at the end of the object
+        """
+        parts = []
+        wanted = n
+        while wanted != 0:
+            if self._offset == len(self._chunk):
+                chunk = self._nextChunk()
+                if chunk is None:
+                    break
+                self._chunk = chunk
+                self._offset = 0
+            if wanted < 0:
+                part = self._chunk[self._offset:]
+            else:
+                part = self._chunk[self._offset:self._offset + wanted]
+                wanted -= len(part)
+            self._offset += len(part)
+            parts.append( part )
+        result = ''.join( parts )
+        self._position += len(result)
+        return result
@@ -0,0 +1,229 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Request pipelining for the Arakoon client
+"""
+
+from ArakoonProtocol import ArakoonProtocol, Delete, DeletePrefix, UserFunction
+from ArakoonExceptions import *
+from ArakoonValidators import SignatureValidator
+
+
+class ArakoonPipeline :
+
+    def __init__ (self, client):
+        """
+        Queue of requests that are sent to the master in one go.
+
+        Use L{ArakoonClient.pipeline} to create one. Every request method queues
+        an encoded request and returns immediately; L{execute} writes them all
+        to the master and decodes the replies in order. e.g. ::
+            p = client.pipeline()
+            p.set('foo', 'bar')
+            p.get('foo')
+            p.get('missing')
+            results = p.execute() # [None, 'bar', ArakoonNotFound(...)]
+
+        @type client: L{ArakoonClient}
+        """
+        self._client = client
+        self._requests = []
+
+    def __len__(self):
+        return len(self._requests)
+
+    def _queue(self, msg, decode, update = None, undo = None):
+        # update: what the read cache drops once the request is performed
+        # undo: takes the value codec off the result
+        if undo is not None:
+            read = decode
+            decode = lambda conn: undo( read(conn) )
+        self._requests.append( (msg, decode, update) )
+
+    def execute(self):
+        """
+        Send all queued requests to the master and collect the replies.
+
+        Errors are returned in place of the result of the request that caused them.
+        If the connection breaks or the call runs out of time, that exception is
+        returned for every request that did not get a reply: those updates might
+        or might not have been performed.
+
+        @rtype: list
+        @return: the result or exception of every queued request, in order
+        """
+        requests = self._requests
+        self._requests = []
+        if len(requests) == 0:
+            return []
+
+        msg = ''.join( r[0] for r in requests )
+        masterId = self._client._determineMaster()
+        conn = self._client._sendMessage( masterId, msg, pipelined = True )
+
+        results = []
+        refused = set()
+        try:
+            for (_, decode, _) in requests:
+                try:
+                    results.append( decode(conn) )
+                except ArakoonSocketException, ex:
+                    conn.close()
+                    self._client._forgetMaster( masterId )
+                    results.extend( [ex] * (len(requests) - len(results)) )
+                    break
+                except ArakoonTimeout, ex:
+                    # the replies left can't be told apart from the rest of this one
+                    conn.abandon()
+                    results.extend( [ex] * (len(requests) - len(results)) )
+                    break
+                except ArakoonException, ex:
+                    if isinstance(ex, (ArakoonNodeNotMaster, ArakoonNodeNoLongerMaster)):
+                        self._client._forgetMaster( masterId )
+                    refused.add( len(results) )
+                    results.append(ex)
+        except:
+            conn.close()
+            raise
+        finally:
+            conn.release()
+            cache = self._client._readCache
+            if cache is not None:
+                # an update the master refused wasn't performed, any other might have been
+                cache.invalidate( [ r[2] for (i, r) in enumerate(requests)
+                                    if r[2] is not None and i not in refused ] )
+            self._client._wrote()
+        return results
+
+    @SignatureValidator( 'string' )
+    def exists(self, key):
+        msg = ArakoonProtocol.encodeExists(key, self._client._consistency)
+        self._queue(msg, ArakoonProtocol.decodeBoolResult)
+
+    @SignatureValidator( 'string' )
+    def get(self, key):
+        msg = ArakoonProtocol.encodeGet(key, self._client._consistency)
+        codec = self._client._valueCodec
+        self._queue(msg, ArakoonProtocol.decodeStringResult, undo = codec and codec.decode)
+
+    def multiGet(self, keys):
+        msg = ArakoonProtocol.encodeMultiGet(keys, self._client._consistency)
+        codec = self._client._valueCodec
+        self._queue(msg, ArakoonProtocol.decodeStringListResult, undo = codec and codec.decodeList)
+
+    def multiGetOption(self, keys):
+        msg = ArakoonProtocol.encodeMultiGetOption(keys, self._client._consistency)
+        codec = self._client._valueCodec
+        self._queue(msg, ArakoonProtocol.decodeStringOptionArrayResult, undo = codec and codec.decodeList)
+
+    @SignatureValidator( 'string', 'string' )
+    def set(self, key, value):
+        codec = self._client._valueCodec
+        if codec is not None:
+            value = codec.encode(value)
+        self._queue(ArakoonProtocol.encodeSet(key, value), ArakoonProtocol.decodeVoidResult, Delete(key))
+
+    @SignatureValidator( 'string', 'string' )
+    def confirm(self, key, value):
+        codec = self._client._valueCodec
+        if codec is not None:
+            value = codec.encode(value)
+        self._queue(ArakoonProtocol.encodeConfirm(key, value), ArakoonProtocol.decodeVoidResult, Delete(key))
+
+    @SignatureValidator( 'string' )
+    def delete(self, key):
+        self._queue(ArakoonProtocol.encodeDelete(key), ArakoonProtocol.decodeVoidResult, Delete(key))
+
+    @SignatureValidator( 'string' )
+    def deletePrefix(self, prefix):
+        self._queue(ArakoonProtocol.encodeDeletePrefix(prefix), ArakoonProtocol.decodeIntResult,
+                    DeletePrefix(prefix))
+
+    @SignatureValidator( 'sequence', 'bool' )
+    def sequence(self, seq, sync = False):
+        codec = self._client._valueCodec
+        encoded = seq
+        if codec is not None:
+            encoded = codec.encodeUpdate(seq)
+        self._queue(ArakoonProtocol.encodeSequence(encoded, sync), ArakoonProtocol.decodeVoidResult, seq)
+
+    @SignatureValidator( 'string', 'string_option', 'string_option' )
+    def testAndSet(self, key, oldValue, newValue):
+        codec = self._client._valueCodec
+        if codec is not None:
+            oldValue = codec.encode(oldValue)
+            newValue = codec.encode(newValue)
+        msg = ArakoonProtocol.encodeTestAndSet(key, oldValue, newValue)
+        self._queue(msg, ArakoonProtocol.decodeStringOptionResult, Delete(key),
+                    undo = codec and codec.decode)
+
+    @SignatureValidator( 'string', 'string_option' )
+    def replace(self, key, wanted):
+        codec = self._client._valueCodec
+        if codec is not None:
+            wanted = codec.encode(wanted)
+        msg = ArakoonProtocol.encodeReplace(key, wanted)
+        self._queue(msg, ArakoonProtocol.decodeStringOptionResult, Delete(key),
+                    undo = codec and codec.decode)
+
+    @SignatureValidator( 'string', 'string_option' )
+    def aSSert(self, key, vo):
+        codec = self._client._valueCodec
+        if codec is not None:
+            vo = codec.encode(vo)
+        msg = ArakoonProtocol.encodeAssert(key, vo, self._client._consistency)
+        self._queue(msg, ArakoonProtocol.decodeVoidResult)
+
+    @SignatureValidator( 'string' )
+    def aSSert_exists(self, key):
+        msg = ArakoonProtocol.encodeAssertExists(key, self._client._consistency)
+        self._queue(msg, ArakoonProtocol.decodeVoidResult)
+
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int' )
+    def range(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeRange(beginKey, beginKeyIncluded, endKey,
+                                          endKeyIncluded, maxElements, self._client._consistency)
+        self._queue(msg, ArakoonProtocol.decodeStringListResult)
+
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int' )
+    def range_entries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeRangeEntries(beginKey, beginKeyIncluded, endKey,
+                                                 endKeyIncluded, maxElements, self._client._consistency)
+        codec = self._client._valueCodec
+        self._queue(msg, ArakoonProtocol.decodeStringPairListResult, undo = codec and codec.decodePairs)
+
+    @SignatureValidator( 'string_option', 'bool', 'string_option', 'bool', 'int' )
+    def rev_range_entries(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        msg = ArakoonProtocol.encodeReverseRangeEntries(beginKey, beginKeyIncluded, endKey,
+                                                        endKeyIncluded, maxElements, self._client._consistency)
+        codec = self._client._valueCodec
+        self._queue(msg, ArakoonProtocol.decodeStringPairListResult, undo = codec and codec.decodePairs)
+
+    @SignatureValidator( 'string', 'int' )
+    def prefix(self, keyPrefix, maxElements = 1000):
+        msg = ArakoonProtocol.encodePrefixKeys(keyPrefix, maxElements, self._client._consistency)
+        self._queue(msg, ArakoonProtocol.decodeStringListResult)
+
+    def nop(self):
+        self._queue(ArakoonProtocol.encodeNOP(), ArakoonProtocol.decodeVoidResult)
+
+    @SignatureValidator( 'string', 'string_option' )
+    def userFunction(self, name, argument):
+        msg = ArakoonProtocol.encodeUserFunction(name, argument)
+        self._queue(msg, ArakoonProtocol.decodeStringOptionResult, UserFunction(name, argument))
@@ -24,12 +24,9 @@ from ArakoonValidators import SignatureValidator
 from NurseryRouting import RoutingInfo
 
 import os.path
-import ssl
 import struct
 import logging
-import select
 import operator
-import cStringIO
 import types
 
 FILTER = ''.join([(len(repr(chr(x)))==3) and chr(x) or '.' for x in range(256)])
@@ -38,11 +35,20 @@ ARA_CFG_TRY_CNT = 1
 ARA_CFG_CONN_TIMEOUT = 60
 ARA_CFG_CONN_BACKOFF = 5
 ARA_CFG_NO_MASTER_RETRY = 60
+ARA_CFG_READ_BUFFER_SIZE = 64 * 1024
+ARA_CFG_POOL_MIN_SIZE = 1
+ARA_CFG_POOL_MAX_SIZE = 16
+ARA_CFG_POOL_MAX_IDLE_TIME = 60
+ARA_CFG_TRUSTED_CALLER = False
+ARA_CFG_MAX_SEQUENCE_SIZE = 8 * 1024 * 1024
 
 class ArakoonClientConfig :
 
     def __init__ (self, clusterId, nodes,
-        tls=False, tls_ca_cert=None, tls_cert=None):
+        tls=False, tls_ca_cert=None, tls_cert=None,
+        pool_min_size=None, pool_max_size=None, pool_max_idle_time=None,
+        connection_timeout=None, backoff_interval=None, no_master_retry_period=None,
+        call_timeout=None):
         """
         Constructor of an ArakoonClientConfig object
 
@@ -78,6 +84,30 @@ class ArakoonClientConfig :
             These should be passed as a tuple. When provided, `tls_ca_cert`
             *must* be provided as well, otherwise a `ValueError` will be raised.
         @type tls_cert: `(str, str)`
+
+        @param pool_min_size: Number of idle connections per node that are never closed
+            Defaults to L{ARA_CFG_POOL_MIN_SIZE}
+        @type pool_min_size: `int`
+        @param pool_max_size: Maximum number of connections per node
+            Defaults to L{ARA_CFG_POOL_MAX_SIZE}
+        @type pool_max_size: `int`
+        @param pool_max_idle_time: Seconds after which an idle connection is closed
+            Defaults to L{ARA_CFG_POOL_MAX_IDLE_TIME}
+        @type pool_max_idle_time: `int`
+
+        @param connection_timeout: Seconds to wait for a connection, or for data on one
+            Defaults to L{ARA_CFG_CONN_TIMEOUT}
+        @type connection_timeout: `float`
+        @param backoff_interval: Seconds a retry waits at most, times the number of attempts done
+            Defaults to L{ARA_CFG_CONN_BACKOFF}
+        @type backoff_interval: `float`
+        @param no_master_retry_period: Seconds a call is retried while there is no master
+            Defaults to L{ARA_CFG_NO_MASTER_RETRY}
+        @type no_master_retry_period: `float`
+        @param call_timeout: Seconds a call of the client takes at most, retries included
+            None or 0, the default, leaves calls unbounded but by the settings above.
+            See L{ArakoonClient.deadline} to bound a single call.
+        @type call_timeout: `float`
         """
         self._clusterId = clusterId
         self._nodes = self._cleanUp(nodes)
@@ -101,9 +131,45 @@ class ArakoonClientConfig :
         self._tls_ca_cert = tls_ca_cert
         self._tls_cert = tls_cert
 
+        if pool_max_size is not None and pool_max_size < 1:
+            raise ValueError('pool_max_size must be at least 1')
+        self._pool_min_size = pool_min_size
+        self._pool_max_size = pool_max_size
+        self._pool_max_idle_time = pool_max_idle_time
+
+        for (name, value) in (('connection_timeout', connection_timeout),
+                              ('backoff_interval', backoff_interval),
+                              ('no_master_retry_period', no_master_retry_period),
+                              ('call_timeout', call_timeout)):
+            if value is not None and value < 0:
+                raise ValueError('%s must not be negative' % name)
+        self._connection_timeout = connection_timeout
+        self._backoff_interval = backoff_interval
+        self._no_master_retry_period = no_master_retry_period
+        self._call_timeout = call_timeout
+
     tls = property(operator.attrgetter('_tls'))
     tls_ca_cert = property(operator.attrgetter('_tls_ca_cert'))
     tls_cert = property(operator.attrgetter('_tls_cert'))
+    call_timeout = property(operator.attrgetter('_call_timeout'))
+
+    @property
+    def connection_timeout(self):
+        if self._connection_timeout is None:
+            return ArakoonClientConfig.getConnectionTimeout()
+        return self._connection_timeout
+
+    @property
+    def backoff_interval(self):
+        if self._backoff_interval is None:
+            return ArakoonClientConfig.getBackoffInterval()
+        return self._backoff_interval
+
+    @property
+    def no_master_retry_period(self):
+        if self._no_master_retry_period is None:
+            return ArakoonClientConfig.getNoMasterRetryPeriod()
+        return self._no_master_retry_period
 
     def _cleanUp(self, nodes):
         for k in nodes.keys():
@@ -167,6 +233,36 @@ class ArakoonClientConfig :
         return ARA_CFG_TRY_CNT
 
 
+    def getPoolMinSize(self):
+        """
+        Retrieve the number of idle connections per node that are kept open
+
+        @rtype: integer
+        """
+        if self._pool_min_size is None:
+            return ARA_CFG_POOL_MIN_SIZE
+        return self._pool_min_size
+
+    def getPoolMaxSize(self):
+        """
+        Retrieve the maximum number of connections per node
+
+        @rtype: integer
+        """
+        if self._pool_max_size is None:
+            return ARA_CFG_POOL_MAX_SIZE
+        return self._pool_max_size
+
+    def getPoolMaxIdleTime(self):
+        """
+        Retrieve the number of seconds after which an idle connection is closed
+
+        @rtype: integer
+        """
+        if self._pool_max_idle_time is None:
+            return ARA_CFG_POOL_MAX_IDLE_TIME
+        return self._pool_max_idle_time
+
     def getNodes(self):
         """
         Retrieve the dictionary with node locations
@@ -204,6 +300,45 @@ class ArakoonClientConfig :
         """
         return ARA_CFG_CONN_BACKOFF
 
+    @staticmethod
+    def getReadBufferSize():
+        """
+        Retrieve the initial size of the per connection read buffer
+
+        Replies are received into this buffer with as few recv calls as possible.
+        It grows to fit larger replies.
+        Can be controlled by changing the global variable L{ARA_CFG_READ_BUFFER_SIZE}
+
+        @rtype: integer
+        @return: Returns the read buffer size in bytes
+        """
+        return ARA_CFG_READ_BUFFER_SIZE
+
+    @staticmethod
+    def getMaxSequenceSize():
+        """
+        Retrieve the size in bytes a sequence is split at by L{ArakoonClient.bulkWrite}
+
+        It has to stay well below the max_buffer_size of the server nodes.
+        Can be controlled by changing the global variable L{ARA_CFG_MAX_SEQUENCE_SIZE}
+
+        @rtype: integer
+        """
+        return ARA_CFG_MAX_SEQUENCE_SIZE
+
+    @staticmethod
+    def isTrustedCaller():
+        """
+        Whether the types of the arguments of the client methods are left unchecked
+
+        A trusted caller always passes arguments of the documented types. Passing
+        anything else then fails in the encoding of the request, or worse.
+        Can be controlled by changing the global variable L{ARA_CFG_TRUSTED_CALLER}
+
+        @rtype: bool
+        """
+        return ARA_CFG_TRUSTED_CALLER
+
     def getClusterId(self):
         return self._clusterId
 
@@ -242,6 +377,13 @@ ARA_TYPE_INT64_SIZE = 8
 ARA_TYPE_INT_SIZE = 4
 ARA_TYPE_BOOL_SIZE = 1
 
+_INT   = struct.Struct("I")
+_SIGNED_INT = struct.Struct("i")
+_INT64 = struct.Struct("q")
+_BOOL  = struct.Struct("?")
+_FLOAT = struct.Struct("d")
+_INT_PAIR = struct.Struct("II")
+
 # Magic used to mask each command
 ARA_CMD_MAG    = 0xb1ff0000
 ARA_CMD_VER    = 0x00000001
@@ -293,8 +435,10 @@ ARA_CMD_CURRENT_STATE            = 0x00000032 | ARA_CMD_MAG
 
 
 ARA_CMD_REPLACE                  = 0x00000033 | ARA_CMD_MAG
+ARA_CMD_LAST_ENTRIES2            = 0x00000040 | ARA_CMD_MAG
 ARA_CMD_NOP                      = 0x00000041 | ARA_CMD_MAG
 ARA_CMD_GET_TXID                 = 0x00000043 | ARA_CMD_MAG
+ARA_CMD_USER_HOOK                = 0x00000045 | ARA_CMD_MAG
 
 # Arakoon error codes
 # Success
@@ -316,6 +460,7 @@ ARA_ERR_NO_LONGER_MASTER    = 0x21
 ARA_ERR_BAD_INPUT           = 0x26
 ARA_ERR_INCONSISTENT_READ   = 0x80
 ARA_ERR_USERFUNCTION_FAILURE= 0x81
+ARA_ERR_USERHOOK_NOT_FOUND  = 0x82
 
 NAMED_FIELD_TYPE_INT    = 1
 NAMED_FIELD_TYPE_INT64  = 2
@@ -324,8 +469,7 @@ NAMED_FIELD_TYPE_STRING = 4
 NAMED_FIELD_TYPE_LIST   = 5
 
 def _packString( toPack ):
-    toPackLength = len( toPack )
-    return struct.pack("I%ds" % ( toPackLength), toPackLength, toPack )
+    return _INT.pack( len( toPack ) ) + toPack
 
 def _packStringOption ( toPack = None ):
     if toPack is None:
@@ -334,16 +478,31 @@ def _packStringOption ( toPack = None ):
         return _packBool ( 1 ) + _packString (toPack)
 
 def _packInt ( toPack ):
-    return struct.pack( "I", toPack )
+    return _INT.pack( toPack )
 
 def _packInt64 ( toPack ):
-    return struct.pack( "q", toPack )
+    return _INT64.pack( toPack )
 
 def _packSignedInt ( toPack ):
-    return struct.pack( "i", toPack )
+    return _SIGNED_INT.pack( toPack )
 
 def _packBool ( toPack) :
-    return struct.pack( "?", toPack)
+    return _BOOL.pack( toPack )
+
+class _ByteWriter(object):
+    """
+    File like object appending to a bytearray, for Update.write
+    """
+    def __init__(self, buf):
+        self.write = buf.extend
+
+def _writeStringList( buf, strings ):
+    pack = _INT.pack
+    write = buf.extend
+    write( pack( len( strings ) ) )
+    for s in strings:
+        write( pack( len( s ) ) )
+        write( s )
 
 def sendPrologue(socket, clusterId):
     p  = _packInt(ARA_CMD_MAG)
@@ -352,59 +511,60 @@ def sendPrologue(socket, clusterId):
     socket.sendall(p)
 
 def _readExactNBytes( con, n ):
-
-    if not con._connected :
-        raise ArakoonSockRecvClosed()
-    bytesRemaining = n
-    tmpResult = ""
-    timeout = ArakoonClientConfig.getConnectionTimeout()
-
-    if isinstance(con._socket, ssl.SSLSocket):
-        s = con._socket
-        pending = s.pending()
-        if pending > 0:
-            tmpResult = s.recv(min(n, pending))
-            bytesRemaining = bytesRemaining - len(tmpResult)
-
-    while bytesRemaining > 0 :
-
-        tripleList = select.select(  [con._socket] , [] , [] , timeout )
-
-        if ( len ( tripleList [0]) != 0 ) :
-            newChunk = ""
-            try :
-                newChunk =  tripleList [0][0].recv ( bytesRemaining)
-            except Exception, ex:
-                ArakoonClientLogger.logError ("Error while receiving from socket. %s: '%s'" % (ex.__class__.__name__, ex) )
-                con._connected = False
-                raise ArakoonSockRecvError()
-
-            newChunkSize = len( newChunk )
-            if newChunkSize == 0 :
-                try:
-                    con._socket.close()
-                except Exception, ex:
-                    ArakoonClientLogger.logError( "Error while closing socket. %s: %s" % (ex.__class__.__name__,ex))
-                con._connected = False
-                raise ArakoonSockReadNoBytes ()
-            tmpResult = tmpResult + newChunk
-            bytesRemaining = bytesRemaining - newChunkSize
-
-        else :
-            msg = str(con._socketInfo)
-            try:
-                con._socket.close()
-            except Exception, ex:
-                ArakoonClientLogger.logError( "Error while closing socket. %s: %s" % (ex.__class__.__name__,ex))
-            con._connected = False
-            raise ArakoonSockNotReadable(msg = msg)
-
-    return tmpResult
+    offset = con.consume( n )
+    return con._readView[offset:offset + n].tobytes()
 
 def _recvString ( con ):
     strLength = _recvInt( con )
-    buf = _readExactNBytes( con, strLength)
-    return struct.unpack( "%ds" % strLength, buf ) [0]
+    return _readExactNBytes( con, strLength )
+
+def _recvStringInto ( con, buffer ):
+    """
+    Receive a string straight into buffer, or into a new bytearray if buffer is None.
+
+    @rtype: memoryview
+    @return: the part of the buffer holding the string
+    """
+    size = _recvInt( con )
+    if buffer is None :
+        buffer = bytearray( size )
+    target = memoryview( buffer )
+    if len( target ) < size :
+        # leave the connection usable for the next request
+        con.skip( size )
+        raise ArakoonBufferTooSmall( size, len( target ) )
+    target = target[:size]
+    con.readInto( target )
+    return target
+
+def _recvStrings ( con, count ):
+    """
+    Receive count consecutive strings, in the order they are on the wire.
+
+    Strings that are entirely in the read buffer are unpacked in one go,
+    the buffer is only refilled when the next string is incomplete.
+    """
+    result = [None] * count
+    unpackInt = _INT.unpack_from
+    i = 0
+    while i < count :
+        buf = con._readBuffer
+        view = con._readView
+        start = con._readStart
+        end = con._readEnd
+        while i < count and start + ARA_TYPE_INT_SIZE <= end :
+            first = start + ARA_TYPE_INT_SIZE
+            last = first + unpackInt( buf, start )[0]
+            if last > end :
+                break
+            result[i] = view[first:last].tobytes()
+            start = last
+            i += 1
+        con._readStart = start
+        if i < count :
+            result[i] = _recvString( con )
+            i += 1
+    return result
 
 def _unpackInt(buf, offset):
     r=struct.unpack_from( "I", buf,offset)
@@ -423,6 +583,12 @@ def _unpackString(buf, offset):
     v = buf[o2:o2 + size]
     return v, o2+size
 
+def _unpackStringOption(buf, offset):
+    isSet, offset = _unpackBool(buf, offset)
+    if isSet:
+        return _unpackString(buf, offset)
+    return None, offset
+
 def _unpackStringList(buf, offset):
     size,offset = _unpackInt(buf, offset)
     retVal = []
@@ -460,32 +626,32 @@ def _unpackNamedField(buf, offset):
     raise ArakoonException("Cannot decode named field %s. Invalid type: %d" % (name,type) )
 
 def _recvInt ( con ):
-    buf = _readExactNBytes ( con, ARA_TYPE_INT_SIZE )
-    i,o2 = _unpackInt(buf,0)
-    return i
+    offset = con.consume( ARA_TYPE_INT_SIZE )
+    return _INT.unpack_from( con._readBuffer, offset )[0]
+
+def _recvSignedInt ( con ):
+    offset = con.consume( ARA_TYPE_INT_SIZE )
+    return _SIGNED_INT.unpack_from( con._readBuffer, offset )[0]
 
 def _recvInt64 ( con ):
-    buf = _readExactNBytes( con, ARA_TYPE_INT64_SIZE )
-    i,o2 = _unpackInt64(buf,0)
-    return i
+    offset = con.consume( ARA_TYPE_INT64_SIZE )
+    return _INT64.unpack_from( con._readBuffer, offset )[0]
 
 def _unpackBool(buf, offset):
     r = struct.unpack_from( "?", buf, offset) [0]
     return r, offset+1
 
 def _recvBool ( con ):
-    buf = _readExactNBytes( con, 1 )
-    b, o2 = _unpackBool(buf,0)
-    return b
+    offset = con.consume( ARA_TYPE_BOOL_SIZE )
+    return _BOOL.unpack_from( con._readBuffer, offset )[0]
 
 def _unpackFloat(buf, offset):
     r = struct.unpack_from("d", buf, offset)
     return r[0], offset+8
 
-def _recvFloat(buf):
-    buf = _readExactNBytes(con, 8)
-    f,o2 = _unpackFloat(buf,0)
-    return f
+def _recvFloat(con):
+    offset = con.consume( 8 )
+    return _FLOAT.unpack_from( con._readBuffer, offset )[0]
 
 def _recvStringOption ( con ):
     isSet = _recvBool( con )
@@ -524,6 +690,8 @@ class AtLeast(Consistency):
         self._i = i
         self._v = "\x02" + _packInt64(i)
 
+    i = property(operator.attrgetter('_i'))
+
     def __str__(self):
         return "AtLeast(%i)" % self._i
 
@@ -531,47 +699,84 @@ class AtLeast(Consistency):
         return True
 
 class Update(object):
-    pass
+    __slots__ = ()
+
 class Set(Update):
+    __slots__ = ('_key', '_value')
+
     def __init__(self,key,value):
         self._key = key
         self._value = value
 
+    key = property(operator.attrgetter('_key'))
+    value = property(operator.attrgetter('_value'))
+
     def write(self, fob):
         fob.write(_packInt(1))
         fob.write(_packString(self._key))
         fob.write(_packString(self._value))
 
 class Delete(Update):
+    __slots__ = ('_key',)
+
     def __init__(self,key):
         self._key = key
 
+    key = property(operator.attrgetter('_key'))
+
     def write(self, fob):
         fob.write(_packInt(2))
         fob.write(_packString(self._key))
 
 class Assert(Update):
+    __slots__ = ('_key', '_vo')
+
     def __init__(self, key, vo):
         self._key = key
         self._vo = vo
 
+    key = property(operator.attrgetter('_key'))
+    value = property(operator.attrgetter('_vo'))
+
     def write(self, fob):
         fob.write(_packInt(8))
         fob.write(_packString(self._key))
         fob.write(_packStringOption(self._vo))
 
 class AssertExists(Update):
+    __slots__ = ('_key',)
+
     def __init__(self, key):
         self._key = key
 
+    key = property(operator.attrgetter('_key'))
+
     def write(self, fob):
         fob.write(_packInt(15))
         fob.write(_packString(self._key))
 
+class Replace(Update):
+    __slots__ = ('_key', '_wanted')
+
+    def __init__(self, key, wanted):
+        self._key = key
+        self._wanted = wanted
+
+    key = property(operator.attrgetter('_key'))
+    wanted = property(operator.attrgetter('_wanted'))
+
+    def write(self, fob):
+        # unlike Delete, Replace(key, None) doesn't fail the sequence when key is missing
+        fob.write(_packInt(16))
+        fob.write(_packString(self._key))
+        fob.write(_packStringOption(self._wanted))
+
 class Sequence(Update):
     def __init__(self):
         self._updates = []
 
+    updates = property(operator.attrgetter('_updates'))
+
     def addUpdate(self,u):
         self._updates.append(u)
 
@@ -595,6 +800,302 @@ class Sequence(Update):
         for update in self._updates:
             update.write(fob)
 
+class CompactSequence(Sequence):
+
+    # command, length, update kind and update count, filled in when encoding
+    _HEADER_SIZE = 4 * ARA_TYPE_INT_SIZE
+
+    def __init__(self):
+        """
+        Sequence that encodes its updates into a bytearray as they are added.
+
+        It keeps no object per update, and its encoding is sent as is, so
+        sequences of many updates take a fraction of the memory of a L{Sequence}
+        and are not copied around while being sent. L{size} is the size of the
+        request at any time.
+        """
+        self._buf = bytearray( CompactSequence._HEADER_SIZE )
+        self._writer = _ByteWriter( self._buf )
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def size(self):
+        """
+        @rtype: int
+        @return: the size in bytes of the request that executes the sequence
+        """
+        return len(self._buf)
+
+    def _fillHeader(self, cmd):
+        buf = self._buf
+        _INT_PAIR.pack_into( buf, 0, cmd, len(buf) - 2 * ARA_TYPE_INT_SIZE )
+        _INT_PAIR.pack_into( buf, 2 * ARA_TYPE_INT_SIZE, 5, self._count )
+
+    def _encode(self, cmd):
+        self._fillHeader( cmd )
+        return str( self._buf )
+
+    @property
+    def updates(self):
+        """
+        The updates, decoded from the encoding. Only meant for inspection, it
+        creates all the objects a compact sequence avoids.
+        """
+        self._fillHeader( 0 )
+        return _unpackUpdates( str( self._buf ), 3 * ARA_TYPE_INT_SIZE )[0]
+
+    def _entries(self):
+        """
+        The updates in the encoding: a (key, value) pair for every Set, which
+        is not turned into an object, and the decoded update for the others.
+        """
+        data = buffer( self._buf )
+        offset = CompactSequence._HEADER_SIZE
+        end = len(data)
+        while offset < end:
+            kind = _INT.unpack_from( data, offset )[0]
+            if kind == 1:
+                key, offset = _unpackString( data, offset + ARA_TYPE_INT_SIZE )
+                value, offset = _unpackString( data, offset )
+                yield (key, value)
+            else:
+                u, offset = _unpackUpdate( data, offset )
+                yield u
+
+    def _mark(self):
+        return ( len(self._buf), self._count )
+
+    def _rollback(self, mark):
+        size, count = mark
+        del self._buf[size:]
+        self._count = count
+
+    def addUpdate(self, u):
+        u.write( self._writer )
+        self._count += 1
+
+    @SignatureValidator( 'string', 'string' )
+    def addSet(self, key, value):
+        buf = self._buf
+        buf += _INT_PAIR.pack( 1, len(key) )
+        buf += key
+        buf += _INT.pack( len(value) )
+        buf += value
+        self._count += 1
+
+    def addSets(self, pairs, maxBytes = None):
+        """
+        Add a Set for every (key, value) pair, a lot faster than calling addSet for each.
+
+        If one of the pairs is invalid, none of them is added.
+
+        @type pairs: iterable of pair(string, string)
+        @type maxBytes: int
+        @param maxBytes: stop taking pairs from the iterable once the sequence
+        has reached this size, the last pair taken can take it beyond
+        @rtype: int
+        @return: the number of pairs added
+        """
+        mark = self._mark()
+        validate = not ArakoonClientConfig.isTrustedCaller()
+        buf = self._buf
+        packPair = _INT_PAIR.pack
+        packInt = _INT.pack
+        count = 0
+        for (key, value) in pairs:
+            if validate and not ( isinstance(key, str) and isinstance(value, str) ):
+                self._rollback( mark )
+                raise ArakoonInvalidArguments( 'addSets', [('key', key), ('value', value)] )
+            buf += packPair( 1, len(key) )
+            buf += key
+            buf += packInt( len(value) )
+            buf += value
+            count += 1
+            if maxBytes is not None and len(buf) >= maxBytes:
+                break
+        self._count += count
+        return count
+
+    @SignatureValidator( 'string' )
+    def addDelete(self, key):
+        buf = self._buf
+        buf += _INT_PAIR.pack( 2, len(key) )
+        buf += key
+        self._count += 1
+
+    def addAssert(self, key, vo):
+        self.addUpdate( Assert(key, vo) )
+
+    def addAssertExists(self, key):
+        self.addUpdate( AssertExists(key) )
+
+    def write(self, fob):
+        self._fillHeader( 0 )
+        fob.write( buffer( self._buf, 2 * ARA_TYPE_INT_SIZE ) )
+
+# The updates below only show up when reading the tlog, see L{ArakoonProtocol.decodeTlogStream}
+
+class SyncedSequence(Sequence):
+    pass
+
+class TestAndSet(Update):
+    def __init__(self, key, expected, wanted):
+        self._key = key
+        self._expected = expected
+        self._wanted = wanted
+
+    key = property(operator.attrgetter('_key'))
+    expected = property(operator.attrgetter('_expected'))
+    wanted = property(operator.attrgetter('_wanted'))
+
+class DeletePrefix(Update):
+    def __init__(self, prefix):
+        self._prefix = prefix
+
+    prefix = property(operator.attrgetter('_prefix'))
+
+class UserFunction(Update):
+    def __init__(self, name, argument):
+        self._name = name
+        self._argument = argument
+
+    name = property(operator.attrgetter('_name'))
+    argument = property(operator.attrgetter('_argument'))
+
+class AdminSet(Update):
+    def __init__(self, key, vo):
+        self._key = key
+        self._vo = vo
+
+    key = property(operator.attrgetter('_key'))
+    value = property(operator.attrgetter('_vo'))
+
+class AssertRange(Update):
+    def __init__(self, prefix, keys):
+        self._prefix = prefix
+        self._keys = keys
+
+    prefix = property(operator.attrgetter('_prefix'))
+    keys = property(operator.attrgetter('_keys'))
+
+class MasterSet(Update):
+    def __init__(self, master):
+        self._master = master
+
+    master = property(operator.attrgetter('_master'))
+
+class Nop(Update):
+    pass
+
+class NurseryUpdate(Update):
+    """
+    Change to the interval or routing of a nursery cluster
+    """
+    def __init__(self, kind):
+        self._kind = kind
+
+    kind = property(operator.attrgetter('_kind'))
+
+def _unpackUpdates(buf, offset):
+    count, offset = _unpackInt(buf, offset)
+    updates = []
+    for i in xrange(count):
+        u, offset = _unpackUpdate(buf, offset)
+        updates.append(u)
+    return updates, offset
+
+def _unpackUpdate(buf, offset):
+    kind, offset = _unpackInt(buf, offset)
+    if kind == 1:
+        key, offset = _unpackString(buf, offset)
+        value, offset = _unpackString(buf, offset)
+        return Set(key, value), offset
+    if kind == 2:
+        key, offset = _unpackString(buf, offset)
+        return Delete(key), offset
+    if kind == 3:
+        key, offset = _unpackString(buf, offset)
+        expected, offset = _unpackStringOption(buf, offset)
+        wanted, offset = _unpackStringOption(buf, offset)
+        return TestAndSet(key, expected, wanted), offset
+    if kind == 4:
+        master, offset = _unpackString(buf, offset)
+        return MasterSet(master), offset + ARA_TYPE_INT64_SIZE
+    if kind == 5 or kind == 13:
+        seq = kind == 5 and Sequence() or SyncedSequence()
+        updates, offset = _unpackUpdates(buf, offset)
+        seq._updates = updates
+        return seq, offset
+    if kind == 6:
+        return Nop(), offset
+    if kind == 7:
+        name, offset = _unpackString(buf, offset)
+        argument, offset = _unpackStringOption(buf, offset)
+        return UserFunction(name, argument), offset
+    if kind == 8:
+        key, offset = _unpackString(buf, offset)
+        vo, offset = _unpackStringOption(buf, offset)
+        return Assert(key, vo), offset
+    if kind == 9:
+        key, offset = _unpackString(buf, offset)
+        vo, offset = _unpackStringOption(buf, offset)
+        return AdminSet(key, vo), offset
+    if kind == 10:
+        for i in range(4):
+            _, offset = _unpackStringOption(buf, offset)
+        return NurseryUpdate(kind), offset
+    if kind == 11:
+        _, offset = RoutingInfo.unpack(buf, offset, _unpackBool, _unpackString)
+        return NurseryUpdate(kind), offset
+    if kind == 12:
+        for i in range(3):
+            _, offset = _unpackString(buf, offset)
+        return NurseryUpdate(kind), offset
+    if kind == 14:
+        prefix, offset = _unpackString(buf, offset)
+        return DeletePrefix(prefix), offset
+    if kind == 15:
+        key, offset = _unpackString(buf, offset)
+        return AssertExists(key), offset
+    if kind == 16:
+        key, offset = _unpackString(buf, offset)
+        wanted, offset = _unpackStringOption(buf, offset)
+        return Replace(key, wanted), offset
+    if kind == 17:
+        prefix, offset = _unpackString(buf, offset)
+        assertion, offset = _unpackInt(buf, offset)
+        if assertion != 1:
+            raise ArakoonException("Cannot decode range assertion of type %d" % assertion)
+        keys, offset = _unpackStringList(buf, offset)
+        # the keys are logged back to front
+        keys.reverse()
+        return AssertRange(prefix, keys), offset
+    raise ArakoonException("Cannot decode update of type %d" % kind)
+
+def _unpackTlogValue(buf, offset):
+    """
+    Decode a value as it is logged in the tlog into the list of its updates
+    """
+    tag, next = _unpackInt(buf, offset)
+    if tag != 0xff:
+        # tlogs of older versions hold a single update per entry
+        u, offset = _unpackUpdate(buf, offset)
+        return [u], offset
+    kind = buf[next]
+    next += 1
+    if kind == 'c':
+        _, next = _unpackBool(buf, next)
+        updates, next = _unpackUpdates(buf, next)
+        # the updates are logged back to front
+        updates.reverse()
+        return updates, next
+    if kind == 'm':
+        master, next = _unpackString(buf, next)
+        return [MasterSet(master)], next + ARA_TYPE_INT64_SIZE
+    raise ArakoonException("Cannot decode tlog value of type %r" % kind)
+
 
 class ArakoonProtocol :
 
@@ -666,14 +1167,19 @@ class ArakoonProtocol :
 
     @staticmethod
     def encodeSequence(seq, sync):
-        r = cStringIO.StringIO()
-        seq.write(r)
-        flattened = r.getvalue()
-        r.close()
         cmd = ARA_CMD_SEQ
         if sync:
             cmd = ARA_CMD_SYNCED_SEQUENCE
-        return _packInt(cmd) + _packString(flattened)
+        if isinstance( seq, CompactSequence ):
+            return seq._encode( cmd )
+        # the sequence is written right behind the command and its length,
+        # which are filled in once the length is known
+        header = 2 * ARA_TYPE_INT_SIZE
+        buf = bytearray( header )
+        seq.write( _ByteWriter( buf ) )
+        _INT.pack_into( buf, 0, cmd )
+        _INT.pack_into( buf, ARA_TYPE_INT_SIZE, len( buf ) - header )
+        return str( buf )
 
     @staticmethod
     def encodeDelete( key ):
@@ -724,19 +1230,15 @@ class ArakoonProtocol :
 
     @staticmethod
     def encodeMultiGet(keys, consistency):
-        retVal = _packInt(ARA_CMD_MULTI_GET) + consistency.encode()
-        retVal += _packInt(len(keys))
-        for key in keys:
-            retVal += _packString(key)
-        return retVal
+        buf = bytearray( _packInt(ARA_CMD_MULTI_GET) + consistency.encode() )
+        _writeStringList( buf, keys )
+        return str( buf )
 
     @staticmethod
     def encodeMultiGetOption(keys, consistency):
-        retVal = _packInt(ARA_CMD_MULTI_GET_OPTION) + consistency.encode()
-        retVal += _packInt(len(keys))
-        for key in keys:
-            retVal += _packString(key)
-        return retVal
+        buf = bytearray( _packInt(ARA_CMD_MULTI_GET_OPTION) + consistency.encode() )
+        _writeStringList( buf, keys )
+        return str( buf )
 
     @staticmethod
     def encodeExpectProgressPossible():
@@ -755,6 +1257,13 @@ class ArakoonProtocol :
         retVal += _packStringOption(argument)
         return retVal
 
+    @staticmethod
+    def encodeUserHook(name, consistency):
+        retVal = _packInt(ARA_CMD_USER_HOOK)
+        retVal += consistency.encode()
+        retVal += _packString(name)
+        return retVal
+
     @staticmethod
     def encodeDeletePrefix(prefix):
         retVal =  _packInt(ARA_CMD_DELETE_PREFIX)
@@ -781,6 +1290,8 @@ class ArakoonProtocol :
             raise ArakoonInconsistentRead(errorMsg)
         if errorCode == ARA_ERR_USERFUNCTION_FAILURE:
             raise ArakoonUserfunctionFailure(errorMsg)
+        if errorCode == ARA_ERR_USERHOOK_NOT_FOUND:
+            raise ArakoonUserHookNotFound(errorMsg)
         if errorCode == ARA_ERR_ASSERTION_FAILED:
             raise ArakoonAssertionFailed(errorMsg)
         if errorCode == ARA_ERR_ASSERTEXISTS_FAILED:
@@ -816,6 +1327,11 @@ class ArakoonProtocol :
         ArakoonProtocol._evaluateErrorCode( con )
         return _recvString( con )
 
+    @staticmethod
+    def decodeStringIntoResult ( con, buffer ):
+        ArakoonProtocol._evaluateErrorCode( con )
+        return _recvStringInto( con, buffer )
+
     @staticmethod
     def decodeStringOptionResult ( con ):
         ArakoonProtocol._evaluateErrorCode( con )
@@ -825,12 +1341,12 @@ class ArakoonProtocol :
     def decodeStringListResult( con ):
 
         ArakoonProtocol._evaluateErrorCode( con )
-        retVal = []
 
         arraySize = _recvInt( con )
 
-        for i in xrange( arraySize ) :
-            retVal[:0] = [ _recvString( con ) ]
+        # the server sends the list back to front
+        retVal = _recvStrings( con, arraySize )
+        retVal.reverse()
         return retVal
 
     @staticmethod
@@ -898,15 +1414,13 @@ class ArakoonProtocol :
     @staticmethod
     def decodeStringPairListResult(con):
         ArakoonProtocol._evaluateErrorCode(con)
-        result = []
 
         size = _recvInt( con )
 
-        for i in range(size):
-            k = _recvString ( con )
-            v = _recvString ( con )
-            result [:0] = [(k, v)]
-
+        flat = _recvStrings( con, 2 * size )
+        result = zip( flat[0::2], flat[1::2] )
+        # the server sends the list back to front
+        result.reverse()
         return result
 
     @staticmethod
@@ -926,6 +1440,46 @@ class ArakoonProtocol :
         info  = _recvString(con)
         return (major,minor, patch, info)
 
+    @staticmethod
+    def encodeLastEntries(i):
+        return _packInt(ARA_CMD_LAST_ENTRIES2) + _packInt64(i)
+
+    @staticmethod
+    def decodeTlogStream(con):
+        """
+        Generator over the reply to a LAST_ENTRIES2 request.
+
+        Yields (i, updates) for every tlog entry the node streams. A node can also
+        send whole tlog files or its head database, for entries it no longer
+        has in the tlog it is writing. Those are skipped and yielded as
+        (None, None): the entries in them are lost to the caller.
+
+        The reply must be read to the end, or the connection closed.
+        """
+        ArakoonProtocol._evaluateErrorCode(con)
+        while True:
+            part = _recvSignedInt(con)
+            if part == -2:
+                # the end marker is sent as an int64
+                con.consume(ARA_TYPE_INT_SIZE)
+                return
+            if part == 1:
+                i = _recvInt64(con)
+                while i != -1:
+                    con.consume(ARA_TYPE_INT_SIZE) # checksum
+                    updates, _ = _unpackTlogValue(_recvString(con), 0)
+                    yield i, updates
+                    i = _recvInt64(con)
+            elif part == 2:
+                con.skip(_recvInt64(con))
+                yield None, None
+            elif part == 3:
+                _recvString(con)
+                con.skip(_recvInt64(con))
+                yield None, None
+            else:
+                raise ArakoonException("Unknown part %d in tlog stream" % part)
+
     @staticmethod
     def encodeGetKeyCount () :
         return _packInt(ARA_CMD_KEY_COUNT)
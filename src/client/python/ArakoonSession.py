@@ -0,0 +1,134 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Read-your-writes consistency for the reads of a client
+"""
+
+import threading
+import contextlib
+
+from ArakoonProtocol import *
+from ArakoonProtocol import _packBool, _packInt64
+
+
+class FallbackConsistency(AtLeast):
+
+    def __init__(self):
+        """
+        AtLeast an i the client works out for every read, see L{SessionConsistency}.
+
+        Reads a node rejects as inconsistent are done on the master, see L{onMaster}.
+        Subclasses give the i with _lowerBound, None when any i will do.
+        """
+        self._local = threading.local()
+        self._masterReads = 0
+
+    def _lowerBound(self):
+        raise NotImplementedError()
+
+    i = property(lambda self: self._lowerBound())
+
+    def _isOnMaster(self):
+        return getattr(self._local, 'onMaster', False)
+
+    def encode(self):
+        if not self.isDirty():
+            return _packBool(False)
+        i = self._lowerBound()
+        if i is None:
+            return _packBool(True)
+        return "\x02" + _packInt64(i)
+
+    def isDirty(self):
+        return not self._isOnMaster()
+
+    @contextlib.contextmanager
+    def onMaster(self):
+        """
+        Make the reads of this thread consistent ones within the block
+        """
+        local = self._local
+        previous = getattr(local, 'onMaster', False)
+        local.onMaster = True
+        self._masterReads += 1
+        try:
+            yield
+        finally:
+            local.onMaster = previous
+
+
+class SessionConsistency(FallbackConsistency):
+
+    def __init__(self, fetchTxid):
+        """
+        AtLeast the i of the last write of the session.
+
+        The writes of the client mark the session with L{wrote}. The reads that
+        follow ask the master for its txid once, and are sent to any node with
+        AtLeast that txid, so they see the writes but can be served by a slave.
+        Reads the slave rejects are done on the master.
+        Use L{ArakoonClient.enableReadYourWrites} to start a session.
+
+        @type fetchTxid: callable
+        @param fetchTxid: returns the txid of the master, e.g. L{ArakoonClient.get_txid}
+        """
+        FallbackConsistency.__init__(self)
+        self._fetchTxid = fetchTxid
+        self._lock = threading.Lock()
+        self._txid = None
+        # the session starts with what the client wrote before it
+        self._pending = True
+        self._txidFetches = 0
+
+    def _lowerBound(self):
+        if self._pending:
+            with self._lock:
+                if self._pending:
+                    # writes done from here on mark the session again
+                    self._pending = False
+                    try:
+                        txid = self._fetchTxid()
+                    except:
+                        self._pending = True
+                        raise
+                    self._txidFetches += 1
+                    if isinstance(txid, AtLeast) and (self._txid is None or txid.i > self._txid):
+                        self._txid = txid.i
+        return self._txid
+
+    def __str__(self):
+        return "SessionConsistency(%s)" % self._txid
+
+    __repr__ = __str__
+
+    def wrote(self):
+        """
+        Mark the session: a write completed, reads have to see it from now on
+        """
+        self._pending = True
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: the txid reads must see, the number of times it was fetched
+        from the master, and the number of reads that fell back on the master
+        """
+        return { 'txid' : self._txid,
+                 'txidFetches' : self._txidFetches,
+                 'masterReads' : self._masterReads }
@@ -0,0 +1,218 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Reads that may lag behind the master by a bounded amount
+"""
+
+import time
+import bisect
+import threading
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+from ArakoonSession import FallbackConsistency
+
+# seconds between two probes of the progress of a node
+ARA_CFG_STALENESS_PROBE_INTERVAL = 1.0
+# probes a node can miss before its progress is no longer trusted
+ARA_CFG_STALENESS_MISSED_PROBES = 3
+
+
+class _NodeProbe(threading.Thread):
+
+    def __init__(self, tracker, nodeId):
+        threading.Thread.__init__(self, name = "arakoon-progress-%s" % nodeId)
+        self.daemon = True
+        self._tracker = tracker
+        self.nodeId = nodeId
+
+    def run(self):
+        tracker = self._tracker
+        client = tracker._client
+        msg = ArakoonProtocol.encodeGetTxid()
+        while not tracker._stopped.isSet():
+            try:
+                conn = client._sendMessage( self.nodeId, msg, tryCount = 1 )
+                txid = conn.decodeGetTxidResult()
+                if isinstance(txid, AtLeast):
+                    tracker._record( self.nodeId, txid.i, time.time() )
+            except Exception, ex:
+                ArakoonClientLogger.logDebug( "Could not probe the progress of node %s (%s: '%s')" %
+                                              (self.nodeId, ex.__class__.__name__, ex) )
+            tracker._stopped.wait( tracker._interval )
+
+
+class ArakoonProgressTracker(object):
+
+    def __init__(self, client, interval = None, horizon = 0.0):
+        """
+        Follows the i every node has applied, by asking each of them for its txid.
+
+        Every node is probed by a thread of its own, so a node that is down
+        doesn't hold up the others. The highest i reported is taken as the
+        progress of the cluster; its history is kept for horizon seconds, to
+        tell how far behind a node is in time.
+
+        @type client: L{ArakoonClient}
+        @param interval: seconds between probes, defaults to L{ARA_CFG_STALENESS_PROBE_INTERVAL}
+        @type horizon: float
+        @param horizon: seconds of history of the progress of the cluster to keep
+        """
+        if interval is None:
+            interval = ARA_CFG_STALENESS_PROBE_INTERVAL
+        self._client = client
+        self._interval = interval
+        self._horizon = horizon
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        # nodeId -> (i, time of the probe)
+        self._progress = dict()
+        # (time, i) every time the progress of the cluster went up
+        self._times = []
+        self._history = []
+        self._probes = [ _NodeProbe(self, nodeId) for nodeId in client._config.getNodes().keys() ]
+
+    def start(self):
+        for probe in self._probes:
+            probe.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def _record(self, nodeId, i, now):
+        with self._lock:
+            self._progress[nodeId] = (i, now)
+            if len(self._history) == 0 or i > self._history[-1]:
+                self._times.append( now )
+                self._history.append( i )
+                # keep the last sample from before the horizon, it is the progress at the horizon
+                drop = bisect.bisect_right( self._times, now - self._horizon ) - 1
+                if drop > 0:
+                    del self._times[:drop]
+                    del self._history[:drop]
+
+    def _fresh(self, now):
+        limit = now - self._interval * ARA_CFG_STALENESS_MISSED_PROBES
+        return dict( (nodeId, i) for (nodeId, (i, probed)) in self._progress.iteritems()
+                     if probed >= limit )
+
+    def lowerBound(self, maxEntries, maxSeconds):
+        """
+        A node that is within either of the two bounds is, when both are given.
+
+        @rtype: int
+        @return: the lowest i a node may have applied to be within the bound,
+        None if the progress of the cluster is not known
+        """
+        now = time.time()
+        with self._lock:
+            fresh = self._fresh(now)
+            if len(fresh) == 0:
+                return None
+            bounds = []
+            if maxEntries is not None:
+                bounds.append( max( 0, max( fresh.values() ) - maxEntries ) )
+            if maxSeconds is not None:
+                # the progress of the cluster maxSeconds ago, or the oldest one known,
+                # which is higher
+                index = max( 0, bisect.bisect_right( self._times, now - maxSeconds ) - 1 )
+                bounds.append( self._history[index] )
+            return min( bounds )
+
+    def eligibleNodes(self, bound):
+        """
+        @type bound: int
+        @rtype: list of string
+        @return: the nodes that were probed recently, and had applied bound then
+        """
+        with self._lock:
+            fresh = self._fresh( time.time() )
+        return [ nodeId for (nodeId, i) in fresh.iteritems() if i >= bound ]
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: the progress of the cluster, and for every node the i it reported,
+        how many entries it is behind and the seconds since it was probed
+        """
+        now = time.time()
+        with self._lock:
+            cluster = None
+            if len(self._history) > 0:
+                cluster = self._history[-1]
+            nodes = dict( (nodeId, { 'i' : i,
+                                     'behind' : cluster - i,
+                                     'age' : now - probed })
+                          for (nodeId, (i, probed)) in self._progress.iteritems() )
+        return { 'progress' : cluster, 'nodes' : nodes }
+
+
+class BoundedStaleness(FallbackConsistency):
+
+    def __init__(self, tracker, maxEntries = None, maxSeconds = None):
+        """
+        Reads that lag at most maxEntries entries, or maxSeconds seconds, behind the cluster.
+
+        With both, a node that is within either of them can be read from.
+
+        The reads go to the nodes the tracker saw within the bound, with AtLeast
+        the lowest i allowed, so a node that fell behind since rejects them and
+        they are done on the master. Reads are done on the master as well while
+        the progress of the nodes is not known.
+
+        The progress is measured at the probes: a node can be up to a probe
+        interval further behind than the bound when it is read.
+        Use L{ArakoonClient.enableBoundedStaleness} to set one up.
+
+        @type tracker: L{ArakoonProgressTracker}
+        @type maxEntries: int
+        @type maxSeconds: float
+        """
+        FallbackConsistency.__init__(self)
+        self._tracker = tracker
+        self._maxEntries = maxEntries
+        self._maxSeconds = maxSeconds
+
+    tracker = property(lambda self: self._tracker)
+
+    def _lowerBound(self):
+        return self._tracker.lowerBound( self._maxEntries, self._maxSeconds )
+
+    def isDirty(self):
+        return FallbackConsistency.isDirty(self) and self._lowerBound() is not None
+
+    def eligibleNodes(self):
+        """
+        @rtype: list of string
+        @return: the nodes reads can go to, None if any will do
+        """
+        bound = self._lowerBound()
+        if bound is None:
+            return None
+        return self._tracker.eligibleNodes( bound )
+
+    def __str__(self):
+        return "BoundedStaleness(%s, %s)" % (self._maxEntries, self._maxSeconds)
+
+    __repr__ = __str__
+
+    def getStatistics(self):
+        stats = self._tracker.getStatistics()
+        stats['masterReads'] = self._masterReads
+        return stats
@@ -0,0 +1,186 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Raw streams to the user hooks registered on the nodes
+"""
+
+from ArakoonProtocol import *
+from ArakoonProtocol import _readExactNBytes, _recvInt, _recvSignedInt, _recvInt64, _recvBool, \
+     _recvString, _recvStringOption, _recvStrings, _packInt, _packInt64, _packBool, \
+     _packString, _packStringOption
+from ArakoonExceptions import *
+
+
+class ArakoonHookStream(object):
+
+    def __init__(self, name, conn):
+        """
+        The connection a user hook was started on.
+
+        A hook registered in the HookRegistry of the node gets the connection to
+        itself: it reads its input from it and writes whatever it wants back, there
+        is no reply framing around it. The hook and the caller agree on what is
+        exchanged, this class offers the reads and writes of the Llio encodings
+        the hooks use. e.g. ::
+            with client.userHook('t3k') as stream:
+                stream.writeString('cthulhu')
+                print stream.readString()
+                stream.release()
+
+        The node writes an error reply (a return code and a message) instead
+        when the hook can't be started, e.g. when it is not registered or the
+        consistency can't be met. Hooks that start their output with a return
+        code, as the other commands do, can be checked with L{readResult}.
+
+        The connection is closed by L{close}, as there is no telling whether the
+        hook is done with it. Call L{release} when the exchange is over instead,
+        to hand the connection back to the pool.
+        Use L{ArakoonClient.userHook} to create one.
+
+        @type name: string
+        @type conn: L{ArakoonClientConnection}
+        """
+        self._name = name
+        self._conn = conn
+
+    name = property(lambda self: self._name)
+    closed = property(lambda self: self._conn is None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+        return False
+
+    def _connection(self):
+        conn = self._conn
+        if conn is None:
+            raise ValueError( "I/O operation on closed hook stream" )
+        return conn
+
+    def _read(self, decoder, *args):
+        conn = self._connection()
+        try:
+            return decoder( conn, *args )
+        except:
+            # whatever the hook still sends can't be told apart from the next reply
+            self.close()
+            raise
+
+    def readResult(self):
+        """
+        Read a return code, raising the exception that matches it if it is not success
+        """
+        self._read( ArakoonProtocol._evaluateErrorCode )
+
+    def read(self, n):
+        """
+        @type n: int
+        @rtype: string
+        @return: the next n bytes the hook sends, waiting for them to come in
+        """
+        return self._read( _readExactNBytes, n )
+
+    def readInto(self, buffer):
+        """
+        Receive the next len(buffer) bytes the hook sends straight into buffer
+
+        @type buffer: bytearray or memoryview
+        """
+        self._read( lambda conn: conn.readInto( memoryview(buffer) ) )
+
+    def readInt(self):
+        return self._read( _recvInt )
+
+    def readSignedInt(self):
+        return self._read( _recvSignedInt )
+
+    def readInt64(self):
+        return self._read( _recvInt64 )
+
+    def readBool(self):
+        return self._read( _recvBool )
+
+    def readString(self):
+        return self._read( _recvString )
+
+    def readStringOption(self):
+        return self._read( _recvStringOption )
+
+    def readStringList(self):
+        """
+        Read a list of strings sent with Llio.output_list.
+
+        @rtype: list of string
+        @return: the strings, in the order the hook sent them. Note Llio.input_list
+        on the OCaml side gives them back to front.
+        """
+        return self._read( lambda conn: _recvStrings( conn, _recvInt( conn ) ) )
+
+    def write(self, data):
+        """
+        Send data to the hook
+
+        @type data: string
+        """
+        conn = self._connection()
+        try:
+            conn.write( data )
+        except:
+            self.close()
+            raise
+
+    def writeInt(self, i):
+        self.write( _packInt( i ) )
+
+    def writeInt64(self, i):
+        self.write( _packInt64( i ) )
+
+    def writeBool(self, b):
+        self.write( _packBool( b ) )
+
+    def writeString(self, s):
+        self.write( _packString( s ) )
+
+    def writeStringOption(self, s):
+        self.write( _packStringOption( s ) )
+
+    def release(self):
+        """
+        End the exchange with the hook, and hand the connection back to the pool.
+
+        Only call this when all the hook sent is read, and it is done reading.
+        """
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        conn.release()
+
+    def close(self):
+        """
+        End the exchange with the hook, and close the connection
+        """
+        conn = self._conn
+        if conn is None:
+            return
+        self._conn = None
+        conn.abandon()
+        conn.release()
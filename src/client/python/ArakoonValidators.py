@@ -33,47 +33,57 @@ class SignatureValidator :
         }
 
     def __call__ (self, f ):
-        @wraps(f)
-        def my_new_f ( *args, **kwargs ) :
-            new_args = list( args[1:] )
-            missing_args = f.func_code.co_varnames[len(args):]
-            for missing_arg in missing_args:
-                if( len(new_args) == len(self.param_types) ) :
-            
+        # everything about the signature is worked out once, not on every call
+        code = f.func_code
+        names = code.co_varnames[1:code.co_argcount]
+        positions = dict( (name, i) for (i, name) in enumerate(names) )
+        defaults = f.func_defaults or ()
+        firstDefault = len(names) - len(defaults)
+        checks = [ (name, self._checker(arg_type)) for (name, arg_type) in zip(names, self.param_types) ]
+
+        def bind(args, kwargs):
+            new_args = list( args )
+            for name in names[len(args):]:
+                if len( kwargs ) == 0:
+                    break
+                if kwargs.has_key( name ):
+                    new_args.append( kwargs.pop( name ) )
+                elif positions[name] >= firstDefault:
+                    # a later argument is passed by keyword
+                    new_args.append( defaults[positions[name] - firstDefault] )
+                else:
                     break
-                if( kwargs.has_key(missing_arg) ) :
-                    pos = f.func_code.co_varnames.index( missing_arg )
-#                    if pos > len(new_args):
-#                        new_args.append( None )
-            
-                    new_args.insert(pos, kwargs[missing_arg])
-                    del kwargs[missing_arg]
-            
             if len( kwargs ) > 0:
                 raise ArakoonInvalidArguments( f.func_name, list(kwargs.iteritems()) )
-            
-            i = 0
-            error_key_values = []
-            for (arg, arg_type) in zip(new_args, self.param_types) :
-                if not self.validate(arg, arg_type):
-                    error_key_values.append( (f.func_code.co_varnames[i+1],new_args[i]) )
-                i += 1
-                
-            if len(error_key_values) > 0 :
-                raise ArakoonInvalidArguments( f.func_name, error_key_values )
-            
-            return f( args[0], *new_args )
-        
+            return new_args
+
+        @wraps(f)
+        def my_new_f ( self, *args, **kwargs ) :
+            if kwargs:
+                args = bind( args, kwargs )
+            if not ArakoonProtocol.ArakoonClientConfig.isTrustedCaller():
+                error_key_values = [ (name, arg) for (arg, (name, check)) in zip(args, checks)
+                                     if not check(arg) ]
+                if len(error_key_values) > 0 :
+                    raise ArakoonInvalidArguments( f.func_name, error_key_values )
+
+            return f( self, *args )
+
         return my_new_f
 
-    def validate(self,arg,arg_type):
+    def _checker(self, arg_type):
         if self.param_native_type_mapping.has_key( arg_type ):
-            return isinstance(arg,self.param_native_type_mapping[arg_type] )     
+            native_type = self.param_native_type_mapping[arg_type]
+            return lambda arg: isinstance( arg, native_type )
         elif arg_type == 'string_option' :
-            return isinstance( arg, str ) or arg is None
+            return lambda arg: arg is None or isinstance( arg, str )
+        elif arg_type == 'buffer' :
+            return lambda arg: isinstance( arg, bytearray ) or \
+                               ( isinstance( arg, memoryview ) and not arg.readonly )
         elif arg_type == 'sequence' :
-            return isinstance( arg, ArakoonProtocol.Sequence )
+            return lambda arg: isinstance( arg, ArakoonProtocol.Sequence )
         else:
             raise RuntimeError( "Invalid argument type supplied: %s" % arg_type )
-        
-    
\ No newline at end of file
+
+    def validate(self,arg,arg_type):
+        return self._checker( arg_type )( arg )
@@ -0,0 +1,245 @@
+"""
+Copyright (2010-2014) INCUBAID BVBA
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+
+
+"""
+Write-behind buffer that coalesces updates of the same key
+"""
+
+import threading
+
+from ArakoonProtocol import *
+from ArakoonExceptions import *
+from ArakoonValidators import SignatureValidator
+
+# number of distinct keys buffered before the buffer is flushed
+ARA_CFG_WRITE_BEHIND_MAX_KEYS = 1000
+# seconds an update is buffered at most, None to only flush explicitly or when full
+ARA_CFG_WRITE_BEHIND_MAX_DELAY = 0.1
+
+# buffered for a key that is to be deleted
+_DELETED = object()
+# encoded size of an update, on top of its key and value
+_UPDATE_OVERHEAD = 4 * ARA_TYPE_INT_SIZE
+
+
+class ArakoonWriteBehind(object):
+
+    def __init__(self, client, maxKeys = None, maxDelay = None, sync = False):
+        """
+        Buffers sets and deletes per key, and performs them as a single sequence.
+
+        Only the last update of every key is kept, so a key that is overwritten
+        many times costs one update when the buffer is flushed. The buffer is
+        flushed once it holds maxKeys keys or would outgrow a sequence, maxDelay
+        seconds after the first update went into it, by L{flush}, and when the
+        with block it is used in ends. e.g. ::
+            with client.writeBehind() as wb:
+                for i in xrange(1000):
+                    wb.set('counter', str(i))
+            # one sequence was sent, setting counter to '999'
+
+        Updates are not durable before they are flushed. Reads through the
+        buffer see the updates it holds, reads through the client don't.
+        A delete does not raise ArakoonNotFound when the key is missing.
+
+        When a flush in the background fails, the updates stay buffered and are
+        tried again after maxDelay. Use L{ArakoonClient.writeBehind} to create one.
+
+        @type client: L{ArakoonClient}
+        @param maxKeys: defaults to L{ARA_CFG_WRITE_BEHIND_MAX_KEYS}
+        @param maxDelay: seconds, defaults to L{ARA_CFG_WRITE_BEHIND_MAX_DELAY}
+        @type sync: bool
+        @param sync: sync the filesystem on the server after every flush
+        """
+        if maxKeys is None:
+            maxKeys = ARA_CFG_WRITE_BEHIND_MAX_KEYS
+        if maxDelay is None:
+            maxDelay = ARA_CFG_WRITE_BEHIND_MAX_DELAY
+        self._client = client
+        self._maxKeys = maxKeys
+        self._maxDelay = maxDelay
+        self._maxBytes = ArakoonClientConfig.getMaxSequenceSize()
+        self._sync = sync
+        # _lock guards the buffers, _flushLock keeps the flushes in order
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._pending = dict()
+        self._pendingBytes = 0
+        # the updates of the flush in progress, reads still have to see them
+        self._flushing = dict()
+        self._timer = None
+        self._writes = 0
+        self._flushes = 0
+        self._flushed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.flush()
+        return False
+
+    @SignatureValidator( 'string', 'string' )
+    def set(self, key, value):
+        """
+        Buffer the update of key to value
+        """
+        self._buffer( key, value )
+
+    @SignatureValidator( 'string' )
+    def delete(self, key):
+        """
+        Buffer the removal of key, if it exists
+        """
+        self._buffer( key, _DELETED )
+
+    def _buffer(self, key, value):
+        size = _UPDATE_OVERHEAD + len(key)
+        if value is not _DELETED:
+            size += len(value)
+        with self._lock:
+            # flush first if the update would make the sequence too large
+            full = key not in self._pending and len(self._pending) > 0 and \
+                   self._pendingBytes + size > self._maxBytes
+        if full:
+            self.flush()
+        with self._lock:
+            old = self._pending.get( key )
+            if old is not None:
+                self._pendingBytes -= _UPDATE_OVERHEAD + len(key)
+                if old is not _DELETED:
+                    self._pendingBytes -= len(old)
+            self._pending[key] = value
+            self._pendingBytes += size
+            self._writes += 1
+            full = len(self._pending) >= self._maxKeys
+            if not full:
+                self._arm()
+        if full:
+            self.flush()
+
+    def _lookup(self, key):
+        with self._lock:
+            value = self._pending.get( key )
+            if value is None:
+                value = self._flushing.get( key )
+            return value
+
+    @SignatureValidator( 'string' )
+    def get(self, key):
+        """
+        Retrieve the value of key, as it is in the buffer or else in the store
+
+        @rtype: string
+        """
+        value = self._lookup( key )
+        if value is _DELETED:
+            raise ArakoonNotFound( key )
+        if value is not None:
+            return value
+        return self._client.get( key )
+
+    @SignatureValidator( 'string' )
+    def exists(self, key):
+        """
+        @rtype: bool
+        @return: whether key has a value, in the buffer or else in the store
+        """
+        value = self._lookup( key )
+        if value is not None:
+            return value is not _DELETED
+        return self._client.exists( key )
+
+    def flush(self):
+        """
+        Perform the buffered updates as a single sequence
+
+        If the sequence fails, the updates it held are put back in the buffer,
+        unless the key was updated again meanwhile, and the exception is raised.
+
+        @rtype: int
+        @return: the number of updates performed
+        """
+        with self._flushLock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                pending = self._pending
+                if len(pending) == 0:
+                    return 0
+                self._pending = dict()
+                self._pendingBytes = 0
+                self._flushing = pending
+            try:
+                seq = CompactSequence()
+                for (key, value) in pending.iteritems():
+                    if value is _DELETED:
+                        seq.addUpdate( Replace( key, None ) )
+                    else:
+                        seq.addSet( key, value )
+                self._client.sequence( seq, self._sync )
+            except:
+                with self._lock:
+                    self._flushing = dict()
+                    for (key, value) in pending.iteritems():
+                        if key not in self._pending:
+                            self._pending[key] = value
+                            self._pendingBytes += _UPDATE_OVERHEAD + len(key)
+                            if value is not _DELETED:
+                                self._pendingBytes += len(value)
+                raise
+            with self._lock:
+                self._flushing = dict()
+                self._flushes += 1
+                self._flushed += len(pending)
+            return len(pending)
+
+    def _flushInBackground(self):
+        try:
+            self.flush()
+        except ArakoonException, ex:
+            ArakoonClientLogger.logWarning( "Write-behind flush of %d keys failed (%s: '%s')",
+                                            len(self), ex.__class__.__name__, ex )
+            with self._lock:
+                if len(self._pending) > 0:
+                    self._arm()
+
+    def _arm(self):
+        # the lock is held
+        if self._timer is None and self._maxDelay is not None:
+            self._timer = threading.Timer( self._maxDelay, self._flushInBackground )
+            self._timer.daemon = True
+            self._timer.start()
+
+    def getStatistics(self):
+        """
+        @rtype: dict
+        @return: the updates buffered, the flushes done, the updates they performed,
+        and the updates that were coalesced with a later one of the same key
+        """
+        with self._lock:
+            pending = len(self._pending) + len(self._flushing)
+            return { 'writes' : self._writes,
+                     'flushes' : self._flushes,
+                     'flushed' : self._flushed,
+                     'coalesced' : self._writes - self._flushed - pending,
+                     'pending' : pending }
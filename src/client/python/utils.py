@@ -25,6 +25,7 @@ limitations under the License.
 
 import __builtin__
 import uuid
+import inspect
 import functools
 import itertools
 
@@ -160,6 +161,25 @@ def %%(name)s(%(signature)s):
         'argnames': template_argnames,
     }
 
+    # Callables taking the arguments positionally are called without building
+    # a keyword dictionary on every call
+    positional_fun_def_template = '''
+def %%(name)s(%(signature)s):
+    return %%(orig_name)s(%(args)s)
+''' % {
+        'signature': template_signature,
+        'args': template_args,
+    }
+
+    def _takes_positional(fun):
+        '''Check whether a callable accepts all argnames as positional arguments'''
+
+        code = getattr(fun, 'func_code', None)
+        if code is None:
+            return False
+        return bool(code.co_flags & inspect.CO_VARARGS) or \
+            code.co_argcount >= len(argnames_) - 1
+
     def wrapper(fun):
         '''
         Decorating which wraps the decorated function in a callable which uses
@@ -185,7 +205,10 @@ def %%(name)s(%(signature)s):
 
 
         # Fill in function template
-        fun_def = fun_def_template % {
+        template = fun_def_template
+        if _takes_positional(fun):
+            template = positional_fun_def_template
+        fun_def = template % {
             'name': fun.__name__,
             'orig_name': orig_function_name,
             'kwargs_name': kwargs_name,
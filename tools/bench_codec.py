@@ -0,0 +1,86 @@
+"""
+Benchmark for the value codecs of the python client.
+
+Encodes and decodes sample values with every codec, as the client does when
+setValueCodec is used, and reports the compression ratio and the CPU time
+per value and per MiB. The samples are JSON documents, log text and random
+bytes, which don't compress and show what a codec costs for nothing.
+
+usage: python bench_codec.py [repeat]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'client', 'python'))
+
+from ArakoonCodec import ArakoonValueCodec, ZlibCodec, Bz2Codec
+
+
+def json_sample(n):
+    rnd = random.Random(n)
+    docs = [ { 'id' : i,
+               'name' : 'user_%06d' % rnd.randint(0, 999999),
+               'email' : 'user%d@example.com' % rnd.randint(0, 99999),
+               'active' : rnd.random() < 0.5,
+               'score' : round(rnd.random() * 100, 2),
+               'tags' : rnd.sample(['red', 'green', 'blue', 'admin', 'guest', 'beta'], 3) }
+             for i in xrange(n) ]
+    return json.dumps(docs)
+
+def log_sample(n):
+    rnd = random.Random(n)
+    levels = ['info', 'debug', 'warning']
+    return ''.join( "2014-03-%02d 12:%02d:%02d %s node_%d: handled request %d in %d ms\n" %
+                    (rnd.randint(1, 28), rnd.randint(0, 59), rnd.randint(0, 59),
+                     rnd.choice(levels), rnd.randint(0, 2), i, rnd.randint(1, 500))
+                    for i in xrange(n) )
+
+def random_sample(size):
+    return os.urandom(size)
+
+SAMPLES = [ ("json 1KiB", json_sample(8)),
+            ("json 64KiB", json_sample(500)),
+            ("log 16KiB", log_sample(250)),
+            ("random 16KiB", random_sample(16 * 1024)) ]
+
+CODECS = [ ("zlib-1", ZlibCodec(1)),
+           ("zlib-6", ZlibCodec(6)),
+           ("zlib-9", ZlibCodec(9)),
+           ("bz2-9", Bz2Codec(9)) ]
+
+
+def best_of(call, repeat, loops):
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.clock()
+        for _ in xrange(loops):
+            call()
+        t = (time.clock() - t0) / loops
+        if best is None or t < best:
+            best = t
+    return best
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    print "%-13s %-7s %9s %8s %11s %11s %10s %10s" % ("sample", "codec", "size", "ratio",
+                                                    "enc (us)", "dec (us)", "enc MiB/s", "dec MiB/s")
+    for (sampleName, value) in SAMPLES:
+        loops = max(10, 2 * 1024 * 1024 / len(value))
+        for (codecName, codec) in CODECS:
+            layer = ArakoonValueCodec(codec, 0)
+            encoded = layer.encode(value)
+            assert layer.decode(encoded) == value
+            t_enc = best_of(lambda: layer.encode(value), repeat, loops)
+            t_dec = best_of(lambda: layer.decode(encoded), repeat, loops)
+            mib = len(value) / (1024.0 * 1024.0)
+            print "%-13s %-7s %9d %7.2fx %11.1f %11.1f %10.1f %10.1f" % (
+                sampleName, codecName, len(encoded), float(len(value)) / len(encoded),
+                t_enc * 1e6, t_dec * 1e6, mib / t_enc, mib / t_dec)
+
+if __name__ == '__main__':
+    main()
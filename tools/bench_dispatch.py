@@ -0,0 +1,170 @@
+"""
+Micro-benchmark for the call dispatch of the python client.
+
+Every public method of ArakoonClient is wrapped by update_argspec,
+retryDuringMasterReelection and SignatureValidator. This measures what the
+wrappers cost per call, on methods that do nothing, for the former wrappers,
+the current ones, and the current ones with ARA_CFG_TRUSTED_CALLER set.
+
+usage: python bench_dispatch.py [repeat]
+"""
+
+import os
+import sys
+import time
+from functools import wraps
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'client', 'python'))
+
+import ArakoonProtocol
+from ArakoonProtocol import ArakoonClientConfig
+from ArakoonExceptions import *
+from ArakoonValidators import SignatureValidator
+from Arakoon import retryDuringMasterReelection
+import utils
+
+
+def legacy_update_argspec(*argnames):
+    names = [a if isinstance(a, str) else a[0] for a in argnames]
+    signature = ', '.join(a if isinstance(a, str) else '%s=%r' % a for a in argnames)
+    template = '''
+def wrapper(%s):
+    kwargs = dict(zip((%s,), (%s,)))
+    return orig(**kwargs)
+''' % (signature, ', '.join(repr(n) for n in names), ', '.join(names))
+    def wrap(fun):
+        env = {'orig' : fun}
+        exec template in env
+        return wraps(fun)(env['wrapper'])
+    return wrap
+
+def legacy_retry(is_read_only = False):
+    def wrap(f):
+        @wraps(f)
+        def retrying_f (self,*args,**kwargs):
+            start = time.time()
+            tryCount = 0.0
+            backoffPeriod = 0.2
+            callSucceeded = False
+            retryPeriod = ArakoonClientConfig.getNoMasterRetryPeriod ()
+            deadline = start + retryPeriod
+            while( not callSucceeded and time.time() < deadline ):
+                try :
+                    retVal = f(self,*args,**kwargs)
+                    callSucceeded = True
+                except (ArakoonNoMaster, ArakoonNodeNotMaster, ArakoonSocketException, ArakoonNotConnected, ArakoonGoingDown) as ex:
+                    raise
+            return retVal
+        return retrying_f
+    return wrap
+
+class legacy_validator :
+    def __init__ (self, *args ):
+        self.param_types = args
+        self.param_native_type_mapping = { 'int': int, 'string': str, 'bool': bool }
+
+    def __call__ (self, f ):
+        @wraps(f)
+        def my_new_f ( *args, **kwargs ) :
+            new_args = list( args[1:] )
+            missing_args = f.func_code.co_varnames[len(args):]
+            for missing_arg in missing_args:
+                if( len(new_args) == len(self.param_types) ) :
+                    break
+                if( kwargs.has_key(missing_arg) ) :
+                    pos = f.func_code.co_varnames.index( missing_arg )
+                    new_args.insert(pos, kwargs[missing_arg])
+                    del kwargs[missing_arg]
+            if len( kwargs ) > 0:
+                raise ArakoonInvalidArguments( f.func_name, list(kwargs.iteritems()) )
+            i = 0
+            error_key_values = []
+            for (arg, arg_type) in zip(new_args, self.param_types) :
+                if not self.validate(arg, arg_type):
+                    error_key_values.append( (f.func_code.co_varnames[i+1],new_args[i]) )
+                i += 1
+            if len(error_key_values) > 0 :
+                raise ArakoonInvalidArguments( f.func_name, error_key_values )
+            return f( args[0], *new_args )
+        return my_new_f
+
+    def validate(self,arg,arg_type):
+        if self.param_native_type_mapping.has_key( arg_type ):
+            return isinstance(arg,self.param_native_type_mapping[arg_type] )
+        elif arg_type == 'string_option' :
+            return isinstance( arg, str ) or arg is None
+        raise RuntimeError( "Invalid argument type supplied: %s" % arg_type )
+
+
+RANGE_ARGS = ('self', 'beginKey', 'beginKeyIncluded', 'endKey', 'endKeyIncluded', ('maxElements', 1000))
+RANGE_TYPES = ('string_option', 'bool', 'string_option', 'bool', 'int')
+
+class Legacy(object):
+    @legacy_update_argspec('self', 'key')
+    @legacy_retry(is_read_only=True)
+    @legacy_validator( 'string' )
+    def get(self, key):
+        return key
+
+    @legacy_update_argspec(*RANGE_ARGS)
+    @legacy_retry(is_read_only=True)
+    @legacy_validator(*RANGE_TYPES)
+    def range(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        return beginKey
+
+class Current(object):
+    def __init__(self):
+        # what ArakoonClient._initialize sets up for the wrappers
+        self._config = ArakoonClientConfig('bench', {'bench' : (['127.0.0.1'], 4000)})
+        self._callTimeout = self._config.call_timeout
+
+    @utils.update_argspec('self', 'key')
+    @retryDuringMasterReelection(is_read_only=True)
+    @SignatureValidator( 'string' )
+    def get(self, key):
+        return key
+
+    @utils.update_argspec(*RANGE_ARGS)
+    @retryDuringMasterReelection(is_read_only=True)
+    @SignatureValidator(*RANGE_TYPES)
+    def range(self, beginKey, beginKeyIncluded, endKey, endKeyIncluded, maxElements = 1000):
+        return beginKey
+
+
+def best_of(call, repeat, loops):
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.time()
+        for _ in xrange(loops):
+            call()
+        t = (time.time() - t0) / loops
+        if best is None or t < best:
+            best = t
+    return best
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    loops = 100000
+    legacy, current = Legacy(), Current()
+    cases = [("get", lambda o: o.get('some_key')),
+             ("get(key=)", lambda o: o.get(key = 'some_key')),
+             ("range", lambda o: o.range('a', True, 'z', False)),
+             ("range(max=)", lambda o: o.range('a', True, 'z', False, maxElements = 10))]
+
+    print "%-12s %12s %12s %12s %8s %8s" % ("call", "legacy (ns)", "current (ns)", "trusted (ns)",
+                                           "current", "trusted")
+    for name, call in cases:
+        assert call(legacy) == call(current)
+        t_old = best_of(lambda: call(legacy), repeat, loops)
+        t_new = best_of(lambda: call(current), repeat, loops)
+        ArakoonProtocol.ARA_CFG_TRUSTED_CALLER = True
+        try:
+            t_trusted = best_of(lambda: call(current), repeat, loops)
+        finally:
+            ArakoonProtocol.ARA_CFG_TRUSTED_CALLER = False
+        print "%-12s %12.0f %12.0f %12.0f %7.1fx %7.1fx" % (name, t_old * 1e9, t_new * 1e9, t_trusted * 1e9,
+                                                           t_old / t_new, t_old / t_trusted)
+
+if __name__ == '__main__':
+    main()
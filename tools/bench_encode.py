@@ -0,0 +1,114 @@
+"""
+Micro-benchmark for the request encoders of the python client.
+
+Encodes get, range_entries, multiGet and sequence requests with the current
+encoders and with the former ones, which built a format string for every
+field and concatenated the pieces. The compact sequence case builds a
+CompactSequence instead of a Sequence of Set objects.
+
+usage: python bench_encode.py [repeat]
+"""
+
+import os
+import sys
+import struct
+import time
+import cStringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'client', 'python'))
+
+from ArakoonProtocol import *
+
+
+def legacy_packString(s):
+    return struct.pack("I%ds" % len(s), len(s), s)
+
+def legacy_packStringOption(s):
+    if s is None:
+        return struct.pack("?", 0)
+    return struct.pack("?", 1) + legacy_packString(s)
+
+def legacy_packInt(i):
+    return struct.pack("I", i)
+
+def legacy_get(key, consistency):
+    return legacy_packInt(ARA_CMD_GET) + consistency.encode() + legacy_packString(key)
+
+def legacy_range_entries(first, finc, last, linc, maxEntries, consistency):
+    r = legacy_packInt(ARA_CMD_RAN_E) + consistency.encode()
+    r += legacy_packStringOption(first) + struct.pack("?", finc)
+    r += legacy_packStringOption(last) + struct.pack("?", linc)
+    r += struct.pack("i", maxEntries)
+    return r
+
+def legacy_multi_get(keys, consistency):
+    r = legacy_packInt(ARA_CMD_MULTI_GET) + consistency.encode()
+    r += legacy_packInt(len(keys))
+    for key in keys:
+        r += legacy_packString(key)
+    return r
+
+def legacy_sequence(pairs):
+    r = cStringIO.StringIO()
+    r.write(legacy_packInt(5))
+    r.write(legacy_packInt(len(pairs)))
+    for k, v in pairs:
+        r.write(legacy_packInt(1))
+        r.write(legacy_packString(k))
+        r.write(legacy_packString(v))
+    flattened = r.getvalue()
+    return legacy_packInt(ARA_CMD_SEQ) + legacy_packString(flattened)
+
+def current_sequence(pairs):
+    seq = Sequence()
+    for k, v in pairs:
+        seq.addUpdate(Set(k, v))
+    return ArakoonProtocol.encodeSequence(seq, False)
+
+def compact_sequence(pairs):
+    seq = CompactSequence()
+    seq.addSets(pairs)
+    return ArakoonProtocol.encodeSequence(seq, False)
+
+def legacy_sequence_build(pairs):
+    # build the same Sequence object, so only the encoding differs
+    seq = Sequence()
+    for k, v in pairs:
+        seq.addUpdate(Set(k, v))
+    return legacy_sequence(pairs)
+
+
+def best_of(encode, args, repeat, loops):
+    best = None
+    for _ in xrange(repeat):
+        t0 = time.time()
+        for _ in xrange(loops):
+            result = encode(*args)
+        t = (time.time() - t0) / loops
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    c = Consistent()
+    cases = [("get", 1, 10000, legacy_get, ArakoonProtocol.encodeGet, ("some_key", c)),
+             ("range_entries", 1, 10000, legacy_range_entries, ArakoonProtocol.encodeRangeEntries,
+              ("key_a", True, "key_z", False, 1000, c))]
+    for n in (1000, 10000):
+        keys = ["key_%08d" % i for i in xrange(n)]
+        pairs = [(k, "value_of_" + k) for k in keys]
+        cases.append(("multiGet", n, 20, legacy_multi_get, ArakoonProtocol.encodeMultiGet, (keys, c)))
+        cases.append(("sequence", n, 20, legacy_sequence_build, current_sequence, (pairs,)))
+        cases.append(("compact seq", n, 20, legacy_sequence_build, compact_sequence, (pairs,)))
+
+    print "%-14s %8s %14s %14s %8s" % ("request", "keys", "legacy (us)", "current (us)", "speedup")
+    for name, n, loops, legacy, current, args in cases:
+        t_old, r_old = best_of(legacy, args, repeat, loops)
+        t_new, r_new = best_of(current, args, repeat, loops)
+        assert r_old == r_new
+        print "%-14s %8d %14.1f %14.1f %7.1fx" % (name, n, t_old * 1e6, t_new * 1e6, t_old / t_new)
+
+if __name__ == '__main__':
+    main()
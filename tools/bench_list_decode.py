@@ -0,0 +1,90 @@
+"""
+Micro-benchmark for the list decoders of the python client.
+
+Decodes a canned range / range_entries reply of 1k, 10k and 100k entries
+with the current decoders and with the former ones, which prepended every
+element to the result list.
+
+usage: python bench_list_decode.py [repeat]
+"""
+
+import os
+import sys
+import struct
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', 'src', 'client', 'python'))
+
+from ArakoonProtocol import ArakoonProtocol, _recvInt, _recvString
+from ArakoonClientConnection import ArakoonClientConnection
+
+
+def _packString(s):
+    return struct.pack("I", len(s)) + s
+
+def make_reply(n, pairs):
+    parts = [struct.pack("I", 0), struct.pack("I", n)]
+    for i in xrange(n - 1, -1, -1):
+        key = "key_%08d" % i
+        parts.append(_packString(key))
+        if pairs:
+            parts.append(_packString("value_of_" + key))
+    return ''.join(parts)
+
+class CannedConnection(ArakoonClientConnection):
+    """A connection that has the complete reply in its read buffer."""
+
+    def __init__(self, reply):
+        self._connected = True
+        self._readBuffer = bytearray(reply)
+        self._readView = memoryview(self._readBuffer)
+        self._readStart = 0
+        self._readEnd = len(reply)
+
+
+def legacy_string_list(con):
+    ArakoonProtocol._evaluateErrorCode(con)
+    retVal = []
+    for i in xrange(_recvInt(con)):
+        retVal[:0] = [_recvString(con)]
+    return retVal
+
+def legacy_string_pair_list(con):
+    ArakoonProtocol._evaluateErrorCode(con)
+    result = []
+    for i in xrange(_recvInt(con)):
+        k = _recvString(con)
+        v = _recvString(con)
+        result[:0] = [(k, v)]
+    return result
+
+
+def best_of(decode, reply, repeat):
+    best = None
+    for _ in xrange(repeat):
+        con = CannedConnection(reply)
+        t0 = time.time()
+        result = decode(con)
+        t = time.time() - t0
+        if best is None or t < best:
+            best = t
+    return best, result
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    cases = [("range", False, legacy_string_list,
+              ArakoonProtocol.decodeStringListResult),
+             ("range_entries", True, legacy_string_pair_list,
+              ArakoonProtocol.decodeStringPairListResult)]
+    print "%-14s %8s %12s %12s %8s" % ("reply", "entries", "legacy (s)", "current (s)", "speedup")
+    for name, pairs, legacy, current in cases:
+        for n in (1000, 10000, 100000):
+            reply = make_reply(n, pairs)
+            t_old, r_old = best_of(legacy, reply, repeat)
+            t_new, r_new = best_of(current, reply, repeat)
+            assert r_old == r_new
+            print "%-14s %8d %12.4f %12.4f %7.1fx" % (name, n, t_old, t_new, t_old / t_new)
+
+if __name__ == '__main__':
+    main()